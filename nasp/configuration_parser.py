@@ -258,6 +258,11 @@ def _get_application(app_node, name=None):
         job_parms['walltime'] = job_node.findtext('Walltime', default="")
         job_parms['queue'] = job_node.findtext('Queue', default="")
         job_parms['args'] = job_node.findtext('JobSubmitterArgs', default="")
+        # Optional split of an aligner's resources for samtools sort, see dispatcher._plan_alignment.
+        if job_node.find('SortCPUs') is not None:
+            job_parms['sort_cpus'] = job_node.findtext('SortCPUs')
+        if job_node.find('SortMemRequested') is not None:
+            job_parms['sort_mem'] = job_node.findtext('SortMemRequested')
     return name, path, args, job_parms
 
 
@@ -373,6 +378,10 @@ def _write_application(node, details, app_type):
         ElementTree.SubElement(job_node, "Walltime").text = job_parms["walltime"] if "walltime" in job_parms else ""
         ElementTree.SubElement(job_node, "Queue").text = job_parms["queue"] if "queue" in job_parms else ""
         ElementTree.SubElement(job_node, "JobSubmitterArgs").text = job_parms["args"] if "args" in job_parms else ""
+        if "sort_cpus" in job_parms:
+            ElementTree.SubElement(job_node, "SortCPUs").text = job_parms["sort_cpus"]
+        if "sort_mem" in job_parms:
+            ElementTree.SubElement(job_node, "SortMemRequested").text = job_parms["sort_mem"]
     return node
 
 
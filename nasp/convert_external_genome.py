@@ -16,8 +16,14 @@ def _parse_args():
     parser.add_argument("--deltafilterpath", default="delta-filter", help="Path to the 'delta-filter' executable.")
     parser.add_argument("--deltafilterargs", default="", help="Optional arguments to pass to the 'delta-filter' executable.")
     parser.add_argument("--reference", required=True, help="Path to the reference fasta file.")
-    parser.add_argument("--external", required=True, help="Path to the external genome fasta file.")
+    external_group = parser.add_mutually_exclusive_group(required=True)
+    external_group.add_argument("--external", help="Path to the external genome fasta file.")
+    external_group.add_argument("--manifest", help="Path to a file of external genomes to convert in one pool, one "
+                                                   "'name<tab>fasta' line each, optionally followed by '<tab>key<tab>"
+                                                   "stamp file' to write the key to once it is converted.  Each fasta "
+                                                   "is reformatted into the current directory first.")
     parser.add_argument("--name", default="", help="Name of this external genome.")
+    parser.add_argument("--numthreads", type=int, default=1, help="Number of external genomes to convert at once.")
     return parser.parse_args()
 
 
@@ -41,90 +47,394 @@ def generate_delta_file(nucmer_path, nucmer_args, delta_filter_path, delta_filte
     filtered_delta_handle.close()
 
 
-def _update_genome_from_delta_data(franken_genome, external_genome, parser_state, distance_covered, is_external_insert):
-    from nasp.nasp_objects import Genome
+# The complement of each call, in the same case, for reading an external contig on its reverse strand.
+_COMPLEMENT_TABLE = bytes.maketrans(b'ABCDGHKMNRSTUVWXYabcdghkmnrstuvwxy',
+                                    b'TVGHCDMKNYSAABWXRtvghcdmknysaabwxr')
 
-    if distance_covered == -1:
-        distance_covered = parser_state['final_pos'] - parser_state['reference_pos'] + 1
-        is_external_insert = True
-    if distance_covered > 0:
-        if parser_state['external_is_reversed']:
-            matching_segment = Genome.reverse_complement(''.join(
-                external_genome.get_call(( parser_state['external_pos'] - distance_covered + 1 ),
-                                         parser_state['external_pos'])))
+
+def _read_delta_records(delta_filename):
+    """
+    Args:
+        delta_filename (str): Path to a nucmer delta file.
+
+    Returns:
+        generator: A ( reference contig, external contig, reference length, alignments ) tuple per header line,
+        where each alignment is a ( reference start, reference end, external start, external end, distances ) tuple.
+
+    Raises:
+        MalformedInputFile: If a line is not a nucmer delta file line.
+    """
+    from nasp.nasp_objects import MalformedInputFile
+
+    with open(delta_filename, 'r') as delta_handle:
+        delta_handle.readline()
+        if delta_handle.readline().strip() != "NUCMER":
+            raise MalformedInputFile(delta_filename, "Only NUCMER alignments can be converted")
+        record = None
+        for line_from_delta_file in delta_handle:
+            fields = line_from_delta_file.split()
+            try:
+                if len(fields) == 4 and fields[0].startswith('>'):
+                    if record is not None:
+                        yield record
+                    record = ( fields[0][1:], fields[1], int(fields[2]), [] )
+                elif len(fields) == 7:
+                    record[3].append(tuple(map(int, fields[0:4])) + ( [], ))
+                elif len(fields) == 1:
+                    record[3][-1][4].append(int(fields[0]))
+                elif fields:
+                    raise ValueError(line_from_delta_file)
+            except ( ValueError, TypeError, IndexError ):
+                raise MalformedInputFile(delta_filename, "Unexpected line '{0}'".format(line_from_delta_file.strip()))
+        if record is not None:
+            yield record
+
+
+def _copy_segment(franken_contig, first_offset, segment, is_overlap):
+    """
+    Copies the calls of an aligned segment over the frankenfasta contig.
+    Where an earlier alignment of another external contig already placed a
+    call, a different call is a conflict, and becomes an 'N'.
+
+    Args:
+        franken_contig (bytearray): The calls of the reference contig.
+        first_offset (int): 0-indexed position of the segment on the reference contig.
+        segment (bytes): The calls of the external contig, on the reference strand.
+        is_overlap (bool): Whether an earlier external contig was aligned to the reference contig.
+    """
+    last_offset = first_offset + len(segment)
+    if is_overlap:
+        current_calls = franken_contig[first_offset:last_offset]
+        if current_calls == segment:
+            return
+        if current_calls.count(b'X') != len(current_calls):
+            merged_calls = bytearray(segment)
+            for offset, call in enumerate(current_calls):
+                if call != ord('X') and call != segment[offset]:
+                    merged_calls[offset] = ord('N')
+            segment = merged_calls
+    franken_contig[first_offset:last_offset] = segment
+
+
+def _apply_alignment(franken_contig, external_contig, alignment, is_overlap):
+    """
+    Places the calls of an external contig at the reference positions they
+    aligned to, a gap-free segment at a time.  A deletion in the external
+    contig is a '.', and an insertion is skipped.
+
+    Args:
+        franken_contig (bytearray): The calls of the reference contig.
+        external_contig (bytes): The calls of the external contig.
+        alignment (tuple): ( reference start, reference end, external start, external end, distances ), as in the
+            delta file.
+        is_overlap (bool): Whether an earlier external contig was aligned to the reference contig.
+
+    Returns:
+        bool: Whether the alignment fits within both contigs.
+    """
+    ( reference_start, reference_end, external_start, external_end, distances ) = alignment
+    is_reversed = external_end < external_start
+    # 0-indexed; on the reverse strand, the external position is the end of the next segment, exclusive.
+    reference_pos = reference_start - 1
+    external_pos = external_start if is_reversed else external_start - 1
+    external_step = -1 if is_reversed else 1
+    for distance in distances:
+        if distance == -1:
+            external_pos += external_step
+            continue
+        if distance == 1:
+            if reference_pos >= len(franken_contig):
+                return False
+            franken_contig[reference_pos] = ord('.')
+            reference_pos += 1
+            continue
+        segment_length = reference_end - reference_pos if distance == 0 else abs(distance) - 1
+        if segment_length < 1:
+            break
+        if is_reversed:
+            if external_pos - segment_length < 0 or external_pos > len(external_contig):
+                return False
+            segment = external_contig[external_pos - segment_length:external_pos][::-1].translate(_COMPLEMENT_TABLE)
         else:
-            matching_segment = ''.join(external_genome.get_call(parser_state['external_pos'], (
-                parser_state['external_pos'] + distance_covered - 1 )))
-        franken_genome.set_call(matching_segment, parser_state['reference_pos'], 'X')
-    parser_state['reference_pos'] = parser_state['reference_pos'] + distance_covered
-    parser_state['external_pos'] = parser_state['external_pos'] + (
-        -distance_covered if parser_state['external_is_reversed'] else distance_covered )
-    if is_external_insert:
-        parser_state['external_pos'] += -1 if parser_state['external_is_reversed'] else 1
-    else:
-        franken_genome.set_call('.', parser_state['reference_pos'], '!')
-        parser_state['reference_pos'] += 1
-    return parser_state
+            if external_pos < 0 or external_pos + segment_length > len(external_contig):
+                return False
+            segment = external_contig[external_pos:external_pos + segment_length]
+        if reference_pos < 0 or reference_pos + segment_length + ( distance > 0 ) > len(franken_contig):
+            return False
+        _copy_segment(franken_contig, reference_pos, segment, is_overlap)
+        reference_pos += segment_length
+        external_pos += external_step * segment_length
+        if distance > 0:
+            franken_contig[reference_pos] = ord('.')
+            reference_pos += 1
+        elif distance < 0:
+            external_pos += external_step
+    return True
+
+
+def _write_franken_contig(output_handle, contig_name, franken_contig, max_chars_per_line=80):
+    output_handle.write(b">franken::" + contig_name.encode() + b"\n")
+    output_handle.write(b"\n".join(franken_contig[line_start:line_start + max_chars_per_line] for line_start in
+                                   range(0, len(franken_contig), max_chars_per_line)) + b"\n")
+
+
+def _read_external_contigs(external_filename, contig_names):
+    """
+    The fallback for an external fasta that cannot be indexed.
+
+    Returns:
+        dict: The calls of each of the contigs, as bytes, by contig name.
+    """
+    from nasp.nasp_objects import open_input_file
+
+    external_contigs = {}
+    contig_lines = None
+    with open_input_file(external_filename, 'rb') as external_handle:
+        for line_from_fasta in external_handle:
+            if line_from_fasta.startswith(b'>'):
+                contig_name = line_from_fasta[1:].split(None, 1)[0].decode() if line_from_fasta[1:].strip() else ""
+                contig_lines = [] if contig_name in contig_names and contig_name not in external_contigs else None
+                if contig_lines is not None:
+                    external_contigs[contig_name] = contig_lines
+            elif contig_lines is not None:
+                contig_lines.append(line_from_fasta.rstrip(b"\r\n"))
+    return dict(( contig_name, b''.join(contig_lines) ) for ( contig_name, contig_lines ) in external_contigs.items())
+
+
+def _build_franken_contigs(delta_filename, get_external_contig):
+    """
+    Places the external calls of each alignment in the delta file on its
+    reference contig, which starts out as all 'X'.
+
+    Args:
+        delta_filename (str): Path to the filtered delta file of the external genome aligned to the reference.
+        get_external_contig (function): The calls of an external contig by name, as bytes, or None if it is missing.
+
+    Returns:
+        generator: A ( reference contig name, calls ) tuple per reference contig in the delta file, as soon as its last
+        alignment is placed.
+
+    Raises:
+        MalformedInputFile: If an alignment is to a contig that is missing or runs past the end of either contig.
+    """
+    from nasp.nasp_objects import MalformedInputFile
+
+    last_records = {}
+    for ( record_index, ( reference_contig_name, _, _, _ ) ) in enumerate(_read_delta_records(delta_filename)):
+        last_records[reference_contig_name] = record_index
+    franken_contigs = {}
+    external_contig = ( None, b'' )
+    for ( record_index, ( reference_contig_name, external_contig_name, reference_length, alignments ) ) in enumerate(
+            _read_delta_records(delta_filename)):
+        is_overlap = reference_contig_name in franken_contigs
+        if not is_overlap:
+            franken_contigs[reference_contig_name] = bytearray(b'X') * reference_length
+        if external_contig[0] != external_contig_name:
+            external_contig = ( external_contig_name, get_external_contig(external_contig_name) )
+            if external_contig[1] is None:
+                raise MalformedInputFile(delta_filename, "External contig '{0}' was not found".format(
+                    external_contig_name))
+        for alignment in alignments:
+            if not _apply_alignment(franken_contigs[reference_contig_name], external_contig[1], alignment, is_overlap):
+                raise MalformedInputFile(delta_filename, "Alignment '{0}' runs past the end of {1} or {2}".format(
+                    " ".join(map(str, alignment[0:4])), reference_contig_name, external_contig_name))
+        if last_records[reference_contig_name] == record_index:
+            yield reference_contig_name, franken_contigs.pop(reference_contig_name)
+
+
+def write_frankenfasta(delta_filename, external_filename, output_handle):
+    """
+    Builds the frankenfasta of an external genome: each reference contig
+    that the external genome aligned to, with the external call aligned to
+    each of its positions, or an 'X' where nothing aligned.
+    The external fasta is read through its FastaIndex, memory-mapped, so
+    that only the contig being copied is in memory as bytes, and each
+    reference contig is written as soon as its last alignment is placed,
+    so contigs are written in the order they last appear in the delta file.
 
+    Args:
+        delta_filename (str): Path to the filtered delta file of the external genome aligned to the reference.
+        external_filename (str): Path to the external genome fasta file the delta file was made from.
+        output_handle (file): Binary handle to write the frankenfasta to.
 
-def _parse_delta_line(line_from_delta_file, franken_genome, external_genome, parser_state):
-    import re
+    Raises:
+        MalformedInputFile: If an alignment is to a contig that is not in the external fasta or runs past the end of
+        either contig.
+    """
+    from nasp.nasp_objects import FastaIndex, InvalidContigName
 
-    line_match = re.match(r'^>([^ ]+) ([^ ]+) (\d+) \d+\s*$', line_from_delta_file)
-    if line_match:
-        current_contig = line_match.group(1)
-        external_genome.set_current_contig(line_match.group(2))
-        parser_state['contig_sizes'][current_contig] = int(line_match.group(3))
-        franken_genome.add_contig(current_contig)
+    def get_indexed_contig(contig_name):
+        try:
+            return fasta_index.get_call_bytes(contig_name)
+        except InvalidContigName:
+            return None
+
+    fasta_index = FastaIndex.load(external_filename)
+    if fasta_index is None:
+        external_contigs = _read_external_contigs(external_filename, set(
+            external_contig_name for ( _, external_contig_name, _, _ ) in _read_delta_records(delta_filename)))
+        get_external_contig = external_contigs.get
     else:
-        line_match = re.match(r'^(\d+) (\d+) (\d+) (\d+) \d+ \d+ \d+\s*$', line_from_delta_file)
-        if line_match:
-            parser_state['reference_pos'] = int(line_match.group(1))
-            parser_state['final_pos'] = int(line_match.group(2))
-            parser_state['external_pos'] = int(line_match.group(3))
-            parser_state['external_is_reversed'] = (
-                True if ( parser_state['external_pos'] > int(line_match.group(4)) ) else False )
-        else:
-            line_match = re.match(r'^(\-?)(\d+)\s*$', line_from_delta_file)
-            if line_match:
-                distance_covered = int(line_match.group(2)) - 1
-                is_external_insert = ( True if ( line_match.group(1) == '-' ) else False )
-                parser_state = _update_genome_from_delta_data(franken_genome, external_genome, parser_state,
-                                                              distance_covered, is_external_insert)
-    return parser_state
+        fasta_index.open(use_mmap=True)
+        get_external_contig = get_indexed_contig
+    try:
+        for ( contig_name, franken_contig ) in _build_franken_contigs(delta_filename, get_external_contig):
+            _write_franken_contig(output_handle, contig_name, franken_contig)
+    finally:
+        if fasta_index is not None:
+            fasta_index.close()
 
 
 def parse_delta_file(delta_filename, franken_genome, external_genome):
-    parser_state = dict(zip(['contig_sizes', 'reference_pos', 'external_pos', 'final_pos', 'external_is_reversed'],
-                            [dict(), None, None, None, None]))
-    delta_handle = open(delta_filename, 'r')
-    for line_from_delta_file in delta_handle:
-        parser_state = _parse_delta_line(line_from_delta_file, franken_genome, external_genome, parser_state)
-    delta_handle.close()
-    for current_contig in franken_genome.get_contigs():
-        franken_genome.extend_contig(parser_state['contig_sizes'][current_contig], 'X', current_contig)
+    """
+    The Genome version of write_frankenfasta, for when the external genome
+    is already read in.
+
+    Args:
+        delta_filename (str): Path to the filtered delta file of the external genome aligned to the reference.
+        franken_genome (Genome): Where to put the calls of each reference contig.
+        external_genome (Genome): The external genome the delta file was made from.
+    """
+    def get_external_contig(contig_name):
+        if contig_name not in external_genome.get_contigs():
+            return None
+        return ''.join(external_genome.get_call(1, -1, contig_name)).encode('latin-1')
+
+    for ( contig_name, franken_contig ) in _build_franken_contigs(delta_filename, get_external_contig):
+        franken_genome.add_contig(contig_name)
+        franken_genome.set_call(franken_contig.decode('latin-1'), 1, 'X', contig_name)
+
+
+# The reference path, nucmer path, nucmer args, delta-filter path, and delta-filter args of a conversion worker.
+_conversion_options = None
+
+
+def _set_conversion_options(reference_path, nucmer_path, nucmer_args, delta_filter_path, delta_filter_args):
+    """ Pool initializer for convert_external_genomes. """
+    global _conversion_options
+    _conversion_options = ( reference_path, nucmer_path, nucmer_args, delta_filter_path, delta_filter_args )
+
+
+def convert_external_genome(external_genome):
+    """
+    Reformats one external genome into the current directory, aligns it to
+    the reference, and writes its frankenfasta there, in a
+    convert_external_genomes worker.  Errors are logged and returned, so
+    that the other external genomes can still be converted.  Once the
+    frankenfasta is written, the stage key of the external genome, if it
+    has one, is written to its stamp file.
+
+    Args:
+        external_genome (tuple): The name and fasta path of the external genome, and optionally its stage key and
+            stamp file.
+
+    Returns:
+        str: The error, or None if the frankenfasta was written.
+    """
+    import os
+    from nasp.format_fasta import format_fasta
+
+    ( reference_path, nucmer_path, nucmer_args, delta_filter_path, delta_filter_args ) = _conversion_options
+    ( external_nickname, external_path ) = external_genome[0:2]
+    try:
+        formatted_path = os.path.basename(external_path)
+        if os.path.abspath(formatted_path) != os.path.abspath(external_path):
+            format_fasta(external_path, formatted_path, write_index=True)
+        generate_delta_file(nucmer_path, nucmer_args, delta_filter_path, delta_filter_args, external_nickname,
+                            reference_path, os.path.abspath(formatted_path))
+        with open(external_nickname + ".frankenfasta", 'wb') as handle:
+            write_frankenfasta(external_nickname + ".filtered.delta", formatted_path, handle)
+        if len(external_genome) == 4:
+            ( stage_key, stamp_filename ) = external_genome[2:4]
+            with open(stamp_filename, 'w') as stamp_handle:
+                stamp_handle.write(stage_key + "\n")
+    except Exception as conversion_error:
+        logging.exception("Unable to convert external genome '%s'", external_nickname)
+        return "{0}: {1}".format(external_nickname, conversion_error)
+    return None
+
+
+def read_manifest(manifest_filename):
+    """
+    Args:
+        manifest_filename (str): Path to a file with a 'name<tab>fasta' line per external genome, which may be
+            followed by '<tab>key<tab>stamp file'.
+
+    Returns:
+        list: The ( name, fasta path ) or ( name, fasta path, key, stamp file ) of each external genome.
+
+    Raises:
+        MalformedInputFile: If a line does not have a name and fasta, or has only one of a key and stamp file.
+    """
+    from nasp.nasp_objects import MalformedInputFile
+
+    external_genomes = []
+    with open(manifest_filename, 'r') as manifest_handle:
+        for manifest_line in manifest_handle:
+            if manifest_line.strip():
+                manifest_fields = manifest_line.rstrip("\r\n").split("\t")
+                if len(manifest_fields) not in ( 2, 4 ) or not all(manifest_fields):
+                    raise MalformedInputFile(manifest_filename, "Expected 'name<tab>fasta[<tab>key<tab>stamp file]' "
+                                                                "but found '{0}'".format(manifest_line.strip()))
+                external_genomes.append(tuple(manifest_fields))
+    return external_genomes
+
+
+def convert_external_genomes(external_genomes, reference_path, nucmer_path, nucmer_args, delta_filter_path,
+                             delta_filter_args, num_threads=1):
+    """
+    Converts many external genomes in one process pool of num_threads
+    workers, largest first, so that a job manager only schedules one job
+    for all of them instead of one job each.
+
+    Args:
+        external_genomes (list): The ( name, fasta path ), and optionally stage key and stamp file, of each external
+            genome.
+        reference_path (str): Path to the reference fasta file.
+        nucmer_path (str): Path to the 'nucmer' executable.
+        nucmer_args (str): Optional arguments to pass to the 'nucmer' executable.
+        delta_filter_path (str): Path to the 'delta-filter' executable.
+        delta_filter_args (str): Optional arguments to pass to the 'delta-filter' executable.
+        num_threads (int): Number of external genomes to convert at once.
+
+    Returns:
+        list: The errors of the external genomes that could not be converted.
+    """
+    import os
+    from multiprocessing import Pool
+
+    if len(external_genomes) == 0:
+        return []
+    external_genomes = sorted(external_genomes, key=lambda external_genome: os.path.getsize(external_genome[1]) if
+                              os.path.exists(external_genome[1]) else 0, reverse=True)
+    with Pool(max(1, min(num_threads, len(external_genomes))), _set_conversion_options,
+              ( os.path.abspath(reference_path), nucmer_path, nucmer_args, delta_filter_path, delta_filter_args )) as pool:
+        conversion_errors = pool.map(convert_external_genome, external_genomes, 1)
+    return [conversion_error for conversion_error in conversion_errors if conversion_error is not None]
 
 
 def main():
-    import subprocess
-    from nasp.nasp_objects import Genome, GenomeMeta
+    import sys
+    from nasp.nasp_objects import GenomeMeta
 
     commandline_args = _parse_args()
+    if commandline_args.manifest:
+        conversion_errors = convert_external_genomes(
+            read_manifest(commandline_args.manifest), commandline_args.reference, commandline_args.nucmerpath,
+            commandline_args.nucmerargs, commandline_args.deltafilterpath, commandline_args.deltafilterargs,
+            commandline_args.numthreads)
+        for conversion_error in conversion_errors:
+            sys.stderr.write("NASP ERROR: unable to convert external genome " + conversion_error + "\n")
+        if conversion_errors:
+            raise SystemExit(1)
+        return
     external_nickname = commandline_args.name if commandline_args.name else GenomeMeta.generate_nickname_from_filename(
         commandline_args.external)
-    #external_genome = Genome()
-    #external_genome.import_fasta_file(commandline_args.external)
     generate_delta_file(commandline_args.nucmerpath, commandline_args.nucmerargs, commandline_args.deltafilterpath,
                         commandline_args.deltafilterargs, external_nickname, commandline_args.reference,
                         commandline_args.external)
-    #franken_genome = Genome()
-    #parse_delta_file(( external_nickname + ".filtered.delta" ), franken_genome, external_genome)
-    #franken_genome.write_to_fasta_file(external_nickname + ".frankenfasta", "franken::")
-
-    import pkg_resources
-    nasptool_path = pkg_resources.resource_filename('nasp', 'nasptool_linux_64')
-    with open(external_nickname + ".frankenfasta", 'w') as handle:
-        return_code = subprocess.call([nasptool_path, "frankenfasta", external_nickname + ".filtered.delta"], stdout=handle)
+    with open(external_nickname + ".frankenfasta", 'wb') as handle:
+        write_frankenfasta(external_nickname + ".filtered.delta", commandline_args.external, handle)
 
 
 if __name__ == "__main__":
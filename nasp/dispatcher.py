@@ -18,15 +18,134 @@ import os
 App = namedtuple('App', ['name', 'path', 'args', 'job_params'])
 #Assembly = namedtuple('Assembly', ['name', 'read1', 'read2'])
 
+# The job id of a stage that was up to date, and so was not submitted; see _cache_stage.
+CACHED_JOB_ID = "cached"
+
+# The stage key of every output file of the stages of this run so far, so that a stage whose input is the output of
+# an earlier stage is invalidated along with it, even before that stage has run.
+_stage_keys = {}
+
 def _parse_args():
     import argparse
 
     parser = argparse.ArgumentParser(description="Meant to be called from the pipeline automatically.")
     parser.add_argument("--config", required=True, help="Path to the configuration xml file.")
+    parser.add_argument("--force", action="store_true",
+                        help="Submit every stage, even those whose outputs are up to date with their inputs.")
     return parser.parse_args()
 
 
-def _pbs_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue='', args='', hold=False, notify=False, waitfor_id=None):
+def _get_file_signature(file_path):
+    """
+    Describes an input file of a stage for its stage key: by the key of the
+    stage of this run that writes it, if any, or else by its size and
+    modification time, as make would.  Tools given as bare command names
+    are looked up on the PATH.
+    """
+    import shutil
+
+    if os.sep not in file_path and not os.path.exists(file_path):
+        file_path = shutil.which(file_path) or file_path
+    file_path = os.path.abspath(file_path)
+    if file_path in _stage_keys:
+        return "stage {0}".format(_stage_keys[file_path])
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return "missing"
+    return "{0} {1}".format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def _cache_stage(configuration, command, input_files, output_files, parameters=None):
+    """
+    Skips a pipeline stage whose outputs are up to date.  The stage key is
+    a checksum of the command, which has the tool paths and arguments in it,
+    any other parameters, and the signature of every input file and tool.
+    A submitted stage writes its key to a stamp file once its command has
+    succeeded, and the stage is up to date while the stamp has the current
+    key and all of the outputs exist.  Unless configuration["force"] is
+    "False", every stage is submitted as is.
+
+    Args:
+        configuration (dict): The run configuration.
+        command (str): The command of the stage.
+        input_files (list): The paths of the input files and tools, or None for an unused one.
+        output_files (list): The paths of the files the stage writes.
+        parameters: Optional JSON-safe values the stage also depends on.
+
+    Returns:
+        str: The command to submit, or None if the stage is up to date.
+    """
+    stamp_command = _get_stamp_command(configuration, command, input_files, output_files, parameters)
+    if not stamp_command:
+        return stamp_command if stamp_command is None else command
+    # set -e does not stop at a failed command in the middle of an && list, so its status is checked again at the end.
+    return "set -e\n{0}\ntest $? -eq 0\n{1}".format(command, stamp_command)
+
+
+def _get_stage_stamp(configuration, command, input_files, output_files, parameters=None):
+    """
+    The part of _cache_stage that decides whether the stage is up to date,
+    for when one job runs several stages.
+
+    Returns:
+        tuple: The key of the stage and the stamp file to write it to once
+        the stage has succeeded, with no stamp file if stages are always
+        run, or None if the stage is up to date.
+    """
+    import hashlib
+    import json
+
+    stage_key = hashlib.sha1(json.dumps([__version__, command, parameters] + [
+        [input_file, _get_file_signature(input_file)] for input_file in input_files if input_file]).encode()).hexdigest()
+    output_files = sorted(os.path.abspath(output_file) for output_file in output_files)
+    for output_file in output_files:
+        _stage_keys[output_file] = stage_key
+    if configuration.get("force", "True") == "True":
+        return stage_key, None
+    cache_folder = os.path.join(configuration["output_folder"], "stage_cache")
+    stamp_file = os.path.join(cache_folder, "{0}.stage".format(hashlib.sha1("\n".join(output_files).encode()).hexdigest()))
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as stamp_handle:
+            if stamp_handle.read().strip() == stage_key and all(os.path.exists(output_file) for output_file in output_files):
+                logging.info("Skipping up to date stage: %s" % command)
+                return None
+        # The stage is run again, and must not look done if it fails this time.
+        os.remove(stamp_file)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    return stage_key, stamp_file
+
+
+def _get_stamp_command(configuration, command, input_files, output_files, parameters=None):
+    """
+    _get_stage_stamp as a shell command.
+
+    Returns:
+        str: The command that marks the stage done once it has succeeded,
+        an empty string if stages are always run, or None if the stage is
+        up to date.
+    """
+    stage_stamp = _get_stage_stamp(configuration, command, input_files, output_files, parameters)
+    if stage_stamp is None:
+        return None
+    (stage_key, stamp_file) = stage_stamp
+    if stamp_file is None:
+        return ""
+    return "echo {0} > {1}".format(stage_key, shlex.quote(stamp_file))
+
+
+def _get_pending_jobs(waitfor_id):
+    """ Drops the stages that were up to date from the dependencies of a job, or returns None if none are left. """
+    if not waitfor_id:
+        return waitfor_id
+    job_ids = [job_id for job_id in waitfor_id[0].split(":") if job_id and job_id != CACHED_JOB_ID]
+    if not job_ids:
+        return None
+    return (":".join(job_ids),) + tuple(waitfor_id[1:])
+
+
+def _pbs_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue='', args='', hold=False, notify=False, waitfor_id=None, array_size=None, array_waitfor=None):
 
     job_resources = 'ncpus={ncpu},mem={mem}gb,walltime={hours}:00:00'.format(**{
         'ncpu': num_cpus,
@@ -40,11 +159,23 @@ def _pbs_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue=
         'job_name': shlex.quote(name),
     }))
 
+    dependencies = []
     if waitfor_id:
-        pbs_cmd.extend(['-W', 'depend={directive}:{job_ids}'.format(**{
-            'directive': waitfor_id[1] if len(waitfor_id) > 1 else 'afterok',
-            'job_ids': waitfor_id[0],
-        })])
+        directive = waitfor_id[1] if len(waitfor_id) > 1 else 'afterok'
+        # Job arrays have ids ending in '[]' and are waited for with the array form of the directive.
+        job_ids = [job_id for job_id in waitfor_id[0].split(":") if not job_id.endswith("[]")]
+        array_ids = [job_id for job_id in waitfor_id[0].split(":") if job_id.endswith("[]")]
+        if job_ids:
+            dependencies.append('{directive}:{job_ids}'.format(directive=directive, job_ids=":".join(job_ids)))
+        if array_ids:
+            dependencies.append('{directive}array:{job_ids}'.format(directive=directive, job_ids=":".join(array_ids)))
+    if array_waitfor:
+        # TORQUE cannot make each task wait for just the matching task of another array, so it waits for all of them.
+        dependencies.append('afterokarray:{job_ids}'.format(job_ids=array_waitfor))
+    if dependencies:
+        pbs_cmd.extend(['-W', 'depend=' + ','.join(dependencies)])
+    if array_size:
+        pbs_cmd.extend(['-t', '1-{0}'.format(array_size)])
     if queue:
         pbs_cmd.extend(['-q', queue])
     if hold:
@@ -67,7 +198,7 @@ def _pbs_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue=
         print("WARNING: Job not submitted: %s" % output)
 
 
-def _slurm_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue='', args='', hold=False, notify=False, waitfor_id=None):
+def _slurm_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queue='', args='', hold=False, notify=False, waitfor_id=None, array_size=None, array_waitfor=None):
     slurm_cmd = shlex.split('sbatch -D {work_dir} -c {ncpu} --mem={mem_gb} --time={hours} --mail-type=FAIL -J {job_name}'.format(**{
         'work_dir': shlex.quote(work_dir),
         'ncpu': shlex.quote(str(num_cpus)),
@@ -76,13 +207,19 @@ def _slurm_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queu
         'job_name': shlex.quote(name),
     }))
 
+    dependencies = []
     if waitfor_id:
-        slurm_cmd.extend([
-            '-d', '{directive}:{job_ids}'.format(**{
-                'directive': waitfor_id[1] if len(waitfor_id) > 1 else 'afterok',
-                'job_ids': waitfor_id[0],
-            })
-        ])
+        dependencies.append('{directive}:{job_ids}'.format(**{
+            'directive': waitfor_id[1] if len(waitfor_id) > 1 else 'afterok',
+            'job_ids': waitfor_id[0],
+        }))
+    if array_waitfor:
+        # Each task waits for the task with the same index in each of the arrays.
+        dependencies.append('aftercorr:{job_ids}'.format(job_ids=array_waitfor))
+    if dependencies:
+        slurm_cmd.extend(['-d', ','.join(dependencies)])
+    if array_size:
+        slurm_cmd.append('--array=1-{0}'.format(array_size))
 
     if queue:
         slurm_cmd.extend(['-p', queue])
@@ -106,29 +243,174 @@ def _slurm_command(name, work_dir, mem_requested=1, num_cpus=1, walltime=1, queu
         print("WARNING: Job not submitted: %s" % output)
 
 
-def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False, notify=False):
+class _LocalExecutor(object):
+    """
+    Runs the jobs of a pipeline on this machine when there is no job manager.
+    Submitted jobs are held until run is called, which starts each job as
+    soon as the jobs it waits for have finished and enough cores and memory
+    are free for its num_cpus and mem_requested, and waits for all of them.
+    """
+
+    def __init__(self, num_cpus=None, mem_gb=None):
+        """
+        Args:
+            num_cpus (int): The cores to share between jobs, all of them on this machine by default.
+            mem_gb (float): The memory to share between jobs, in GB, all of it on this machine by default.
+        """
+        import multiprocessing
+
+        self.num_cpus = num_cpus or multiprocessing.cpu_count()
+        if mem_gb is None:
+            try:
+                mem_gb = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 3
+            except (AttributeError, ValueError, OSError):
+                mem_gb = float('inf')
+        self.mem_gb = mem_gb
+        self.clear()
+
+    def clear(self):
+        """ Forgets every job, so the executor can be used for a new run. """
+        self._jobs = []
+        self._job_states = {}
+
+    def submit(self, command, job_parms, waitfor_id=None):
+        """
+        Args:
+            command (str): The shell command of the job.
+            job_parms (dict): The job parameters, of which name, work_dir, num_cpus and mem_requested are used.
+            waitfor_id (tuple): The colon separated job ids to wait for and optionally the dependency type, which is
+                afterok unless it is afterany.
+
+        Returns:
+            str: The id of the new job.
+        """
+        job_id = str(len(self._jobs) + 1)
+        waitfor = []
+        afterany = False
+        if waitfor_id:
+            waitfor = [waitfor_job for waitfor_job in waitfor_id[0].split(":") if waitfor_job in self._job_states]
+            afterany = len(waitfor_id) > 1 and waitfor_id[1] == 'afterany'
+        self._jobs.append({
+            'id': job_id,
+            'name': job_parms.get('name', "nasp_job_%s" % job_id),
+            'command': command,
+            'work_dir': job_parms['work_dir'],
+            # Unset job parameters are empty strings, which take a core and no memory.
+            'num_cpus': min(int(job_parms.get('num_cpus') or 1), self.num_cpus),
+            'mem_requested': min(float(job_parms.get('mem_requested') or 0), self.mem_gb),
+            'waitfor': waitfor,
+            'afterany': afterany
+        })
+        self._job_states[job_id] = 'pending'
+        return job_id
+
+    def run(self):
+        """
+        Runs every pending job, each with its output in <work_dir>/<name>.out.
+        A job that waits for a failed job is not run, unless it waits with
+        afterany.
+
+        Returns:
+            list: The names of the jobs that failed or were not run, in the order they were submitted.
+        """
+        import queue
+        import subprocess
+        import threading
+
+        def wait_for_job(job_id, process):
+            finished_jobs.put((job_id, process.wait()))
+
+        def fits(job):
+            # The free cores and memory are counted from the running jobs each time, so that they cannot drift, and a
+            # job that does not fit still runs on its own.
+            if not running_jobs:
+                return True
+            free_cpus = self.num_cpus - sum(running_job['num_cpus'] for running_job in running_jobs.values())
+            free_mem = self.mem_gb - sum(running_job['mem_requested'] for running_job in running_jobs.values())
+            return job['num_cpus'] <= free_cpus and job['mem_requested'] <= free_mem
+
+        finished_jobs = queue.Queue()
+        running_jobs = {}
+        while True:
+            # Jobs are always submitted after the jobs they wait for, so one pass in submission order also skips the
+            # jobs that wait for a job skipped earlier in the pass.
+            for job in self._jobs:
+                if self._job_states[job['id']] != 'pending':
+                    continue
+                waitfor_states = [self._job_states[waitfor_job] for waitfor_job in job['waitfor']]
+                if 'pending' in waitfor_states or 'running' in waitfor_states:
+                    continue
+                if not job['afterany'] and ('failed' in waitfor_states or 'skipped' in waitfor_states):
+                    self._job_states[job['id']] = 'skipped'
+                    logging.warning("Job %s skipped, a job it depends on failed", job['name'])
+                    print("WARNING: Job %s was not run because a job it depends on failed" % job['name'])
+                elif fits(job):
+                    logging.info("Starting job %s: %s", job['name'], job['command'])
+                    with open(os.path.join(job['work_dir'], "%s.out" % job['name']), 'w') as output_log:
+                        process = subprocess.Popen(job['command'], stdout=output_log, stderr=subprocess.STDOUT,
+                                                   shell=True, cwd=job['work_dir'])
+                    thread = threading.Thread(target=wait_for_job, args=(job['id'], process))
+                    thread.daemon = True
+                    thread.start()
+                    running_jobs[job['id']] = job
+                    self._job_states[job['id']] = 'running'
+            if not running_jobs:
+                break
+            (job_id, return_code) = finished_jobs.get()
+            job = running_jobs.pop(job_id)
+            if return_code == 0:
+                self._job_states[job_id] = 'done'
+                logging.info("Job %s finished", job['name'])
+            else:
+                self._job_states[job_id] = 'failed'
+                output_file = os.path.join(job['work_dir'], "%s.out" % job['name'])
+                logging.error("Job %s failed with exit status %s", job['name'], return_code)
+                print("ERROR: Job %s failed with exit status %s, see %s" % (job['name'], return_code, output_file))
+        return [job['name'] for job in self._jobs if self._job_states[job['id']] in ('failed', 'skipped', 'pending')]
+
+
+# The jobs of a run without a job manager, see _submit_job and begin.
+_local_executor = _LocalExecutor()
+
+
+def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False, notify=False, array_size=None,
+                array_waitfor=None):
+    """
+    Args:
+        job_submitter (str): PBS, SLURM or SGE, or anything else to run the job on this machine.
+        command (str): The shell command of the job.
+        job_parms (dict): The name, work_dir, num_cpus, mem_requested, walltime, queue and args of the job.
+        waitfor_id (tuple): The colon separated ids of the jobs to wait for and optionally the dependency type.
+        hold (bool): Submit the job held, see _release_hold.
+        notify (bool): Mail the user when the job ends.
+        array_size (int): Submit a job array of this many tasks, numbered from 1, see _JobArrays.
+        array_waitfor (str): The colon separated ids of the job arrays each task waits for the matching task of.
+
+    Returns:
+        str: The id of the job, or None if it was not submitted.
+    """
     import subprocess
     import re
-    import os
 
     jobid = None
+    waitfor_id = _get_pending_jobs(waitfor_id)
     logging.info("command = %s" % command)
     if job_submitter == "PBS":
 
-        submit_command = _pbs_command(job_params['name'], job_params['work_dir'], job_params['mem_requested'], job_params['num_cpus'], job_params['walltime'], job_params['queue'], job_params['args'], hold, notify, waitfor_id)
+        submit_command = _pbs_command(job_parms['name'], job_parms['work_dir'], job_parms['mem_requested'], job_parms['num_cpus'], job_parms['walltime'], job_parms['queue'], job_parms['args'], hold, notify, waitfor_id, array_size, array_waitfor)
         logging.debug("submit_command = {0}".format(submit_command))
         output = subprocess.getoutput("echo {0} | {1} - ".format(shlex.quote(command), submit_command))
         logging.debug("output = {0}".format(output))
-        job_match = re.search('^(\d+)\..*$', output)
+        job_match = re.search('^(\d+(?:\[\])?)\..*$', output)
         if job_match:
             jobid = job_match.group(1)
         else:
             logging.warning("Job not submitted!!")
             print("WARNING: Job not submitted: %s" % output)
     elif job_submitter == "SLURM":
-        submit_command = _slurm_command(job_params['name'], job_params['work_dir'], job_params['mem_requested'], job_params['num_cpus'], job_params['walltime'], job_params['queue'], job_params['args'], hold, notify, waitfor_id)
+        submit_command = _slurm_command(job_parms['name'], job_parms['work_dir'], job_parms['mem_requested'], job_parms['num_cpus'], job_parms['walltime'], job_parms['queue'], job_parms['args'], hold, notify, waitfor_id, array_size, array_waitfor)
         logging.debug("submit_command = %s" % submit_command)
-        output = subprocess.getoutput("%s --wrap=\"%s\"" % (submit_command, command))
+        output = subprocess.getoutput("%s --wrap=%s" % (submit_command, shlex.quote(command)))
         logging.debug("output = %s" % output)
         job_match = re.search('^Submitted batch job (\d+)$', output)
         if job_match:
@@ -141,6 +423,10 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
         waitfor = ""
         if waitfor_id:
             waitfor = "-hold_jid %s" % (re.sub(":", ",", waitfor_id[0]))
+        if array_waitfor:
+            waitfor += " -hold_jid_ad %s" % (re.sub(":", ",", array_waitfor))
+        if array_size:
+            waitfor += " -t 1-%s" % array_size
         queue = ""
         if job_parms["queue"]:
             queue = "-q %s" % job_parms["queue"]
@@ -158,48 +444,158 @@ def _submit_job(job_submitter, command, job_parms, waitfor_id=None, hold=False,
         #output = subprocess.getoutput("echo \"%s\" | %s" % (command, submit_command))
         output = subprocess.getoutput("%s \"%s\"" % (submit_command, command))
         logging.debug("output = %s" % output)
-        job_match = re.search('^\D*(\d+)\s.*$', output)
+        job_match = re.search('^\D*(\d+)[\s.].*$', output)
         if job_match:
             jobid = job_match.group(1)
         else:
             logging.warning("Job not submitted!!")
             print("WARNING: Job not submitted: %s" % output)
     else:
-        command = re.sub('\n', '; ', command)
-        work_dir = job_parms['work_dir']
-        dependency_check = ""
-        if waitfor_id:
-            if re.search(":", waitfor_id[0]):
-                pid_filename = os.path.join(work_dir, "%s_dependent_pids" % job_parms['name'])
-                pid_file = open(pid_filename, 'w')
-                pids = waitfor_id[0].split(":")
-                pid_file.write("\n".join(pids))
-                pid_file.close()
-                dependency_check = "while [ -s %s ]; do sleep 600; for pid in `cat %s`; do kill -0 \"$pid\" 2>/dev/null || sed -i \"/^$pid$/d\" %s; done; done; rm %s; " % (
-                    pid_filename, pid_filename, pid_filename, pid_filename)
-            else:
-                pid = waitfor_id[0]
-                dependency_check = "while kill -0 %s; do sleep 300; done; " % pid
-        # cpu_check = "grep 'cpu ' /proc/stat | awk '{usage=($2+$4)/($2+$4+$5)} END {print 1-usage}'"
-        total_mem = subprocess.getoutput("free -g | grep Mem: | awk '{ print $2 }'")
-        mem_requested = job_parms['mem_requested']
-        if mem_requested > total_mem:
-            mem_requested = total_mem
-        print("total_mem = %s" % total_mem)
-        mem_needed = float(mem_requested) * 750
-        mem_check = "while [ `free -m | grep cache: | awk '{ print $4 }'` -lt %d ]; do sleep 300; done; " % mem_needed
-        submit_command = "%s%s%s" % (dependency_check, mem_check, command)
-        logging.debug("submit_command = %s" % submit_command)
-        output_log = os.open(os.path.join(work_dir, "%s.out" % job_parms['name']), os.O_WRONLY | os.O_CREAT)
-        proc = subprocess.Popen(submit_command, stderr=subprocess.STDOUT, stdout=output_log, shell=True, cwd=work_dir)
-        jobid = str(proc.pid)
+        jobid = _local_executor.submit(command, job_parms, waitfor_id)
     logging.info("jobid = %s" % jobid)
     return jobid
 
 
+# Runs the task of a job array given by the job manager's task id: the line of the manifest, the first argument, with
+# that number, which has the task id, sample name, work directory and command of the task separated by tabs.
+_ARRAY_TASK_RUNNER = """#!/bin/sh
+task_id=${SLURM_ARRAY_TASK_ID:-${PBS_ARRAYID:-$SGE_TASK_ID}}
+task=$(sed -n "${task_id}p" "$1")
+work_dir=$(printf '%s\\n' "$task" | cut -f 3)
+command=$(printf '%s\\n' "$task" | cut -f 4-)
+cd "$work_dir" && eval "$command"
+"""
+
+
+class _JobArrays(object):
+    """
+    Collects the jobs a run submits for each sample into one job array per
+    stage, so the job manager gets one submission per stage however many
+    samples there are.  While collecting, each job handed to _submit_task
+    becomes the next task of its stage's array and gets a placeholder id,
+    and submit then submits every array with a manifest of its tasks.  A
+    stage is split into an array per set of upstream arrays its tasks wait
+    for, so each task of the array can wait for just the matching task of
+    the arrays upstream of it.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """ Stops collecting and forgets every array. """
+        self.job_submitter = None
+        self.array_folder = None
+        self._arrays = []
+        self._array_tasks = {}
+
+    def start(self, job_submitter, array_folder):
+        """
+        Args:
+            job_submitter (str): The job manager to submit the arrays to.
+            array_folder (str): The folder to write the manifests to.
+        """
+        self.clear()
+        self.job_submitter = job_submitter
+        self.array_folder = array_folder
+
+    @property
+    def collecting(self):
+        return self.job_submitter is not None
+
+    def add(self, stage, sample, command, job_parms, waitfor_id=None):
+        """
+        Args:
+            stage (str): The name of the stage, which is also the name of its job arrays.
+            sample (str): The name of the sample the task is for.
+            command (str): The shell command of the task.
+            job_parms (dict): The job parameters, which are the same for every task of a stage.
+            waitfor_id (tuple): The colon separated ids of the jobs and tasks the task waits for.
+
+        Returns:
+            str: The placeholder id of the task, see get_job_id.
+        """
+        waitfor_id = _get_pending_jobs(waitfor_id)
+        waitfor_jobs = waitfor_id[0].split(":") if waitfor_id else []
+        upstream_tasks = [self._array_tasks[job_id] for job_id in waitfor_jobs if job_id in self._array_tasks]
+        array_key = ( stage, tuple(sorted(set(array['number'] for ( array, _ ) in upstream_tasks))) )
+        array = next((array for array in self._arrays if array['key'] == array_key), None)
+        if array is None:
+            array = {'key': array_key, 'number': len(self._arrays) + 1, 'stage': stage,
+                     'job_parms': dict(job_parms, name=stage), 'tasks': [], 'waitfor': [], 'upstream': [],
+                     'corresponding': True, 'job_id': None}
+            self._arrays.append(array)
+        array['tasks'].append(( sample, job_parms['work_dir'], command ))
+        task_index = len(array['tasks'])
+        for job_id in waitfor_jobs:
+            if job_id not in self._array_tasks and job_id not in array['waitfor']:
+                array['waitfor'].append(job_id)
+        for ( upstream_array, upstream_index ) in upstream_tasks:
+            if upstream_array not in array['upstream']:
+                array['upstream'].append(upstream_array)
+            if upstream_index != task_index:
+                array['corresponding'] = False
+        task_id = "array{0}[{1}]".format(array['number'], task_index)
+        self._array_tasks[task_id] = ( array, task_index )
+        return task_id
+
+    def submit(self):
+        """ Submits the arrays in the order they were started, which is after the arrays they wait for, and stops collecting. """
+        if self._arrays:
+            if not os.path.exists(self.array_folder):
+                os.makedirs(self.array_folder)
+            runner = os.path.join(self.array_folder, "run_array_task.sh")
+            with open(runner, 'w') as runner_handle:
+                runner_handle.write(_ARRAY_TASK_RUNNER)
+        for array in self._arrays:
+            upstream_ids = [upstream_array['job_id'] for upstream_array in array['upstream']]
+            if None in upstream_ids:
+                print("WARNING: Job array %s not submitted, an array it depends on was not submitted" % array['stage'])
+                continue
+            manifest = os.path.join(self.array_folder, "{0}-{1}.manifest".format(array['stage'], array['number']))
+            with open(manifest, 'w') as manifest_handle:
+                for ( task_index, ( sample, work_dir, command ) ) in enumerate(array['tasks'], start=1):
+                    # Each task is one line of the manifest, and the commands of the per-sample stages are all simple
+                    # enough to join their lines with semicolons, as is done for SGE.
+                    manifest_handle.write("{0}\t{1}\t{2}\t{3}\n".format(task_index, sample, work_dir,
+                                                                       command.replace("\n", "; ")))
+            waitfor = array['waitfor'] if array['corresponding'] else array['waitfor'] + upstream_ids
+            array_waitfor = ":".join(upstream_ids) if array['corresponding'] and upstream_ids else None
+            array['job_id'] = _submit_job(self.job_submitter,
+                                          "sh {0} {1}".format(shlex.quote(runner), shlex.quote(manifest)),
+                                          array['job_parms'], (":".join(waitfor),) if waitfor else None,
+                                          array_size=len(array['tasks']), array_waitfor=array_waitfor)
+        self.job_submitter = None
+
+    def get_job_id(self, job_id):
+        """ Returns the id of the submitted array for a task placeholder id, or any other job id as is. """
+        if job_id in self._array_tasks:
+            return self._array_tasks[job_id][0]['job_id']
+        return job_id
+
+
+# The job arrays of a run with a job manager, see _submit_task and begin.
+_job_arrays = _JobArrays()
+
+
+def _submit_task(job_submitter, stage, sample, command, job_parms, waitfor_id=None):
+    """
+    Submits the job of a stage for one sample, or adds it to the stage's job
+    array if the run is collecting them.  The arguments are as for
+    _submit_job, and _JobArrays.add.
+    """
+    if _job_arrays.collecting:
+        return _job_arrays.add(stage, sample, command, job_parms, waitfor_id)
+    if waitfor_id:
+        return _submit_job(job_submitter, command, job_parms, waitfor_id)
+    return _submit_job(job_submitter, command, job_parms)
+
+
 def _release_hold(job_submitter, job_id):
     import subprocess
 
+    if job_id == CACHED_JOB_ID:
+        return
     if job_submitter == "PBS" or job_submitter == "SGE":
         command = "qrls %s" % job_id
     elif job_submitter == "SLURM":
@@ -223,9 +619,9 @@ def _index_reference(configuration):
         os.makedirs(ref_folder)
     # Copy the reference as $output_folder/reference/reference.fasta, verifying its format first. Replace it if it already exists.
     reference = os.path.join(ref_folder, "reference.fasta")
-    if os.path.exists(reference):
-        os.remove(reference)
-    index_commands = ["format_fasta --inputfasta %s --outputfasta %s" % (ref_path, reference)]
+    index_commands = ["format_fasta --inputfasta %s --outputfasta %s --index" % (ref_path, reference)]
+    input_files = [ref_path]
+    output_files = [reference, reference + ".fai"]
 
     # Gather all of the index commands that need to be run
     bwa_done = False
@@ -234,33 +630,45 @@ def _index_reference(configuration):
         if re.search('bwa', name, re.IGNORECASE):
             if not bwa_done:
                 index_commands.append("%s index %s" % (path, reference))
+                output_files.append(reference + ".bwt")
                 bwa_done = True
         elif re.search('b(ow)?t(ie)?2', name, re.IGNORECASE):
             bt2path = os.path.split(path)[0]
             bt2_build_path = os.path.join(bt2path, "bowtie2-build")
             index_commands.append("%s %s reference" % (bt2_build_path, reference))
+            input_files.append(bt2_build_path)
+            output_files.append(os.path.join(ref_folder, "reference.1.bt2"))
         elif re.search('novo', name, re.IGNORECASE):
             novopath = os.path.split(path)[0]
             novoindex_path = os.path.join(novopath, "novoindex")
             index_commands.append("%s %s.idx %s" % (novoindex_path, reference, reference))
+            input_files.append(novoindex_path)
+            output_files.append(reference + ".idx")
         elif re.search('snap', name, re.IGNORECASE):
             index_commands.append("%s index %s %s" % (path, reference, os.path.join(ref_folder, "snap")))
+            output_files.append(os.path.join(ref_folder, "snap"))
         else:
             print("Unknown aligner \'%s\' found, don't know how to index the reference for it. Skipping..." % name)
+            continue
+        input_files.append(path)
 
-    #if we are using GATK, we also need to create a Sequence Dictionary and samtools index of the reference
+    #if we are using GATK, we also need to create a Sequence Dictionary of the reference; format_fasta wrote its index
     if next((v for i, v in enumerate(configuration["snpcallers"]) if re.search('gatk', v[0], re.IGNORECASE)), None):
         #picard_path = configuration["picard"][1] or ""
         picard_path = configuration["picard"][1]
         picard_memory = 2
         if configuration["picard"][3]:
             picard_memory = configuration["picard"][3]['mem_requested'] or 2
-        samtools_path = configuration["samtools"][1] or "samtools"
         out_file = os.path.join(ref_folder, "reference.dict")
         index_commands.append("java -Xmx%sG -jar %s CreateSequenceDictionary R=%s O=%s" % (picard_memory, picard_path, reference, out_file))
-        index_commands.append("%s faidx %s" % (samtools_path, reference))
+        input_files.append(picard_path)
+        output_files.append(out_file)
 
-    command = "\n".join(index_commands)
+    command = _cache_stage(configuration, "\n".join(index_commands), input_files, output_files)
+    if command is None:
+        return CACHED_JOB_ID, reference
+    if os.path.exists(reference):
+        os.remove(reference)
     job_parms['work_dir'] = ref_folder
     job_id = _submit_job(configuration["job_submitter"], command, job_parms, hold=True)
     return job_id, reference
@@ -296,16 +704,79 @@ def _novo_index_command(path, reference):
     })
 
 
-def _samtools_view_sort_index_pipe_command(samtools_path, output_bam):
+AlignmentPlan = namedtuple('AlignmentPlan', ['aligner_cpus', 'sort_cpus', 'sort_mem_mb'])
+
+
+def _plan_alignment(job_parms):
+    """
+    Splits the cores and memory of an alignment job between the stages of
+    its pipeline.  The aligner and samtools sort run at the same time, but
+    sort only buffers its input until the aligner is done and then does all
+    of its merging and compression, so both get every core.  The memory is
+    split between the aligner, for its index, and the sort buffers, half
+    each unless the job parameters give sort_cpus or sort_mem (in GB).
+    Indexing the sorted bam is single threaded.
+
+    Args:
+        job_parms (dict): The job parameters of the aligner.
+
+    Returns:
+        AlignmentPlan: The threads of the aligner, and the threads and memory per thread, in MB, of samtools sort.
+    """
+    num_cpus = max(int(job_parms.get('num_cpus') or 1), 1)
+    mem_requested = float(job_parms.get('mem_requested') or 1)
+    sort_cpus = min(max(int(job_parms.get('sort_cpus') or num_cpus), 1), num_cpus)
+    sort_mem = min(float(job_parms.get('sort_mem') or mem_requested / 2), mem_requested)
+    # samtools sort takes its memory per thread, and will not go below a few megabytes.
+    sort_mem_mb = max(int(sort_mem * 1024 / sort_cpus), 64)
+    return AlignmentPlan(num_cpus, sort_cpus, sort_mem_mb)
+
+
+def _samtools_view_sort_index_pipe_command(samtools_path, output_bam, sort_cpus=1, sort_mem_mb=768):
     (bam_prefix, _) = os.path.splitext(output_bam)
-    # The semicolon has a space on each side so the shlex parser will treat it as a separate token.
-    return '{samtools} view -S -u -h - | {samtools} sort - {bam_prefix} ; {samtools} index {bam_filename}'.format(**{
+    return '{samtools} view -S -u -h - | {samtools} sort -@ {sort_cpus} -m {sort_mem}M - {bam_prefix} && {samtools} index {bam_filename}'.format(**{
         'samtools': shlex.quote(samtools_path),
+        'sort_cpus': sort_cpus,
+        'sort_mem': sort_mem_mb,
         'bam_prefix': shlex.quote(bam_prefix),
         'bam_filename': shlex.quote(output_bam)
     })
 
 
+def _align_sort_index_command(aligner_command, samtools_path, output_bam, plan, temp_files=()):
+    """
+    Args:
+        aligner_command (str): The aligner command, which writes sam to stdout.
+        samtools_path (str): path to samtools executable
+        output_bam (str): The sorted and indexed bam to write.
+        plan (AlignmentPlan): The resources of each stage, see _plan_alignment.
+        temp_files (tuple): Intermediate files of the aligner to remove once the bam is written.
+
+    Returns:
+        string: command that streams the aligner output through samtools sort into output_bam, indexes it, and
+        writes how many seconds each stage took to <bam prefix>.timings
+    """
+    (bam_prefix, _) = os.path.splitext(output_bam)
+    # The aligner writes the time it finished to a file, as the pipeline only has the exit status of samtools sort
+    # and this also lets the time spent sorting after the aligner is done be told apart from the alignment.
+    aligned_file = shlex.quote(bam_prefix + ".aligned")
+    timings_file = shlex.quote(bam_prefix + ".timings")
+    (view_sort_command, index_command) = _samtools_view_sort_index_pipe_command(
+        samtools_path, output_bam, plan.sort_cpus, plan.sort_mem_mb).rsplit(' && ', 1)
+    command_parts = [
+        "rm -f {0}".format(aligned_file),
+        "started=$(date +%s)",
+        "{{ {aligner} && date +%s > {aligned}; }} | {view_sort}".format(aligner=aligner_command, aligned=aligned_file,
+                                                                      view_sort=view_sort_command),
+        "sorted=$(date +%s)",
+        "aligned=$(cat {0})".format(aligned_file),
+        index_command,
+        "printf 'align\\t%s\\nsort\\t%s\\nindex\\t%s\\n' $((aligned - started)) $((sorted - aligned)) $(($(date +%s) - sorted)) > {0}".format(timings_file),
+        "rm -f {0}".format(' '.join(map(shlex.quote, (bam_prefix + ".aligned",) + tuple(temp_files))))
+    ]
+    return ' && '.join(command_parts)
+
+
 def _bwamem_command(path, args, ncpu, reference, sample_name, read1, read2=None):
     """
     Args:
@@ -333,6 +804,10 @@ def _bwamem_command(path, args, ncpu, reference, sample_name, read1, read2=None)
 
 def _bwa_command(path, args, ncpu, reference, output_folder, sample_name, read1, read2=None):
     """
+    bwa aln cannot stream its alignments to bwa sampe/samse, so they go
+    through .sai files in <output_folder>/bwa, see _get_bwa_sai_files.  The
+    reads of a pair are aligned at the same time, with half of the threads each.
+
     Args:
         path (str): path to aligner executable
         args (str): raw arguments to be passed to the aligner
@@ -347,69 +822,64 @@ def _bwa_command(path, args, ncpu, reference, output_folder, sample_name, read1,
         string: command to execute aligner
     """
     import re
-    import os
 
     bam_string = '@RG\\tID:{sample_name}\\tSM:{sample_name}'.format(sample_name=sample_name)
     # Parse read file basename
     is_illumina_fastq = "-I" if re.search('(?:.*\/)?[^\/]+?_[12]_sequence\.txt(?:\.gz)?$', read1, re.IGNORECASE) else ""
     quoted_bwa_args = ' '.join(map(shlex.quote, shlex.split(args)))
+    sai_files = _get_bwa_sai_files(output_folder, sample_name, read2)
 
-    if read2:
-        outfile1 = os.path.join(output_folder, "{0}-R1.sai".format(sample_name))
-        outfile2 = os.path.join(output_folder, "{0}-R2.sai".format(sample_name))
-        align_read1 = '{bwa} aln {is_illumina_fastq} {reference} {read1} -t {ncpu} -f {outfile1} {bwa_args}'.format(**{
+    def aln_command(read, sai_file, ncpu):
+        return '{bwa} aln {is_illumina_fastq} {reference} {read} -t {ncpu} -f {sai_file} {bwa_args}'.format(**{
             'bwa': shlex.quote(path),
             'is_illumina_fastq': is_illumina_fastq,
             'reference': shlex.quote(reference),
-            'read1': shlex.quote(read1),
+            'read': shlex.quote(read),
             'ncpu': shlex.quote(str(ncpu)),
-            'outfile1': shlex.quote(outfile1),
+            'sai_file': shlex.quote(sai_file),
             'bwa_args': quoted_bwa_args
         })
-        align_read2 = '{bwa} aln {is_illumina_fastq} {reference} {read2} -t {ncpu} -f {outfile1} {bwa_args}'.format(**{
-            'bwa': path,
-            'is_illumina_fastq': is_illumina_fastq,
-            'reference': shlex.quote(reference),
-            'read2': shlex.quote(read2),
-            'ncpu': shlex.quote(str(ncpu)),
-            'outfile1': shlex.quote(outfile1),
-            'bwa_args': quoted_bwa_args
+
+    if read2:
+        # The first read is aligned in the background and waited for once the second is done.
+        align_reads = '{{ {align_read1} & {align_read2} && wait $!; }}'.format(**{
+            'align_read1': aln_command(read1, sai_files[0], max(int(ncpu) // 2, 1)),
+            'align_read2': aln_command(read2, sai_files[1], max(int(ncpu) - int(ncpu) // 2, 1))
         })
         sampe_command = '{bwa} sampe -r {bam_string} {reference} {outfile1} {outfile2} {read1} {read2} {bwa_args}'.format(**{
-            'bwa': path,
+            'bwa': shlex.quote(path),
             'bam_string': shlex.quote(bam_string),
             'reference': shlex.quote(reference),
-            'outfile1': shlex.quote(outfile1),
-            'outfile2': shlex.quote(outfile2),
+            'outfile1': shlex.quote(sai_files[0]),
+            'outfile2': shlex.quote(sai_files[1]),
             'read1': shlex.quote(read1),
             'read2': shlex.quote(read2),
             'bwa_args': quoted_bwa_args
         })
-        aligner_command = '; '.join([align_read1, align_read2, sampe_command])
+        aligner_command = ' && '.join([align_reads, sampe_command])
     else:
-        outfile = os.path.join(output_folder, "%s.sai" % sample_name)
-        align_read = '{bwa} aln {is_illumina_fastq} {reference} {read1} -t {ncpu} -f {outfile} {bwa_args}'.format(**{
-            'bwa': path,
-            'is_illumina_fastq': is_illumina_fastq,
-            'reference': shlex.quote(reference),
-            'read1': shlex.quote(read1),
-            'ncpu': shlex.quote(str(ncpu)),
-            'outfile': shlex.quote(outfile),
-            'bwa_args': quoted_bwa_args
-        })
         samse_command = '{bwa} samse -r {bam_string} {reference} {outfile} {read1} {bwa_args}'.format(**{
-            'bwa': path,
+            'bwa': shlex.quote(path),
             'bam_string': shlex.quote(bam_string),
             'reference': shlex.quote(reference),
-            'outfile': shlex.quote(outfile),
+            'outfile': shlex.quote(sai_files[0]),
             'read1': shlex.quote(read1),
             'bwa_args': quoted_bwa_args
         })
-        aligner_command = '; '.join([align_read, samse_command])
+        aligner_command = ' && '.join([aln_command(read1, sai_files[0], ncpu), samse_command])
 
     return aligner_command
 
 
+def _get_bwa_sai_files(output_folder, sample_name, read2=None):
+    """ Returns the .sai files bwa aln writes for a sample, see _bwa_command. """
+    import os
+
+    if read2:
+        return [os.path.join(output_folder, 'bwa', "{0}-R{1}.sai".format(sample_name, read)) for read in (1, 2)]
+    return [os.path.join(output_folder, 'bwa', "{0}.sai".format(sample_name))]
+
+
 def _bowtie2_command(path, args, ncpu, reference, sample_name, read1, read2=None):
     """
     Args:
@@ -585,7 +1055,7 @@ def _samtools_command(path, args, ncpu, mem, output_folder, reference, bam):
     })
 
     
-def _run_gatk(nickname, bam_file, snpcaller, job_submitter, aligner_job_id, reference, output_folder):
+def _run_gatk(nickname, bam_file, snpcaller, configuration, aligner_job_id, reference, output_folder):
     import os
 
     (path, args, job_parms) = snpcaller[1:4]
@@ -599,13 +1069,17 @@ def _run_gatk(nickname, bam_file, snpcaller, job_submitter, aligner_job_id, refe
     command = "java -Xmx%sG -jar %s -T UnifiedGenotyper -dt NONE -glm BOTH -I %s -R %s -nt %s -o %s.vcf -out_mode EMIT_ALL_CONFIDENT_SITES -baq RECALCULATE %s" % (
         memory, path, bam_file, reference, ncpus, vcf_nickname, args)
     final_file = os.path.join(work_dir, "%s.vcf" % vcf_nickname)
+    command = _cache_stage(configuration, command, [bam_file, reference, path], [final_file])
+    if command is None:
+        return vcf_nickname, CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s_%s" % (snpcaller_name, nickname)
     job_parms['work_dir'] = work_dir
-    job_id = _submit_job(job_submitter, command, job_parms, (aligner_job_id,))
+    job_id = _submit_task(configuration["job_submitter"], "nasp_%s" % snpcaller_name, nickname, command, job_parms,
+                          (aligner_job_id,))
     return vcf_nickname, job_id, final_file
 
 
-def _run_solsnp(nickname, bam_file, snpcaller, job_submitter, aligner_job_id, reference, output_folder):
+def _run_solsnp(nickname, bam_file, snpcaller, configuration, aligner_job_id, reference, output_folder):
     import os
 
     (path, args, job_parms) = snpcaller[1:4]
@@ -617,16 +1091,21 @@ def _run_solsnp(nickname, bam_file, snpcaller, job_submitter, aligner_job_id, re
         os.makedirs(work_dir)
     final_file = os.path.join(work_dir, "%s.vcf" % vcf_nickname)
     bam_link = os.path.join(work_dir, os.path.splitext(os.path.basename(bam_file))[0])
-    os.symlink(bam_file, bam_link)
+    if not os.path.lexists(bam_link):
+        os.symlink(bam_file, bam_link)
     command = "java -Xmx%sG -jar %s INPUT=%s REFERENCE_SEQUENCE=%s OUTPUT=%s SUMMARY=true CALCULATE_ALLELIC_BALANCE=true MINIMUM_COVERAGE=1 PLOIDY=Haploid STRAND_MODE=None OUTPUT_FORMAT=VCF OUTPUT_MODE=AllCallable %s" % (
         memory, path, bam_link, reference, final_file, args)
+    command = _cache_stage(configuration, command, [bam_file, reference, path], [final_file])
+    if command is None:
+        return vcf_nickname, CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s_%s" % (snpcaller_name, nickname)
     job_parms['work_dir'] = work_dir
-    job_id = _submit_job(job_submitter, command, job_parms, (aligner_job_id,))
+    job_id = _submit_task(configuration["job_submitter"], "nasp_%s" % snpcaller_name, nickname, command, job_parms,
+                          (aligner_job_id,))
     return vcf_nickname, job_id, final_file
 
 
-def _run_varscan(nickname, bam_file, snpcaller, samtools, job_submitter, aligner_job_id, reference, output_folder):
+def _run_varscan(nickname, bam_file, snpcaller, samtools, configuration, aligner_job_id, reference, output_folder):
     import os
     import re
 
@@ -647,14 +1126,17 @@ def _run_varscan(nickname, bam_file, snpcaller, samtools, job_submitter, aligner
                      "%s mpileup -B -d 10000000 -f %s %s > %s" % (sampath, reference, bam_file, pileup_file),
                      "java -Xmx%sG -jar %s mpileup2cns %s --output-vcf 1 --vcf-sample-list %s > %s %s" % (
                          memory, path, pileup_file, sample_list, final_file, args)]
-    command = "\n".join(command_parts)
+    command = _cache_stage(configuration, "\n".join(command_parts), [bam_file, reference, path, sampath], [final_file])
+    if command is None:
+        return vcf_nickname, CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s_%s" % (snpcaller_name, nickname)
     job_parms['work_dir'] = work_dir
-    job_id = _submit_job(job_submitter, command, job_parms, (aligner_job_id,))
+    job_id = _submit_task(configuration["job_submitter"], "nasp_%s" % snpcaller_name, nickname, command, job_parms,
+                          (aligner_job_id,))
     return vcf_nickname, job_id, final_file
 
 
-def _run_samtools(nickname, bam_file, snpcaller, samtools, job_submitter, aligner_job_id, reference, output_folder):
+def _run_samtools(nickname, bam_file, snpcaller, samtools, configuration, aligner_job_id, reference, output_folder):
     import os
 
     (path, args, job_parms) = snpcaller[1:4]
@@ -667,10 +1149,13 @@ def _run_samtools(nickname, bam_file, snpcaller, samtools, job_submitter, aligne
     final_file = os.path.join(work_dir, "%s.vcf" % vcf_nickname)
     command_parts = ["%s mpileup -uD -d 10000000 -f %s %s" % (sampath, reference, bam_file),
                      "%s view -ceg %s - > %s" % (path, args, final_file)]
-    command = " | ".join(command_parts)
+    command = _cache_stage(configuration, " | ".join(command_parts), [bam_file, reference, path, sampath], [final_file])
+    if command is None:
+        return vcf_nickname, CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s_%s" % (snpcaller_name, nickname)
     job_parms['work_dir'] = work_dir
-    job_id = _submit_job(job_submitter, command, job_parms, (aligner_job_id,))
+    job_id = _submit_task(configuration["job_submitter"], "nasp_%s" % snpcaller_name, nickname, command, job_parms,
+                          (aligner_job_id,))
     return vcf_nickname, job_id, final_file
 
 
@@ -684,33 +1169,108 @@ def _find_dups(configuration, index_job_id, reference):
         # NOTE: This directory is implicitly created by _index_reference.
         os.makedirs(work_dir)
     final_file = os.path.join(work_dir, "duplicates.txt")
+    command = _cache_stage(configuration, command, [reference, path], [final_file])
+    if command is None:
+        return CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s" % name
     job_parms['work_dir'] = work_dir
     job_id = _submit_job(configuration["job_submitter"], command, job_parms, (index_job_id,))
     return job_id, final_file
 
 
-def _convert_external_genome(assembly, configuration, index_job_id, reference):
+def _get_external_genome_stage(assembly, configuration, reference):
+    """
+    Returns:
+        tuple: The command that converts the external genome on its own, the input files and tools of the stage, and
+        the frankenfasta it writes.
+    """
     import os
 
     (tool, path, args, job_parms) = configuration["assembly_importer"]
     (nucmer_path, nucmer_args) = configuration["dup_finder"][1:3]
     (name, fasta) = assembly
     work_dir = os.path.join(configuration["output_folder"], "external")
-    if not os.path.exists(work_dir):
-        os.makedirs(work_dir)
     new_fasta = os.path.join(work_dir, os.path.basename(fasta))
-    command_parts = ["format_fasta --inputfasta %s --outputfasta %s" % (fasta, new_fasta),
+    command_parts = ["format_fasta --inputfasta %s --outputfasta %s --index" % (fasta, new_fasta),
                      "convert_external_genome --nucmerpath %s --nucmerargs \'%s\' --deltafilterpath %s --deltafilterargs \'%s\' --reference %s --external %s --name %s" % (
                          nucmer_path, nucmer_args, path, args, reference, new_fasta, name)]
-    command = "\n".join(command_parts)
     final_file = os.path.join(work_dir, "%s.frankenfasta" % name)
+    return "\n".join(command_parts), [fasta, reference, nucmer_path, path], final_file
+
+
+def _convert_external_genome(assembly, configuration, index_job_id, reference):
+    import os
+
+    (tool, path, args, job_parms) = configuration["assembly_importer"]
+    name = assembly[0]
+    work_dir = os.path.join(configuration["output_folder"], "external")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    (command, input_files, final_file) = _get_external_genome_stage(assembly, configuration, reference)
+    command = _cache_stage(configuration, command, input_files, [final_file])
+    if command is None:
+        return CACHED_JOB_ID, final_file
     job_parms['name'] = "nasp_%s_%s" % (tool, name)
     job_parms['work_dir'] = work_dir
     job_id = _submit_job(configuration["job_submitter"], command, job_parms, (index_job_id,))
     return job_id, final_file
 
 
+def _convert_external_genomes(configuration, index_job_id, reference):
+    """
+    Converts all of the external genomes that are not up to date in one
+    job, which runs convert_external_genome on a manifest of them with a
+    worker per cpu, instead of a job per external genome.  Each external
+    genome is still its own stage for _cache_stage, with the same key as
+    when it is converted on its own, and its worker stamps it as soon as
+    it is converted, so one that fails does not undo the others.
+
+    Args:
+        configuration (dict): The run configuration.
+        index_job_id (str): The job that formats the reference.
+        reference (str): Path to the formatted reference fasta.
+
+    Returns:
+        tuple: The job id, or CACHED_JOB_ID if every external genome is up
+        to date, and the ( name, frankenfasta ) of each external genome.
+    """
+    import os
+
+    (tool, path, args, job_parms) = configuration["assembly_importer"]
+    (nucmer_path, nucmer_args) = configuration["dup_finder"][1:3]
+    franken_fastas = []
+    pending_assemblies = []
+    stage_stamps = []
+    for assembly in configuration["assemblies"]:
+        (command, input_files, final_file) = _get_external_genome_stage(assembly, configuration, reference)
+        franken_fastas.append((assembly[0], final_file))
+        stage_stamp = _get_stage_stamp(configuration, command, input_files, [final_file])
+        if stage_stamp is not None:
+            pending_assemblies.append(assembly)
+            stage_stamps.append(stage_stamp)
+    if not pending_assemblies:
+        return CACHED_JOB_ID, franken_fastas
+    if len(pending_assemblies) == 1:
+        (job_id, _) = _convert_external_genome(pending_assemblies[0], configuration, index_job_id, reference)
+        return job_id, franken_fastas
+    work_dir = os.path.join(configuration["output_folder"], "external")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    manifest = os.path.join(work_dir, "external_genomes.manifest")
+    with open(manifest, 'w') as manifest_handle:
+        for ((name, fasta), (stage_key, stamp_file)) in zip(pending_assemblies, stage_stamps):
+            if stamp_file is None:
+                manifest_handle.write("%s\t%s\n" % (name, fasta))
+            else:
+                manifest_handle.write("%s\t%s\t%s\t%s\n" % (name, fasta, stage_key, stamp_file))
+    command = "convert_external_genome --nucmerpath %s --nucmerargs \'%s\' --deltafilterpath %s --deltafilterargs \'%s\' --reference %s --manifest %s --numthreads %s" % (
+        nucmer_path, nucmer_args, path, args, reference, manifest, job_parms.get('num_cpus') or 1)
+    job_parms['name'] = "nasp_%s_batch" % tool
+    job_parms['work_dir'] = work_dir
+    job_id = _submit_job(configuration["job_submitter"], command, job_parms, (index_job_id,))
+    return job_id, franken_fastas
+
+
 # http://www.usadellab.org/cms/uploads/supplementary/Trimmomatic/TrimmomaticManual_V0.32.pdf
 def _trimmomatic_command(path, args, ncpu, output_folder, sample_name, read1, read2=None):
 
@@ -755,7 +1315,10 @@ def _trim_adapters(read_tuple, configuration):
     else:
         out_reads = [os.path.join(trim_dir, name+"_trimmed.fastq")]
         command = "java -jar %s SE -threads %s %s %s %s" % (path, job_parms['num_cpus'], read1, out_reads[0], args)
-    jobid = _submit_job(configuration["job_submitter"], command, job_parms)
+    command = _cache_stage(configuration, command, [read1, read2, path], out_reads)
+    if command is None:
+        return (tuple([name] + out_reads), CACHED_JOB_ID)
+    jobid = _submit_task(configuration["job_submitter"], "nasp_trim", name, command, job_parms)
     return (tuple([name] + out_reads), jobid)
 
 
@@ -771,40 +1334,47 @@ def _align_reads(read_tuple, configuration, index_job_id, reference):
     for aligner in map(App._make, configuration['aligners']):
         aligner_name = ''
         align_command = ''
+        plan = _plan_alignment(aligner.job_params)
+        temp_files = ()
 
         if re.search('bwa', aligner.name, re.IGNORECASE):
             if re.search('mem', aligner.name, re.IGNORECASE):
                 aligner_name = 'bwamem'
-                align_command = _bwamem_command(aligner.path, aligner.args, aligner.job_params['num_cpus'], reference, *read_tuple)
+                align_command = _bwamem_command(aligner.path, aligner.args, plan.aligner_cpus, reference, *read_tuple)
             else:
                 aligner_name = 'bwa'
-                align_command = _bwa_command(aligner.path, aligner.args, aligner.job_params['num_cpus'], reference, output_folder, *read_tuple)
+                align_command = _bwa_command(aligner.path, aligner.args, plan.aligner_cpus, reference, output_folder, *read_tuple)
+                temp_files = tuple(_get_bwa_sai_files(output_folder, read_tuple[0], read_tuple[2] if len(read_tuple) > 2 else None))
         elif re.search('b(ow)?t(ie)?2', aligner.name, re.IGNORECASE):
             aligner_name = 'bowtie2'
-            align_command = _bowtie2_command(aligner.path, aligner.args, aligner.job_params['num_cpus'], reference, *read_tuple)
+            align_command = _bowtie2_command(aligner.path, aligner.args, plan.aligner_cpus, reference, *read_tuple)
         elif re.search('novo', aligner.name, re.IGNORECASE):
             aligner_name = 'novo'
-            align_command = _novoalign_command(aligner.path, aligner.args, aligner.job_params['num_cpus'], reference, *read_tuple)
+            align_command = _novoalign_command(aligner.path, aligner.args, plan.aligner_cpus, reference, *read_tuple)
         elif re.search('snap', aligner.name, re.IGNORECASE):
             aligner_name = 'snap'
-            align_command = _snap_command(aligner.path, aligner.args, aligner.job_params['num_cpus'], reference, output_folder, *read_tuple)
+            align_command = _snap_command(aligner.path, aligner.args, plan.aligner_cpus, reference, output_folder, *read_tuple)
         else:
             print("Unknown aligner \'{0}\' found, don't know what to do. Skipping...".format(aligner.name))
             continue
 
-        output_bam = os.path.join(output_folder, aligner_name, '{sample}-{aligner}.bam'.format(sample=read_tuple[0], aligner=aligner_name))
-        
-        command = align_command + ' | ' + _samtools_view_sort_index_pipe_command(samtools_path, output_bam)
-
         work_dir = os.path.join(output_folder, aligner_name)
         if not os.path.exists(work_dir):
             os.makedirs(work_dir)
 
+        bam_prefix = "{sample}-{aligner}".format(sample=read_tuple[0], aligner=aligner_name)
         outfile = os.path.join(work_dir, "{bam_prefix}.bam".format(bam_prefix=bam_prefix))
+        command = _align_sort_index_command(align_command, samtools_path, outfile, plan, temp_files)
+        command = _cache_stage(configuration, command, list(read_tuple[1:]) + [reference, aligner.path, samtools_path],
+                               [outfile, outfile + ".bai"])
+        if command is None:
+            aligner_output.append((bam_prefix, CACHED_JOB_ID, outfile, aligner_name))
+            continue
         aligner.job_params['name'] = "nasp_{aligner}_{sample}".format(aligner=aligner_name, sample=read_tuple[0])
         aligner.job_params['work_dir'] = work_dir
 
-        job_id = _submit_job(job_submitter, align_command, aligner.job_params, (index_job_id,))
+        job_id = _submit_task(job_submitter, "nasp_{aligner}".format(aligner=aligner_name), read_tuple[0], command,
+                              aligner.job_params, (index_job_id,))
         if job_id:
             aligner_output.append((bam_prefix, job_id, outfile, aligner_name))
 
@@ -814,8 +1384,6 @@ def _align_reads(read_tuple, configuration, index_job_id, reference):
 def _call_snps(aligner_output, configuration, reference):
     import re
 
-    # TODO: skip task if the file exists and a --force flag was not used
-    # TODO: implement a GNU make style --force flag
     snpcaller_output = []
     for (nickname, aligner_job_id, bam_file, aligner_name) in aligner_output:
         if aligner_job_id:
@@ -823,27 +1391,27 @@ def _call_snps(aligner_output, configuration, reference):
                 name = snpcaller[0]
                 if re.search('gatk', name, re.IGNORECASE):
                     (vcf_nickname, job_id, final_file) = _run_gatk(nickname, bam_file, snpcaller,
-                                                                   configuration["job_submitter"], aligner_job_id,
+                                                                   configuration, aligner_job_id,
                                                                    reference, configuration["output_folder"])
                     if job_id:
                         snpcaller_output.append((vcf_nickname, job_id, final_file, aligner_name, name))
                 elif re.search('solsnp', name, re.IGNORECASE):
                     (vcf_nickname, job_id, final_file) = _run_solsnp(nickname, bam_file, snpcaller,
-                                                                     configuration["job_submitter"], aligner_job_id,
+                                                                     configuration, aligner_job_id,
                                                                      reference, configuration["output_folder"])
                     if job_id:
                         snpcaller_output.append((vcf_nickname, job_id, final_file, aligner_name, name))
                 elif re.search('varscan', name, re.IGNORECASE):
                     (vcf_nickname, job_id, final_file) = _run_varscan(nickname, bam_file, snpcaller,
                                                                       configuration["samtools"],
-                                                                      configuration["job_submitter"], aligner_job_id,
+                                                                      configuration, aligner_job_id,
                                                                       reference, configuration["output_folder"])
                     if job_id:
                         snpcaller_output.append((vcf_nickname, job_id, final_file, aligner_name, name))
                 elif re.search('samtools', name, re.IGNORECASE):
                     (vcf_nickname, job_id, final_file) = _run_samtools(nickname, bam_file, snpcaller,
                                                                        configuration["samtools"],
-                                                                       configuration["job_submitter"], aligner_job_id,
+                                                                       configuration, aligner_job_id,
                                                                        reference, configuration["output_folder"])
                     if job_id:
                         snpcaller_output.append((vcf_nickname, job_id, final_file, aligner_name, name))
@@ -916,6 +1484,14 @@ def _create_matrices(configuration, reference, dups_file, vcf_files, franken_fas
     matrix_DTO.write_dto(matrix_parms, franken_fastas, vcf_files, dto_file)
     jobs_to_wait_for = (":".join(job_ids), 'afterany') if job_ids else None
     command = "%s matrix --dto-file %s --num-threads %s" % (path, dto_file, job_parms['num_cpus'])
+    # The DTO file is written again every run, so the stage depends on what is in it instead.
+    command = _cache_stage(configuration, command,
+                           [reference, dups_file, path] + [input_file[-1] for input_file in franken_fastas + vcf_files],
+                           [os.path.join(matrix_parms['matrix-folder'], "{0}.tsv".format(exported_matrix)) for
+                            exported_matrix in ['bestsnp', 'missingdata']],
+                           [sorted(matrix_parms.items()), franken_fastas, vcf_files])
+    if command is None:
+        return CACHED_JOB_ID
     job_parms['work_dir'] = output_dir
     job_id = _submit_job(configuration["job_submitter"], command, job_parms, jobs_to_wait_for, notify=True)
     return job_id
@@ -946,6 +1522,9 @@ def _export_matrices(configuration, matrix_job_id):
 
 
 def begin(configuration):
+    _stage_keys.clear()
+    _local_executor.clear()
+    _job_arrays.clear()
     (index_job_id, reference) = _index_reference(configuration)
     if not index_job_id:
         print("Failed to submit the index job, there is no point in continuing. Please try again.")
@@ -958,21 +1537,21 @@ def begin(configuration):
         (job_id, dups_file) = _find_dups(configuration, index_job_id, reference)
         if job_id:
             job_ids.append(job_id)
-    for assembly in configuration["assemblies"]:
-        (job_id, final_file) = _convert_external_genome(assembly, configuration, index_job_id, reference)
+    if configuration["assemblies"]:
+        (job_id, final_files) = _convert_external_genomes(configuration, index_job_id, reference)
         if job_id:
             job_ids.append(job_id)
-            franken_fastas.append((assembly[0], "nucmer", final_file))
+            franken_fastas.extend((name, "nucmer", final_file) for (name, final_file) in final_files)
+    # The jobs for each sample are submitted in job arrays, one per stage, when there is a job manager.
+    if configuration["job_submitter"] in ("PBS", "SLURM", "SGE"):
+        _job_arrays.start(configuration["job_submitter"], os.path.join(configuration["output_folder"], "job_arrays"))
+    snpcaller_output = []
     if configuration["alignments"]:
         pre_aligned = []
         (bam_files) = _index_bams(configuration, index_job_id)
         for (name, bam, bamindex_job_id) in bam_files:
             pre_aligned.append((name, bamindex_job_id, bam, "pre-aligned"))
-        snpcaller_output = _call_snps(pre_aligned, configuration, reference)
-        for (vcf_nickname, job_id, final_file, aligner, snpcaller) in snpcaller_output:
-            if job_id:
-                job_ids.append(job_id)
-                vcf_files.append((vcf_nickname, aligner, snpcaller, final_file))
+        snpcaller_output.extend(_call_snps(pre_aligned, configuration, reference))
     for read_tuple in configuration["reads"]:
         dependent_job_id = None
         if "trim_reads" in configuration and configuration["trim_reads"] == "True":
@@ -981,17 +1560,25 @@ def begin(configuration):
         if dependent_job_id:
             dependencies += ":"+dependent_job_id
         aligner_output = _align_reads(read_tuple, configuration, dependencies, reference)
-        snpcaller_output = _call_snps(aligner_output, configuration, reference)
-        for (vcf_nickname, job_id, final_file, aligner, snpcaller) in snpcaller_output:
-            if job_id:
+        snpcaller_output.extend(_call_snps(aligner_output, configuration, reference))
+    _job_arrays.submit()
+    for (vcf_nickname, job_id, final_file, aligner, snpcaller) in snpcaller_output:
+        job_id = _job_arrays.get_job_id(job_id)
+        if job_id:
+            if job_id not in job_ids:
                 job_ids.append(job_id)
-                vcf_files.append((vcf_nickname, aligner, snpcaller, final_file))
+            vcf_files.append((vcf_nickname, aligner, snpcaller, final_file))
     for (name, vcf) in configuration["vcfs"]:
         vcf_files.append((name, "pre-aligned", "pre-called", vcf))
 
     matrix_job_id = _create_matrices(configuration, reference, dups_file, vcf_files, franken_fastas, job_ids)
     _export_matrices(configuration, matrix_job_id)
     _release_hold(configuration["job_submitter"], index_job_id)
+    if configuration["job_submitter"] not in ("PBS", "SLURM", "SGE"):
+        failed_jobs = _local_executor.run()
+        if failed_jobs:
+            print("%s jobs failed or were not run: %s" % (len(failed_jobs), ", ".join(failed_jobs)))
+            raise SystemExit(1)
 
 
 def main():
@@ -999,6 +1586,7 @@ def main():
 
     commandline_args = _parse_args()
     configuration = configuration_parser.parse_config(commandline_args.config)
+    configuration["force"] = str(commandline_args.force)
     begin(configuration)
 
 
@@ -28,46 +28,97 @@ def run_nucmer_on_reference(nucmer_path, reference_path):
             "NASP WARNING: nucmer may have encountered errors during reference duplicates checking, proceeding anyway\n")
 
 
-def _parse_delta_line(line_from_delta_file, dups_data, current_contigs):
-    import re
-
-    line_match = re.match(r'^>([^ ]+) ([^ ]+) (\d+) (\d+)\s*$', line_from_delta_file)
-    if line_match:
-        current_contigs = ( line_match.group(1), line_match.group(2) )
-        contig_0_end = int(line_match.group(3))
-        contig_1_end = int(line_match.group(4))
-        dups_data.add_contig(current_contigs[0])
-        dups_data.add_contig(current_contigs[1])
-        if contig_0_end > dups_data.get_contig_length(current_contigs[0]):
-            dups_data.extend_contig(contig_0_end, "0", current_contigs[0])
-        if contig_0_end > dups_data.get_contig_length(current_contigs[1]):
-            dups_data.extend_contig(contig_1_end, "0", current_contigs[1])
-    else:
-        line_match = re.match(r'^(\d+) (\d+) (\d+) (\d+) \d+ \d+ \d+\s*$', line_from_delta_file)
-        if line_match:
-            contig_0_start = int(line_match.group(1))
-            contig_0_end = int(line_match.group(2))
-            contig_1_start = int(line_match.group(3))
-            contig_1_end = int(line_match.group(4))
-            if ( current_contigs[0] != current_contigs[1] ) or (
-                ( contig_0_start != contig_1_start ) and ( contig_0_end != contig_1_end ) ):
-                if contig_0_end < contig_0_start:
-                    contig_0_end, contig_0_start = contig_0_start, contig_0_end
-                if contig_1_end < contig_1_start:
-                    contig_1_end, contig_1_start = contig_1_start, contig_1_end
-                dups_data.set_value(( "1" * ( contig_0_end - contig_0_start + 1 ) ), contig_0_start, "!",
-                                    current_contigs[0])
-                dups_data.set_value(( "1" * ( contig_1_end - contig_1_start + 1 ) ), contig_1_start, "!",
-                                    current_contigs[1])
+def _parse_delta_line(line_from_delta_file, contig_lengths, dup_intervals, current_contigs):
+    """
+    Records the contig lengths from a delta file header line, or the
+    intervals of both sides of an alignment line.  Every other line, like
+    the indel distances, is ignored.
+
+    Args:
+        line_from_delta_file (str): A line of the delta file.
+        contig_lengths (dict): The length of each contig by name, updated with the header lines.
+        dup_intervals (dict): The list of 1-indexed, inclusive ( start, end ) intervals of each contig by name,
+            updated with the alignment lines.
+        current_contigs (tuple): The contigs of the alignments since the last header line.
+
+    Returns:
+        tuple: The contigs of the alignments from this line on.
+    """
+    fields = line_from_delta_file.split()
+    if line_from_delta_file.startswith('>'):
+        if len(fields) == 4:
+            current_contigs = ( fields[0][1:], fields[1] )
+            for ( contig_name, contig_length ) in zip(current_contigs, map(int, fields[2:4])):
+                contig_lengths[contig_name] = max(contig_lengths.get(contig_name, 0), contig_length)
+                dup_intervals.setdefault(contig_name, [])
+    elif len(fields) == 7 and ''.join(fields).isdigit():
+        ( contig_0_start, contig_0_end, contig_1_start, contig_1_end ) = map(int, fields[0:4])
+        # Skip each contig's alignment to itself.
+        if ( current_contigs[0] != current_contigs[1] ) or (
+            ( contig_0_start != contig_1_start ) and ( contig_0_end != contig_1_end ) ):
+            dup_intervals[current_contigs[0]].append(( min(contig_0_start, contig_0_end), max(contig_0_start, contig_0_end) ))
+            dup_intervals[current_contigs[1]].append(( min(contig_1_start, contig_1_end), max(contig_1_start, contig_1_end) ))
     return current_contigs
 
 
-def parse_delta_file(delta_filename, dups_data):
+def merge_intervals(intervals):
+    """
+    Args:
+        intervals (list): 1-indexed, inclusive ( start, end ) intervals in any order.
+
+    Returns:
+        list: The sorted, non-overlapping intervals covering the same positions, with adjacent intervals joined.
+    """
+    merged_intervals = []
+    for ( start, end ) in sorted(intervals):
+        if merged_intervals and start <= merged_intervals[-1][1] + 1:
+            if end > merged_intervals[-1][1]:
+                merged_intervals[-1] = ( merged_intervals[-1][0], end )
+        else:
+            merged_intervals.append(( start, end ))
+    return merged_intervals
+
+
+def read_delta_intervals(delta_filename):
+    """
+    Args:
+        delta_filename (str): Path to the delta file of the reference aligned to itself.
+
+    Returns:
+        tuple: The length of each contig by name, and the merged duplicated intervals of each contig by name, see
+        merge_intervals.
+    """
+    contig_lengths = {}
+    dup_intervals = {}
     current_contigs = ( "", "" )
-    delta_handle = open(delta_filename, 'r')
-    for line_from_delta_file in delta_handle:
-        current_contigs = _parse_delta_line(line_from_delta_file, dups_data, current_contigs)
-    delta_handle.close()
+    with open(delta_filename, 'r') as delta_handle:
+        for line_from_delta_file in delta_handle:
+            current_contigs = _parse_delta_line(line_from_delta_file, contig_lengths, dup_intervals, current_contigs)
+    return contig_lengths, dict(( contig_name, merge_intervals(intervals) ) for ( contig_name, intervals ) in
+                                dup_intervals.items())
+
+
+def parse_delta_file(delta_filename, dups_data):
+    """
+    Marks each position of the reference in dups_data as duplicated or not.
+    The alignments are collected as intervals and merged first, so each
+    contig is built once as one byte per position.
+
+    Args:
+        delta_filename (str): Path to the delta file of the reference aligned to itself.
+        dups_data (GenomeStatus): Where to put the '0' and '1' of each position.
+    """
+    ( contig_lengths, dup_intervals ) = read_delta_intervals(delta_filename)
+    for ( contig_name, intervals ) in dup_intervals.items():
+        contig_mask = bytearray(b"0") * contig_lengths[contig_name]
+        for ( start, end ) in intervals:
+            if end > len(contig_mask):
+                # The positions up to an alignment past the end of the contig, which should not happen, are
+                # algorithmic failures.
+                contig_mask.extend(b"!" * ( end - len(contig_mask) ))
+            contig_mask[start - 1:end] = b"1" * ( end - start + 1 )
+        dups_data.add_contig(contig_name)
+        dups_data.append_contig(contig_mask.decode('latin-1'), contig_name)
 
 
 def main():
@@ -75,7 +126,7 @@ def main():
 
     commandline_args = _parse_args()
     run_nucmer_on_reference(commandline_args.nucmerpath, commandline_args.reference)
-    dups_data = GenomeStatus()
+    dups_data = GenomeStatus(compact=True)
     parse_delta_file("reference.delta", dups_data)
     dups_data.write_to_fasta_file("duplicates.txt")
 
@@ -6,6 +6,9 @@ __email__ = "dsmith@tgen.org"
 
 import logging
 
+# How much of the input fasta is read at once.
+_BLOCK_SIZE = 1 << 22
+
 
 def _parse_args():
     import argparse
@@ -14,21 +17,298 @@ def _parse_args():
         description="Reformats a fasta to be split 80 characters per line, with system line-endings.")
     parser.add_argument("--inputfasta", required=True, help="Path to input fasta.")
     parser.add_argument("--outputfasta", required=True, help="Path to output fasta.")
+    parser.add_argument("--index", action="store_true", help="Also write the samtools .fai index of the output fasta.")
     return parser.parse_args()
 
-def format_fasta(inputfasta, outputfasta):
-    from nasp.nasp_objects import Genome
-    fasta_data = Genome()
-    fasta_data.import_fasta_file(inputfasta)
-    fasta_data.write_to_fasta_file(outputfasta)
+
+class _FastaWriter(object):
+    """
+    Writes contigs a block of calls at a time, max_chars_per_line calls per
+    line, and keeps the .fai entry of each one as it goes.
+    """
+
+    def __init__(self, output_handle, max_chars_per_line=80):
+        """
+        Args:
+            output_handle (file): Binary handle to write the fasta to.
+            max_chars_per_line (int): Calls per line.
+
+        Attributes:
+            contig_entries (list): A ( name, length, offset, line bases, line bytes ) tuple per written contig.
+            _file_offset (int): The number of bytes written so far.
+            _contig_entry (list): The entry of the contig being written, or None.
+            _partial_line (bytes): The calls of the contig that do not fill a line yet.
+            _line_start (tuple): The file offset, contig length and partial line from before the first calls of an
+                unfinished input line, to go back to if the line turns out not to be calls, or None.
+        """
+        self._output_handle = output_handle
+        self._max_chars_per_line = max_chars_per_line
+        self.contig_entries = []
+        self._file_offset = 0
+        self._contig_entry = None
+        self._partial_line = b''
+        self._line_start = None
+
+    def _write(self, data):
+        self._output_handle.write(data)
+        self._file_offset += len(data)
+
+    def start_contig(self, contig_name):
+        """
+        Args:
+            contig_name (bytes): Unique contig description.
+        """
+        self.end_contig()
+        self._line_start = None
+        self._write(b'>' + contig_name + b'\n')
+        self._contig_entry = [contig_name.decode(), 0, self._file_offset]
+
+    def write_calls(self, calls):
+        """
+        Args:
+            calls (bytes): The next calls of the contig, without line breaks, which finish any unfinished input line.
+        """
+        self._line_start = None
+        self._write_calls(calls)
+
+    def write_partial_calls(self, calls):
+        """
+        Writes the calls of an input line that is not finished yet, which
+        discard_partial_calls can still take back.
+
+        Args:
+            calls (bytes): The next calls of the line.
+        """
+        if self._line_start is None:
+            self._line_start = ( self._file_offset, self._contig_entry[1], self._partial_line )
+        self._write_calls(calls)
+
+    def discard_partial_calls(self):
+        """ Takes back the calls of the unfinished input line, by truncating the output where the line started. """
+        if self._line_start is None:
+            return
+        ( self._file_offset, self._contig_entry[1], self._partial_line ) = self._line_start
+        self._line_start = None
+        self._output_handle.seek(self._file_offset)
+        self._output_handle.truncate()
+
+    def _write_calls(self, calls):
+        self._contig_entry[1] += len(calls)
+        calls = self._partial_line + calls
+        full_length = len(calls) - len(calls) % self._max_chars_per_line
+        if full_length > 0:
+            self._write(b'\n'.join(calls[line_start:line_start + self._max_chars_per_line] for line_start in
+                                   range(0, full_length, self._max_chars_per_line)) + b'\n')
+        self._partial_line = calls[full_length:]
+
+    def end_contig(self):
+        if self._contig_entry is None:
+            return
+        if self._partial_line:
+            self._write(self._partial_line + b'\n')
+            self._partial_line = b''
+        line_bases = min(self._contig_entry[1], self._max_chars_per_line)
+        self.contig_entries.append(tuple(self._contig_entry) + ( line_bases, line_bases + 1 if line_bases else 0 ))
+        self._contig_entry = None
+
+
+def _parse_fasta_lines(fasta_lines):
+    """
+    Reads whole lines of a fasta the way Genome._import_fasta_line does:
+    a contig name is the first word of a header line, and a line with
+    anything but calls and trailing whitespace on it is skipped.
+    Runs of lines that are all calls are checked and joined at once with a
+    translation table, and only the others are looked at a line at a time.
+
+    Args:
+        fasta_lines (bytes): Whole lines of the fasta.
+
+    Returns:
+        generator: A ( 'contig', name ) tuple for each header line and a
+        ( 'calls', calls ) tuple for each run of data lines, both as bytes.
+    """
+    import re
+    from nasp.nasp_objects import FastaIndex
+
+    line_start = 0
+    while line_start < len(fasta_lines):
+        if fasta_lines[line_start:line_start + 1] == b'>':
+            line_end = fasta_lines.find(b'\n', line_start) + 1 or len(fasta_lines)
+        else:
+            line_end = fasta_lines.find(b'\n>', line_start) + 1 or len(fasta_lines)
+            calls = fasta_lines[line_start:line_end].translate(None, b'\r\n')
+            if not calls.translate(None, FastaIndex.CALL_CHARACTERS):
+                if calls:
+                    yield 'calls', calls
+                line_start = line_end
+                continue
+        # Lone carriage returns end lines too, as the line-by-line import reads the fasta as text.
+        for line_from_fasta in fasta_lines[line_start:line_end].replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(
+                b'\n'):
+            contig_match = re.match(br'^>([^\s]+)', line_from_fasta)
+            if contig_match:
+                yield 'contig', contig_match.group(1)
+            else:
+                calls = line_from_fasta.rstrip()
+                if calls and not calls.translate(None, FastaIndex.CALL_CHARACTERS):
+                    yield 'calls', calls
+        line_start = line_end
+
+
+def _read_fasta(fasta_filename):
+    """
+    Reads the fasta a block at a time.  A data line that goes on past the
+    end of a block is not held back until it ends: its calls so far are
+    given as 'partial' at once, and if it turns out not to be calls after
+    all, a 'discard' takes them back.
+
+    Returns:
+        generator: The _parse_fasta_lines of the whole fasta file, with
+        ( 'partial', calls ) and ( 'discard', None ) tuples for the data
+        lines that span blocks.  The calls of such a line that are left
+        when it ends are given as 'calls', even if there are none.
+    """
+    from nasp.nasp_objects import FastaIndex, open_input_file
+
+    def read_line_calls(line_calls, is_line_end):
+        # The calls of a line are valid if all but its trailing whitespace are calls, so trailing whitespace is held
+        # back until it is known to be trailing.
+        calls = line_calls.rstrip()
+        if calls.translate(None, FastaIndex.CALL_CHARACTERS):
+            return ( 'discard', None ), None
+        if is_line_end:
+            return ( 'calls', calls ), None
+        return ( 'partial', calls ), line_calls[len(calls):]
+
+    with open_input_file(fasta_filename, 'rb') as fasta_handle:
+        partial_line = b''
+        # Whether the last block ended in a data line, which is 'calls' until it is found not to be, then 'skip'.
+        line_state = None
+        line_whitespace = b''
+        fasta_block = True
+        while fasta_block:
+            fasta_block = fasta_handle.read(_BLOCK_SIZE)
+            fasta_lines = partial_line + fasta_block
+            partial_line = b''
+            if line_state is not None:
+                line_end = min(line_end for line_end in ( fasta_lines.find(b'\n'), fasta_lines.find(b'\r'),
+                                                          len(fasta_lines) ) if line_end >= 0)
+                is_line_end = line_end < len(fasta_lines) or not fasta_block
+                if line_state == 'calls':
+                    ( parsed_value, line_whitespace ) = read_line_calls(line_whitespace + fasta_lines[:line_end],
+                                                                        is_line_end)
+                    if parsed_value[0] == 'discard':
+                        line_state = 'skip'
+                    if parsed_value[0] != 'partial' or parsed_value[1]:
+                        yield parsed_value
+                if is_line_end:
+                    line_state = None
+                fasta_lines = fasta_lines[line_end + 1:]
+            if line_state is None:
+                if fasta_block:
+                    lines_end = max(fasta_lines.rfind(b'\n'), fasta_lines.rfind(b'\r')) + 1
+                    ( fasta_lines, partial_line ) = ( fasta_lines[:lines_end], fasta_lines[lines_end:] )
+                for parsed_value in _parse_fasta_lines(fasta_lines):
+                    yield parsed_value
+                # Header lines are short, and are kept whole.
+                if partial_line and not partial_line.startswith(b'>'):
+                    ( parsed_value, line_whitespace ) = read_line_calls(partial_line, False)
+                    partial_line = b''
+                    line_state = 'skip' if parsed_value[0] == 'discard' else 'calls'
+                    if parsed_value[0] == 'partial' and parsed_value[1]:
+                        yield parsed_value
+
+
+def _copy_contig_calls(fasta_handle, contig_entry, fasta_writer):
+    """
+    Copies the calls of a contig that a _FastaWriter wrote, a block at a time.
+
+    Args:
+        fasta_handle (file): Binary handle of the fasta the contig is in.
+        contig_entry (tuple): The ( name, length, offset, line bases, line bytes ) of the contig.
+        fasta_writer (_FastaWriter): Where to write the calls.
+    """
+    ( _, contig_length, contig_offset, line_bases, _ ) = contig_entry
+    if contig_length == 0:
+        return
+    remaining_bytes = contig_length + ( contig_length + line_bases - 1 ) // line_bases
+    fasta_handle.seek(contig_offset)
+    while remaining_bytes > 0:
+        fasta_block = fasta_handle.read(min(_BLOCK_SIZE, remaining_bytes))
+        if not fasta_block:
+            break
+        remaining_bytes -= len(fasta_block)
+        fasta_writer.write_calls(fasta_block.translate(None, b'\n'))
+
+
+def format_fasta(inputfasta, outputfasta, write_index=False, max_chars_per_line=80):
+    """
+    Rewrites a fasta, which may be gzip or BGZF compressed, with its
+    contigs sorted by name and max_chars_per_line calls per line, as
+    Genome.write_to_fasta_file would write it once read in, without ever
+    holding more than a block of it in memory.  The contigs are written in
+    the order they are read, and only when they are out of order, or share
+    a name and so are joined, is the output rewritten in order.
+
+    Args:
+        inputfasta (str): Path to input fasta.
+        outputfasta (str): Path to output fasta.
+        write_index (bool): Also write the samtools .fai index of the output fasta.
+        max_chars_per_line (int): Calls per line.
+
+    Raises:
+        MalformedInputFile: If there are calls before the first contig name.
+    """
+    import os
+    import tempfile
+    from nasp.nasp_objects import FastaIndex, MalformedInputFile
+
+    with open(outputfasta, 'wb') as output_handle:
+        fasta_writer = _FastaWriter(output_handle, max_chars_per_line)
+        is_started = False
+        for ( value_type, parsed_value ) in _read_fasta(inputfasta):
+            if value_type == 'contig':
+                fasta_writer.start_contig(parsed_value)
+                is_started = True
+            elif value_type == 'discard':
+                if is_started:
+                    fasta_writer.discard_partial_calls()
+            elif not is_started:
+                if parsed_value:
+                    raise MalformedInputFile(inputfasta, "Found calls before the first contig name")
+            elif value_type == 'partial':
+                fasta_writer.write_partial_calls(parsed_value)
+            else:
+                fasta_writer.write_calls(parsed_value)
+        fasta_writer.end_contig()
+    contig_names = [contig_entry[0] for contig_entry in fasta_writer.contig_entries]
+    if contig_names != sorted(set(contig_names)):
+        contig_entries = {}
+        for contig_entry in fasta_writer.contig_entries:
+            contig_entries.setdefault(contig_entry[0], []).append(contig_entry)
+        ( temporary_handle, temporary_filename ) = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(outputfasta)))
+        os.close(temporary_handle)
+        try:
+            os.replace(outputfasta, temporary_filename)
+            with open(temporary_filename, 'rb') as unsorted_handle, open(outputfasta, 'wb') as output_handle:
+                fasta_writer = _FastaWriter(output_handle, max_chars_per_line)
+                for contig_name in sorted(contig_entries):
+                    fasta_writer.start_contig(contig_name.encode())
+                    for contig_entry in contig_entries[contig_name]:
+                        _copy_contig_calls(unsorted_handle, contig_entry, fasta_writer)
+                fasta_writer.end_contig()
+        finally:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+    if write_index:
+        FastaIndex(outputfasta, fasta_writer.contig_entries).save()
 
 
 def main():
     commandline_args = _parse_args()
-    format_fasta(commandline_args.inputfasta, commandline_args.outputfasta)
+    format_fasta(commandline_args.inputfasta, commandline_args.outputfasta, commandline_args.index)
 
 
 if __name__ == "__main__":
     main()
-
-
@@ -50,6 +50,8 @@ def _parse_args():
     parser.add_argument("reference_fasta", nargs="?", default="", help="Path to the reference fasta.")
     parser.add_argument("output_folder", nargs="?", default="", help="Folder to store the output files.")
     parser.add_argument("--config", help="Path to the configuration xml file.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rerun every stage, even those whose outputs from an earlier run are up to date.")
     return parser.parse_args()
 
 
@@ -608,6 +610,7 @@ def main():
     else:
         configuration = _get_user_input(commandline_args.reference_fasta, commandline_args.output_folder)
     configuration_parser.write_config(configuration)
+    configuration["force"] = str(commandline_args.force)
     dispatcher.begin(configuration)
 
 
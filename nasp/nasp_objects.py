@@ -4,6 +4,7 @@ __author__ = "David Smith"
 __version__ = "1.0.0"
 __email__ = "dsmith@tgen.org"
 
+import io
 import logging
 
 
@@ -18,6 +19,14 @@ class GenomeStatus(object):
     lists for performance and flexibility.
     Whether single characters, numbers, boolean values, or a mixture of data
     types are used does not seem to affect memory and performance.
+    That is, until you have hundreds of genomes loaded at once, at which
+    point the eight-byte list pointer per position is what dominates.  For
+    that case there is a compact mode that stores each contig as a bytearray
+    with one byte per position instead.  Compact mode only holds strings;
+    values that are not exactly one character long (insertions and
+    deletions) are kept in a side table, and are represented in the
+    bytearray by their first character, or '.' if empty, so that anything
+    only looking at the first character of a call can ignore the side table.
     Storing lists per-contig-position with this class is a complicated
     affair, as several of the manipulation functions assume you mean to
     manipulate a continuous range of positions instead of a single position
@@ -50,18 +59,27 @@ class GenomeStatus(object):
     """
 
     # Arrays are zero-indexed, genome positions are one-indexed. Off-by-one errors? Never heard of 'em.
-    def __init__(self):
+    def __init__(self, compact=False):
         """
+        Args:
+            compact (bool): Store contigs as bytearrays instead of lists.
+
         Attributes:
             _status_data: The dictionary of lists that stores the actual genome.
             data. The keys of the dictionary are the contig names.  The lists
             correspond to the position data on that contig.  Genome position is
-            list position + 1.
+            list position + 1.  In compact mode, the lists are bytearrays.
             _current_contig: Tracks the most recently-referenced contig, for
             convenience EG reading in fastas line-by-line.
+            _compact: Whether the contigs are stored as bytearrays.
+            _indel_values: Compact mode side table for values that are not
+            one character long.  A dictionary of dictionaries, keyed by contig
+            name and then by list position.
         """
         self._status_data = {}
         self._current_contig = None
+        self._compact = compact
+        self._indel_values = {}
 
     # NOTE(jtravis): Does not raise exception if contig name is None or the empty string as documented
     def add_contig(self, contig_name):
@@ -79,9 +97,16 @@ class GenomeStatus(object):
             InvalidContigName: If contig_name is undefined.
         """
         if contig_name not in self._status_data:
-            self._status_data[contig_name] = []
+            self._status_data[contig_name] = self._new_contig_data()
         self._current_contig = contig_name
 
+    def _new_contig_data(self):
+        """
+        Returns:
+            list or bytearray: Empty storage for a new contig.
+        """
+        return bytearray() if self._compact else []
+
     # NOTE(jtravis): unused parameter create_contig
     def set_current_contig(self, contig_name, create_contig=True):
         """
@@ -130,7 +155,62 @@ class GenomeStatus(object):
             contig_name (str): Unique contig description.
         """
         contig_name = self.set_current_contig(contig_name)
-        self._status_data[contig_name].extend(genome_data)
+        if self._compact:
+            self._set_compact_values(contig_name, len(self._status_data[contig_name]), genome_data)
+        else:
+            self._status_data[contig_name].extend(genome_data)
+
+    @staticmethod
+    def _encode_compact(genome_data):
+        """
+        Converts a string or list of per-position values to one byte per
+        position.
+
+        Args:
+            genome_data (str or list): Per-position values.
+
+        Returns:
+            tuple: The encoded bytes, and a dictionary of the values that are
+            not exactly one character long, keyed by their offset.
+        """
+        if isinstance(genome_data, str):
+            return genome_data.encode('latin-1'), {}
+        if set(map(len, genome_data)) <= {1}:
+            return ''.join(genome_data).encode('latin-1'), {}
+        encoded = bytearray(len(genome_data))
+        indel_values = {}
+        for offset, value in enumerate(genome_data):
+            if len(value) != 1:
+                indel_values[offset] = value
+                value = value[:1] or '.'
+            encoded[offset] = ord(value)
+        return encoded, indel_values
+
+    def _set_compact_values(self, contig_name, list_index, genome_data):
+        """
+        Writes the values over the compact contig starting at list_index,
+        extending the contig if they run off the end of it, and keeps the
+        insertion/deletion side table in sync.
+
+        Args:
+            contig_name (str): Unique contig description.
+            list_index (int): 0-indexed position to start writing at.
+            genome_data (str or list): Per-position values.
+        """
+        encoded, indel_values = self._encode_compact(genome_data)
+        contig_indels = self._indel_values.get(contig_name)
+        if contig_indels:
+            if len(encoded) == 1:
+                contig_indels.pop(list_index, None)
+            else:
+                for stale_index in [index for index in contig_indels if
+                                    list_index <= index < list_index + len(encoded)]:
+                    del contig_indels[stale_index]
+        self._status_data[contig_name][list_index:list_index + len(encoded)] = encoded
+        if indel_values:
+            contig_indels = self._indel_values.setdefault(contig_name, {})
+            for offset, value in indel_values.items():
+                contig_indels[list_index + offset] = value
 
     def extend_contig(self, new_length, missing_range_filler, contig_name=None):
         """
@@ -143,8 +223,13 @@ class GenomeStatus(object):
         """
         contig_name = self.set_current_contig(contig_name)
         if len(self._status_data[contig_name]) < new_length:
-            self._status_data[contig_name].extend(
-                [missing_range_filler] * ( new_length - len(self._status_data[contig_name]) ))
+            if self._compact:
+                missing_range = missing_range_filler if len(missing_range_filler) == 1 else [missing_range_filler]
+                self._set_compact_values(contig_name, len(self._status_data[contig_name]),
+                                         missing_range * ( new_length - len(self._status_data[contig_name]) ))
+            else:
+                self._status_data[contig_name].extend(
+                    [missing_range_filler] * ( new_length - len(self._status_data[contig_name]) ))
 
     def set_value(self, new_data, position_number, missing_range_filler="!", contig_name=None):
         """
@@ -162,7 +247,10 @@ class GenomeStatus(object):
         """
         contig_name = self.set_current_contig(contig_name)
         self.extend_contig(position_number, missing_range_filler, contig_name)
-        if len(new_data) > 1:
+        if self._compact:
+            # An empty string is a deletion at one position, not an empty range.
+            self._set_compact_values(contig_name, position_number - 1, new_data if new_data != '' else [new_data])
+        elif len(new_data) > 1:
             self._status_data[contig_name][position_number - 1:position_number - 1 + len(new_data)] = new_data
         else:
             self._status_data[contig_name][position_number - 1] = new_data
@@ -184,16 +272,65 @@ class GenomeStatus(object):
         if last_position is None:
             if first_position <= len(self._status_data[contig_name]):
                 queried_value = self._status_data[contig_name][first_position - 1]
+                if self._compact:
+                    contig_indels = self._indel_values.get(contig_name)
+                    if contig_indels and ( first_position - 1 ) in contig_indels:
+                        queried_value = contig_indels[first_position - 1]
+                    else:
+                        queried_value = chr(queried_value)
         else:
             queried_value = []
             if last_position == -1:
                 last_position = len(self._status_data[contig_name])
             if last_position >= first_position and first_position <= len(self._status_data[contig_name]):
                 queried_value = self._status_data[contig_name][first_position - 1:last_position]
+                if self._compact:
+                    queried_value = list(queried_value.decode('latin-1'))
+                    contig_indels = self._indel_values.get(contig_name)
+                    if contig_indels:
+                        for index, value in contig_indels.items():
+                            if first_position - 1 <= index < last_position:
+                                queried_value[index - first_position + 1] = value
                 if filler_value is not None and len(queried_value) < last_position - first_position + 1:
                     queried_value.extend([filler_value] * ( last_position - first_position + 1 - len(queried_value) ))
         return queried_value
 
+    def get_value_bytes(self, first_position, last_position, contig_name=None, filler_value="X"):
+        """
+        The whole-range version of get_value, for when a range is needed for
+        many genomes at once and creating a string per position costs too
+        much.  In compact mode this is a copy of the stored bytes.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+            filler_value (str): Single character filler for undefined regions beyond the genome data.
+
+        Returns:
+            tuple: The values from first_position to last_position as bytes,
+            one character per position, and a dictionary keyed by 0-indexed
+            offset from first_position of the values whose character in the
+            bytes is not the value itself, like insertions and deletions.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        contig_data = self._status_data[contig_name]
+        if self._compact:
+            values = bytes(contig_data[first_position - 1:last_position])
+            other_values = {}
+            contig_indels = self._indel_values.get(contig_name)
+            if contig_indels:
+                for index, value in contig_indels.items():
+                    if first_position - 1 <= index < last_position:
+                        other_values[index - first_position + 1] = value
+        else:
+            values, other_values = self._encode_compact(contig_data[first_position - 1:last_position])
+            values = bytes(values)
+        missing_length = last_position - first_position + 1 - len(values)
+        if missing_length > 0:
+            values += filler_value.encode('latin-1') * missing_length
+        return values, other_values
+
     def get_contig_length(self, contig_name=None):
         """
         Args:
@@ -221,14 +358,22 @@ class GenomeStatus(object):
         """
         for current_contig in self.get_contigs():
             output_handle.write(">" + contig_prefix + current_contig + "\n")
+            contig_data = self._status_data[current_contig]
+            if self._compact:
+                # Without insertions there is one character per position, so the
+                # contig can be decoded once and sliced into lines as a string.
+                if self._indel_values.get(current_contig):
+                    contig_data = self.get_value(1, -1, current_contig)
+                else:
+                    contig_data = contig_data.decode('latin-1')
             if max_chars_per_line > 0:
                 i = 0
-                while ( max_chars_per_line * i ) < len(self._status_data[current_contig]):
-                    output_handle.write(''.join(self._status_data[current_contig][
+                while ( max_chars_per_line * i ) < len(contig_data):
+                    output_handle.write(''.join(contig_data[
                                                 ( max_chars_per_line * i ):( max_chars_per_line * ( i + 1 ) )]) + "\n")
                     i += 1
             else:
-                output_handle.write(''.join(self._status_data[current_contig]) + "\n")
+                output_handle.write(''.join(contig_data) + "\n")
 
     def write_to_fasta_file(self, output_filename, contig_prefix="", max_chars_per_line=80):
         """
@@ -249,16 +394,51 @@ class Genome(GenomeStatus):
     """
     A special type of GenomeStatus where the genome information being stored
     is always actual base calls, as strings.
+    Because the data is known to be base calls, a genome can also be stored
+    in packed mode, which is compact mode with each contig held in a
+    PackedCalls at half a byte per position.  Calls that have no 4-bit code
+    are escaped to the compact mode side table.
     """
 
-    def __init__(self):
+    # Characters to their simple_call, for calls stored one character per position.
+    SIMPLE_CALL_TABLE = bytes(b'ACGTTACGTT'[b'ACGTUacgtu'.index(character)] if character in b'ACGTUacgtu' else
+                              ord('N') for character in range(256))
+
+    def __init__(self, compact=False, packed=False):
         """
+        Args:
+            compact (bool): Store contigs as bytearrays instead of lists.
+            packed (bool): Store contigs as 4-bit codes, implies compact.
+
         Attributes:
             _genome is an alias of _status_data, provided for code clarity
             when working with an actual genome
+            _packed: Whether the contigs are stored as PackedCalls.
         """
-        GenomeStatus.__init__(self)
+        GenomeStatus.__init__(self, compact or packed)
         self._genome = self._status_data
+        self._packed = packed
+
+    def _new_contig_data(self):
+        if self._packed:
+            return PackedCalls()
+        return GenomeStatus._new_contig_data(self)
+
+    def _encode_compact(self, genome_data):
+        """
+        In packed mode, calls outside of the PackedCalls alphabet, like
+        lowercase or three-base degeneracies, are escaped to the side table
+        and stored as the code of their simple call instead.
+        """
+        encoded, indel_values = GenomeStatus._encode_compact(genome_data)
+        if self._packed:
+            representatives = encoded.translate(PackedCalls.REPRESENTATIVE_TABLE)
+            if representatives != encoded:
+                for offset, character in enumerate(encoded):
+                    if representatives[offset] != character and offset not in indel_values:
+                        indel_values[offset] = chr(character)
+                encoded = representatives
+        return encoded, indel_values
 
     def set_call(self, new_data, first_position, missing_range_filler="X", contig_name=None):
         """ Alias of set_value, for code clarity """
@@ -290,19 +470,75 @@ class Genome(GenomeStatus):
             # Parse the contig sequence discarding trailing whitespace characters
             data_match = re.match(r'^([A-Za-z.-]+)\s*$', line_from_fasta)
             if data_match:
-                self.append_contig(list(data_match.group(1)))
+                self.append_contig(data_match.group(1))
 
     # contig_prefix is used by vcf_to_matrix to discard the frankenfasta contig name prefix.
-    def import_fasta_file(self, fasta_filename, contig_prefix=""):
-        """ Read in a fasta file.
+    def import_fasta_file(self, fasta_filename, contig_prefix="", num_threads=1, contig_names=None, use_mmap=False):
+        """ Read in a fasta file, which may be gzip or BGZF compressed.
+        An uncompressed file that samtools could index is read a contig at a
+        time through its FastaIndex, which is built and saved as a .fai
+        beside it if it has none; anything else is read a line at a time.
 
         Args:
             fasta_filename (str): fasta file to import
             contig_prefix (str): the prefix will be removed from the parsed contig names
+            num_threads (int): threads that may decompress a BGZF file
+            contig_names (list): only read in these contigs, if given
+            use_mmap (bool): memory-map an indexed file rather than reading it
         """
-        with open(fasta_filename, 'r') as fasta_handle:
+        import re
+
+        fasta_index = FastaIndex.load(fasta_filename, contig_prefix)
+        if fasta_index is not None:
+            with fasta_index.open(use_mmap):
+                for contig_name in fasta_index.get_contigs():
+                    if contig_names is None or contig_name in contig_names:
+                        self.add_contig(contig_name)
+                        self.append_contig(fasta_index.get_calls(contig_name), contig_name)
+            return
+        is_skipped = False
+        with open_input_file(fasta_filename, 'r', num_threads) as fasta_handle:
             for line_from_fasta in fasta_handle:
-                self._import_fasta_line(line_from_fasta, contig_prefix)
+                if contig_names is not None and line_from_fasta[0:1] == '>':
+                    contig_match = re.match(r'^>' + re.escape(contig_prefix) + r'([^\s]+)(?:\s|$)', line_from_fasta)
+                    if contig_match:
+                        is_skipped = contig_match.group(1) not in contig_names
+                if not is_skipped:
+                    self._import_fasta_line(line_from_fasta, contig_prefix)
+
+    @staticmethod
+    def index_fasta_file(fasta_filename, contig_prefix=""):
+        """
+        Finds where the data of each contig starts in a fasta file, so that
+        a contig can be read on its own without reading in the whole file.
+
+        Args:
+            fasta_filename (str): fasta file to index
+            contig_prefix (str): the prefix will be removed from the parsed contig names
+
+        Returns:
+            dict: Contig names to the byte offset of the line after their header, in the decompressed data
+                of a compressed file.
+
+        Raises:
+            MalformedInputFile: If a contig appears more than once.
+        """
+        import re
+
+        contig_offsets = {}
+        file_offset = 0
+        with open_input_file(fasta_filename, 'rb') as fasta_handle:
+            for line_from_fasta in fasta_handle:
+                file_offset += len(line_from_fasta)
+                contig_match = re.match(br'^>' + re.escape(contig_prefix.encode()) + br'([^\s]+)(?:\s|$)',
+                                        line_from_fasta)
+                if contig_match:
+                    contig_name = contig_match.group(1).decode()
+                    if contig_name in contig_offsets:
+                        raise MalformedInputFile(fasta_filename, "contig '{0}' appears more than once".format(
+                            contig_name))
+                    contig_offsets[contig_name] = file_offset
+        return contig_offsets
 
     @staticmethod
     def reverse_complement(dna_string):
@@ -346,6 +582,209 @@ class Genome(GenomeStatus):
             simple_base = 'N'
         return simple_base
 
+    @staticmethod
+    def simple_call_packed(packed_calls, allow_x=False, allow_del=False):
+        """
+        The equivalent of simple_call for every position of a PackedCalls at
+        once, done with a lookup table over whole bytes, two positions at a
+        time.  Escaped calls are simplified from their stored code, which is
+        already the code of their simple call.
+
+        Args:
+            packed_calls (PackedCalls): calls to standardize
+            allow_x (bool):
+            allow_del (bool):
+
+        Returns:
+            PackedCalls: 'A', 'C', 'G', 'T', or 'N' with optional 'X' and '.'
+        """
+        return PackedCalls.from_packed(
+            packed_calls.packed_bytes().translate(PackedCalls.SIMPLE_CALL_TABLES[( allow_x, allow_del )]),
+            len(packed_calls))
+
+    @staticmethod
+    def reverse_complement_packed(packed_calls):
+        """
+        The equivalent of reverse_complement for a PackedCalls.  Each byte is
+        complemented and has its two positions swapped in one table lookup,
+        then the byte order is reversed.
+
+        Args:
+            packed_calls (PackedCalls): calls to reverse complement
+
+        Returns:
+            PackedCalls: reverse complement
+        """
+        reversed_bytes = packed_calls.packed_bytes().translate(PackedCalls.REVERSE_COMPLEMENT_TABLE)[::-1]
+        if len(packed_calls) % 2:
+            # The unused half of the last byte is now at the front, so shift everything down by half a byte.
+            reversed_bytes = ( int.from_bytes(reversed_bytes, 'little') >> 4 ).to_bytes(len(reversed_bytes), 'little')
+        return PackedCalls.from_packed(reversed_bytes, len(packed_calls))
+
+
+_PACKED_ALPHABET = b'XACGTN.RYSWKMU!-'
+
+
+def _build_packed_pair_table(call_map):
+    """
+    Args:
+        call_map (function): Maps a call in the packed alphabet to another.
+
+    Returns:
+        bytes: Translation table applying call_map to both positions of every possible packed byte.
+    """
+    code_map = [_PACKED_ALPHABET.find(call_map(chr(code)).encode()) for code in _PACKED_ALPHABET]
+    return bytes(code_map[packed_byte & 15] | ( code_map[packed_byte >> 4] << 4 ) for packed_byte in range(256))
+
+
+class PackedCalls(object):
+    """
+    Storage for one contig of a packed Genome: base calls as 4-bit codes,
+    two positions per byte, the first in the low half.  It reads and writes
+    calls as bytes of characters, just like the bytearray of a compact
+    contig, so GenomeStatus does not need to know the difference.
+    Only the characters in ALPHABET have a code; Genome escapes everything
+    else to its side table before it gets here.  The four three-base
+    degeneracies, lowercase calls, and indels are all rare enough that
+    giving up their codes to fit X, '.', and the two-base degeneracies in
+    is worth it.
+    """
+
+    ALPHABET = _PACKED_ALPHABET
+
+    # Characters to codes and back, one byte per position.
+    ENCODE_TABLE = bytes(_PACKED_ALPHABET.find(character) if character in _PACKED_ALPHABET else
+                         _PACKED_ALPHABET.find(b'N') for character in range(256))
+    DECODE_TABLE = _PACKED_ALPHABET + bytes(256 - len(_PACKED_ALPHABET))
+
+    # The character each call is stored as: itself, or its simple call if it has no code.
+    REPRESENTATIVE_TABLE = bytes(character if character in _PACKED_ALPHABET else
+                                 bytes([character]).upper()[0] if bytes([character]).upper() in b'XACGTNRYSWKMU' else
+                                 ord('N') for character in range(256))
+
+    # Splitting bytes into, and building bytes out of, their two positions.
+    LOW_CODE_TABLE = bytes(packed_byte & 15 for packed_byte in range(256))
+    HIGH_CODE_TABLE = bytes(packed_byte >> 4 for packed_byte in range(256))
+    SHIFT_CODE_TABLE = bytes(( packed_byte & 15 ) << 4 for packed_byte in range(256))
+
+    # Whole-byte versions of Genome.simple_call, keyed by (allow_x, allow_del).
+    SIMPLE_CALL_TABLES = {
+        ( allow_x, allow_del ): _build_packed_pair_table(
+            lambda call: call if call in 'ACGT' or ( allow_x and call == 'X' ) or ( allow_del and call == '.' ) else
+            'T' if call == 'U' else 'N')
+        for allow_x in ( False, True ) for allow_del in ( False, True )
+    }
+
+    # Complements both positions and swaps them, to be followed by reversing the bytes.
+    REVERSE_COMPLEMENT_TABLE = bytes(( pair_byte >> 4 ) | ( ( pair_byte & 15 ) << 4 ) for pair_byte in
+                                     _build_packed_pair_table(lambda call: {
+                                         'A': 'T', 'T': 'A', 'U': 'A', 'C': 'G', 'G': 'C',
+                                         'R': 'Y', 'Y': 'R', 'K': 'M', 'M': 'K'}.get(call, call)))
+
+    def __init__(self, calls=b''):
+        """
+        Args:
+            calls (bytes): Optional initial calls, one character per position.
+
+        Attributes:
+            _packed_data (bytearray): The codes, two per byte.
+            _length (int): Number of positions, as the last byte may be half used.
+        """
+        self._packed_data = bytearray()
+        self._length = 0
+        if calls:
+            self[0:0] = calls
+
+    @classmethod
+    def from_packed(cls, packed_bytes, length):
+        """
+        Args:
+            packed_bytes (bytes): Codes, two per byte, as from packed_bytes().
+            length (int): Number of positions.
+
+        Returns:
+            PackedCalls: wrapping a copy of packed_bytes
+        """
+        packed_calls = cls()
+        packed_calls._packed_data = bytearray(packed_bytes)
+        packed_calls._length = length
+        return packed_calls
+
+    def packed_bytes(self):
+        """
+        Returns:
+            bytes: The raw codes, two per byte.
+        """
+        return bytes(self._packed_data)
+
+    def codes(self, start=0, stop=None):
+        """
+        Args:
+            start (int): 0-indexed first position.
+            stop (int): 0-indexed position after the last, or None for the end.
+
+        Returns:
+            bytearray: The codes of the positions in range, one per byte.
+        """
+        if stop is None or stop > self._length:
+            stop = self._length
+        if stop <= start:
+            return bytearray()
+        packed_range = self._packed_data[start >> 1:( stop + 1 ) >> 1]
+        codes = bytearray(len(packed_range) * 2)
+        codes[0::2] = packed_range.translate(self.LOW_CODE_TABLE)
+        codes[1::2] = packed_range.translate(self.HIGH_CODE_TABLE)
+        return codes[start & 1:( start & 1 ) + stop - start]
+
+    @classmethod
+    def _pack_codes(cls, codes):
+        """ Packs codes from one per byte to two per byte. """
+        # The low and high halves never overlap, so or-ing them as big integers combines every byte at once.
+        return ( int.from_bytes(codes[0::2], 'little') |
+                 int.from_bytes(codes[1::2].translate(cls.SHIFT_CODE_TABLE), 'little') ).to_bytes(
+            ( len(codes) + 1 ) >> 1, 'little')
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        """
+        Like a bytearray, a single position is returned as the integer value
+        of its character, and a range as bytes of characters.
+        """
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self._length)
+            return bytes(self.codes(start, stop).translate(self.DECODE_TABLE))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("PackedCalls index out of range")
+        return self.DECODE_TABLE[( self._packed_data[index >> 1] >> ( ( index & 1 ) << 2 ) ) & 15]
+
+    def __setitem__(self, index, calls):
+        """
+        Only overwriting a range starting within or at the end of the
+        sequence is supported, which is all GenomeStatus ever does.  The
+        sequence grows if the range runs off the end.
+        """
+        start = index.indices(self._length)[0]
+        codes = bytes(calls).translate(self.ENCODE_TABLE)
+        stop = start + len(codes)
+        # Pull in the neighbors sharing a byte with either end of the range.
+        if start % 2:
+            codes = self.codes(start - 1, start) + codes
+        if stop % 2 and stop < self._length:
+            codes += self.codes(stop, stop + 1)
+        self._packed_data[start >> 1:( stop + 1 ) >> 1] = self._pack_codes(codes)
+        self._length = max(self._length, stop)
+
+    def decode(self, encoding='latin-1'):
+        """
+        Returns:
+            str: All the calls, like bytearray.decode().
+        """
+        return self[0:self._length].decode(encoding)
+
 
 class GenomeMeta(object):
     """ Stores the metadata associated with a genome.  """
@@ -406,6 +845,19 @@ class GenomeMeta(object):
         """
         self._generators.extend(generator_array)
 
+    def copy_metadata(self, genome):
+        """
+        Sets all the metadata to that of another genome, for a genome that
+        holds another part of the same sample's data.
+
+        Args:
+            genome (GenomeMeta): The genome to copy the metadata of.
+        """
+        self._nickname = genome._nickname
+        self._file_path = genome._file_path
+        self._file_type = genome._file_type
+        self._generators = list(genome._generators)
+
     def file_path(self):
         """
         Returns:
@@ -447,8 +899,9 @@ class GenomeMeta(object):
         """
         For single-sample input files that don't carry any sample name
         metadata within the file, generate a nickname for the sample by
-        removing the extension.  If this fails, generate a random name in the
-        format "file_XXXXXXXX" where X is an 8-digit random integer.
+        removing the extension, and any gzip or BGZF extension after it.  If
+        this fails, generate a random name in the format "file_XXXXXXXX"
+        where X is an 8-digit random integer.
 
         Args:
             filename (str):
@@ -459,7 +912,8 @@ class GenomeMeta(object):
         import re
         import random
         # Parse basename from fasta or vcf file
-        filename_match = re.match(r'^(?:.*/)?([^/]+?)\.(?:(?:franken)?fas?(?:ta)?|vcf)?$', filename, re.IGNORECASE)
+        filename_match = re.match(r'^(?:.*/)?([^/]+?)\.(?:(?:franken)?fas?(?:ta)?|vcf)?(?:\.(?:gz|bgzf?))?$', filename,
+                                  re.IGNORECASE)
         if filename_match:
             nickname = filename_match.group(1)
         else:
@@ -488,6 +942,271 @@ class IndelList(object):
         self._indels = {}
 
 
+class DuplicateRegions(object):
+    """
+    Duplicate region data for the reference, stored as the runs of positions
+    that are not '0', rather than as one value per position like
+    GenomeStatus.  Nearly every position of a reference is '0', so a contig
+    is its length plus a few sorted start and end arrays, which are searched
+    with bisect.  The values follow the duplicate region data conventions
+    of GenomeStatus, and positions beyond the end of a contig are
+    undefined.
+    """
+
+    def __init__(self):
+        """
+        Attributes:
+            _regions (dict): The runs of each contig by contig name, as a
+            tuple of the 1-indexed first positions, the inclusive last
+            positions, and the value of each run.  The runs are sorted,
+            do not overlap, and adjacent runs have different values.
+            _lengths (dict): The number of positions defined in each contig.
+            _current_contig: Tracks the most recently-referenced contig, for
+            convenience EG reading in the duplicates file line-by-line.
+        """
+        self._regions = {}
+        self._lengths = {}
+        self._current_contig = None
+
+    def add_contig(self, contig_name):
+        """
+        Defines a new empty contig.
+
+        Args:
+            contig_name (str): Unique contig description.
+        """
+        from array import array
+        if contig_name not in self._regions:
+            self._regions[contig_name] = ( array('L'), array('L'), bytearray() )
+            self._lengths[contig_name] = 0
+        self._current_contig = contig_name
+
+    def set_current_contig(self, contig_name, create_contig=True):
+        """
+        See GenomeStatus.set_current_contig.
+
+        Args:
+            contig_name (str): Unique contig description or None to query the current contig name.
+            create_contig (bool): If True and the contig does not exist, an empty contig will be created.
+
+        Returns:
+            str: Name of the last accessed contig or None.
+
+        Raises:
+            InvalidContigName: If create_contig is False and the contig does not exist.
+        """
+        if contig_name is None:
+            contig_name = self._current_contig
+        elif contig_name in self._regions:
+            self._current_contig = contig_name
+        elif create_contig:
+            self.add_contig(contig_name)
+        else:
+            raise InvalidContigName(contig_name, self.get_contigs())
+        return contig_name
+
+    def get_contigs(self):
+        """
+        Returns:
+            list: Sorted list of contig names.
+        """
+        return sorted(self._regions.keys())
+
+    def get_contig_length(self, contig_name=None):
+        """
+        Args:
+            contig_name (str): Unique contig description.
+
+        Returns:
+            int: Number of positions defined in the contig
+        """
+        contig_name = self.set_current_contig(contig_name)
+        return self._lengths[contig_name]
+
+    def append_run(self, first_position, last_position, value, contig_name=None, missing_range_filler="!"):
+        """
+        Places a run of one value at the end of the contig.
+
+        Args:
+            first_position (int): 1-indexed first position number, after the end of the contig.
+            last_position (int): Last position number, inclusive.
+            value (str): The single character value of every position in the run.
+            contig_name (str): Unique contig description.
+            missing_range_filler (str): Value for undefined positions between the end of the contig and the run.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        if first_position <= self._lengths[contig_name]:
+            raise ValueError("Position {0} of contig {1} is already defined".format(first_position, contig_name))
+        if last_position < first_position:
+            return
+        ( starts, ends, values ) = self._regions[contig_name]
+        if first_position > self._lengths[contig_name] + 1:
+            self.append_run(self._lengths[contig_name] + 1, first_position - 1, missing_range_filler, contig_name)
+        if value != "0":
+            if ends and ends[-1] == first_position - 1 and values[-1] == ord(value):
+                ends[-1] = last_position
+            else:
+                starts.append(first_position)
+                ends.append(last_position)
+                values.append(ord(value))
+        self._lengths[contig_name] = last_position
+
+    def append_contig(self, dups_data, contig_name=None):
+        """
+        Places the passed-in values at the positions following the last
+        defined position on the contig.
+
+        Args:
+            dups_data (str): One duplicate region value per position.
+            contig_name (str): Unique contig description.
+        """
+        import re
+        contig_name = self.set_current_contig(contig_name)
+        contig_length = self._lengths[contig_name]
+        for run_match in re.finditer(r'(.)\1*', dups_data, re.DOTALL):
+            self.append_run(contig_length + run_match.start() + 1, contig_length + run_match.end(),
+                            run_match.group(1), contig_name)
+
+    def get_value(self, first_position, last_position=None, contig_name=None, filler_value=None):
+        """
+        See GenomeStatus.get_value.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Optional last position to select a range or -1 to specify the end of the contig.
+            contig_name (str): Unique contig description.
+            filler_value (str): Optional filler for undefined regions beyond the contig.
+
+        Returns:
+            The value at first_position, list of values from first_position
+            to last_position inclusive, or None.
+        """
+        from bisect import bisect_right
+        contig_name = self.set_current_contig(contig_name)
+        contig_length = self._lengths[contig_name]
+        if last_position is None:
+            if first_position > contig_length:
+                return filler_value
+            ( starts, ends, values ) = self._regions[contig_name]
+            run_index = bisect_right(starts, first_position) - 1
+            if run_index >= 0 and ends[run_index] >= first_position:
+                return chr(values[run_index])
+            return "0"
+        if last_position == -1:
+            last_position = contig_length
+        if last_position < first_position or first_position > contig_length:
+            return []
+        if filler_value is None:
+            last_position = min(last_position, contig_length)
+            filler_value = "?"
+        return list(self.get_value_bytes(first_position, last_position, contig_name, filler_value).decode('latin-1'))
+
+    def _runs_in_range(self, first_position, last_position, contig_name):
+        """
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+
+        Returns:
+            generator: The ( first offset, end offset, value ) of each run
+            overlapping the range, clipped to it, where the offsets are
+            0-indexed from first_position and the end offset is exclusive.
+        """
+        from bisect import bisect_left
+        ( starts, ends, values ) = self._regions[contig_name]
+        run_index = bisect_left(ends, first_position)
+        while run_index < len(starts) and starts[run_index] <= last_position:
+            yield ( max(starts[run_index], first_position) - first_position,
+                    min(ends[run_index], last_position) - first_position + 1, values[run_index] )
+            run_index += 1
+
+    def get_value_bytes(self, first_position, last_position, contig_name=None, filler_value="?"):
+        """
+        The whole-range version of get_value.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+            filler_value (str): Single character filler for undefined regions beyond the contig.
+
+        Returns:
+            bytes: The values from first_position to last_position, one character per position.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        range_length = max(0, last_position - first_position + 1)
+        defined_length = max(0, min(range_length, self._lengths[contig_name] - first_position + 1))
+        range_values = bytearray(b"0") * defined_length + filler_value.encode('latin-1') * (
+            range_length - defined_length )
+        for ( first_offset, end_offset, value ) in self._runs_in_range(first_position, last_position, contig_name):
+            range_values[first_offset:end_offset] = bytes(( value, )) * ( end_offset - first_offset )
+        return bytes(range_values)
+
+    def get_mask(self, first_position, last_position, contig_name=None):
+        """
+        The positions in a duplicated region, that is with a '1', across a
+        range, for applying to a whole window at once.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+
+        Returns:
+            bytearray: 1 for each position in a duplicated region, and 0 otherwise, including beyond the contig.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        range_mask = bytearray(max(0, last_position - first_position + 1))
+        for ( first_offset, end_offset, value ) in self._runs_in_range(first_position, last_position, contig_name):
+            if value == ord("1"):
+                range_mask[first_offset:end_offset] = b"\x01" * ( end_offset - first_offset )
+        return range_mask
+
+    def get_window(self, first_position, last_position, contig_name=None):
+        """
+        Copies a range of a contig to a new DuplicateRegions, where it starts
+        at position 1.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+
+        Returns:
+            DuplicateRegions: The contig with only the defined part of the range.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        last_position = min(last_position, self._lengths[contig_name])
+        window = DuplicateRegions()
+        window.add_contig(contig_name)
+        for ( first_offset, end_offset, value ) in self._runs_in_range(first_position, last_position, contig_name):
+            window.append_run(first_offset + 1, end_offset, chr(value), contig_name, "0")
+        window.append_run(window.get_contig_length(contig_name) + 1, last_position - first_position + 1, "0",
+                          contig_name)
+        return window
+
+    def import_delta_file(self, delta_filename):
+        """
+        Marks the regions of the reference that aligned to another region of
+        itself according to a nucmer delta file as duplicated.
+
+        Args:
+            delta_filename (str): Path to the delta file of the reference aligned to itself.
+        """
+        from nasp.find_duplicates import read_delta_intervals
+        ( contig_lengths, dup_intervals ) = read_delta_intervals(delta_filename)
+        for ( contig_name, intervals ) in dup_intervals.items():
+            self.add_contig(contig_name)
+            for ( start, end ) in intervals:
+                # The positions up to an alignment past the end of the contig, which should not happen, are
+                # algorithmic failures.
+                self.append_run(self._lengths[contig_name] + 1, min(start - 1, contig_lengths[contig_name]), "0",
+                                contig_name)
+                self.append_run(start, end, "1", contig_name)
+            self.append_run(self._lengths[contig_name] + 1, contig_lengths[contig_name], "0", contig_name)
+
+
 class ReferenceGenome(Genome):
     """
     A special type of genome that is to be used as our reference.
@@ -495,15 +1214,19 @@ class ReferenceGenome(Genome):
     region data, and we don't need to store any metadata about it.
     """
 
-    def __init__(self):
+    def __init__(self, compact=False, packed=False):
         """
+        Args:
+            compact (bool): Store contigs as bytearrays instead of lists.
+            packed (bool): Store the reference calls as 4-bit codes.
+
         Attributes:
-            _dups (GenomeStatus): carries data about whether a particular
+            _dups (DuplicateRegions): carries data about whether a particular
             region of the reference was found to be very similar to another region
             in the same reference.
         """
-        Genome.__init__(self)
-        self._dups = GenomeStatus()
+        Genome.__init__(self, compact, packed)
+        self._dups = DuplicateRegions()
 
     def get_dups_call(self, first_position, last_position=None, contig_name=None):
         """
@@ -517,6 +1240,43 @@ class ReferenceGenome(Genome):
         """
         return self._dups.get_value(first_position, last_position, contig_name, "?")
 
+    def get_dups_bytes(self, first_position, last_position, contig_name=None):
+        """
+        The range version of get_dups_call.
+
+        Returns:
+            bytes: The dups call of every position in the range, one character each.
+        """
+        return self._dups.get_value_bytes(first_position, last_position, contig_name, "?")
+
+    def get_dups_mask(self, first_position, last_position, contig_name=None):
+        """
+        Returns:
+            bytearray: 1 for each position of the range in a duplicated region, and 0 otherwise.
+        """
+        return self._dups.get_mask(first_position, last_position, contig_name)
+
+    def get_window(self, first_position, last_position, contig_name=None):
+        """
+        Copies a range of a contig to a new reference, where it starts at
+        position 1, for working on the contig a window at a time.
+
+        Args:
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            contig_name (str): Unique contig description.
+
+        Returns:
+            ReferenceGenome: The range of the reference calls and dups calls.
+        """
+        contig_name = self.set_current_contig(contig_name)
+        window = ReferenceGenome(self._compact and not self._packed, self._packed)
+        window.add_contig(contig_name)
+        if last_position >= first_position:
+            window.set_call(self.get_call(first_position, last_position, contig_name), 1, "X", contig_name)
+        window._dups = self._dups.get_window(first_position, last_position, contig_name)
+        return window
+
     def _import_dups_line(self, line_from_dups_file, contig_prefix=""):
         """
         Just like importing any other fasta-like file line-by-line, but
@@ -534,16 +1294,24 @@ class ReferenceGenome(Genome):
         else:
             data_match = re.match(r'^([01-]+)\s*$', line_from_dups_file)
             if data_match:
-                self._dups.append_contig(list(data_match.group(1)))
+                self._dups.append_contig(data_match.group(1))
 
-    def import_dups_file(self, dups_filename, contig_prefix=""):
+    def import_dups_file(self, dups_filename, contig_prefix="", num_threads=1):
         """ Wrapper for _import_dups_line for flexibility and testing.
+        A nucmer delta file of the reference aligned to itself, named
+        *.delta, is read directly instead.
 
         Args:
             dups_filename (str):
             contig_prefix (str):
-        """
-        with open(dups_filename, 'r') as dups_handle:
+            num_threads (int): threads that may decompress a BGZF file
+        """
+        if dups_filename.endswith('.delta'):
+            self._dups.import_delta_file(dups_filename)
+            for contig_name in self._dups.get_contigs():
+                self.add_contig(contig_name)
+            return
+        with open_input_file(dups_filename, 'r', num_threads) as dups_handle:
             for line_from_dups_file in dups_handle:
                 self._import_dups_line(line_from_dups_file, contig_prefix)
 
@@ -554,8 +1322,11 @@ class FastaGenome(Genome, GenomeMeta):
     a VCFGenome object, with filter checks hard-coded.
     """
 
-    def __init__(self):
-        Genome.__init__(self)
+    # Calls to the was-called filter state of get_was_called.
+    WAS_CALLED_TABLE = bytes(ord('N') if character in b'XN' else ord('Y') for character in range(256))
+
+    def __init__(self, compact=False, packed=False):
+        Genome.__init__(self, compact, packed)
         GenomeMeta.__init__(self)
         self._indels = IndelList()
 
@@ -579,38 +1350,542 @@ class FastaGenome(Genome, GenomeMeta):
         """ This filter is not applicable. """
         return "-"
 
+    def get_was_called_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """
+        The whole-contig version of get_was_called, for parity with VCFGenome.
+        """
+        if contig_length is None:
+            contig_length = self.get_contig_length(contig_name)
+        calls, other_calls = self.get_value_bytes(first_position, contig_length, contig_name, "X")
+        was_called = bytearray(calls.translate(FastaGenome.WAS_CALLED_TABLE))
+        for offset, call in other_calls.items():
+            was_called[offset] = ord('N') if call in ( 'X', 'N' ) else ord('Y')
+        return bytes(was_called)
+
+    def get_coverage_pass_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """ This filter is not applicable. """
+        if contig_length is None:
+            contig_length = self.get_contig_length(contig_name)
+        return b'-' * ( contig_length - first_position + 1 )
+
+    def get_proportion_pass_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """ This filter is not applicable. """
+        if contig_length is None:
+            contig_length = self.get_contig_length(contig_name)
+        return b'-' * ( contig_length - first_position + 1 )
+
+
+# The states of the three VCFGenome filters, indexed by their 2-bit code.  The first is the default.
+_FILTER_STATES = (b'NY', b'?YN-', b'?YN-')
+
+
+class VCFGenome(Genome, GenomeMeta):
+    """
+    A standard sample for analysis.  Has genome data, metadata, and data for
+    the three filters.
+    The filters are stored together as one status word per position, one
+    byte holding a 2-bit state code for each of was-called, coverage, and
+    proportion, so an unset position reads as 'N', '?', '?'.
+    """
+
+    WAS_CALLED_FILTER = 0
+    COVERAGE_FILTER = 1
+    PROPORTION_FILTER = 2
+
+    # Status words to filter state characters, one table per filter.
+    FILTER_STATE_TABLES = tuple(bytes(( states + b'??' )[( status_word >> ( 2 * filter_index ) ) & 3]
+                                      for status_word in range(256))
+                                for filter_index, states in enumerate(_FILTER_STATES))
+    # Filter state characters to their code in the status word, and status words with that filter cleared.
+    FILTER_CODE_TABLES = tuple(bytes(max(0, states.find(bytes(( state, )))) << ( 2 * filter_index )
+                                     for state in range(256))
+                               for filter_index, states in enumerate(_FILTER_STATES))
+    FILTER_CLEAR_TABLES = tuple(bytes(status_word & ~( 3 << ( 2 * filter_index ) ) & 255 for status_word in range(256))
+                                for filter_index in range(len(_FILTER_STATES)))
+
+    # Raw depths and proportions that are not numbers: not given, passed by the caller, and not applicable.
+    RAW_UNSET = float('nan')
+    RAW_PASS = float('inf')
+    RAW_NOT_APPLICABLE = float('-inf')
+    RAW_DEPTHS = 0
+    RAW_PROPORTIONS = 1
+
+    def __init__(self, compact=False, packed=False, raw_values=False):
+        """
+        Args:
+            raw_values (bool): Also keep the depth and proportion behind the
+                coverage and proportion filters, so that they can be
+                filtered again with other thresholds.
+
+        Attributes:
+            _filter_status (dict): Contig names to bytearrays of status words.
+            _current_filter_contig (str): Most-recently-referenced contig of the filters.
+            _raw_values (dict): Contig names to a pair of float arrays, the
+                depths and proportions, or None if raw values are not kept.
+        """
+        Genome.__init__(self, compact, packed)
+        GenomeMeta.__init__(self)
+        self._indels = IndelList()
+        self._filter_status = {}
+        self._current_filter_contig = None
+        self._raw_values = {} if raw_values else None
+
+    def has_raw_values(self):
+        return self._raw_values is not None
+
+    def set_raw_values(self, raw_index, values, first_position, contig_name=None):
+        """
+        Sets the raw depth or proportion of a continuous range of positions.
+        Depths and proportions given as 'PASS' are stored as RAW_PASS, and
+        positions without one are RAW_UNSET.
+
+        Args:
+            raw_index (int): RAW_DEPTHS or RAW_PROPORTIONS.
+            values (list): A float per position, starting at first_position.
+            first_position (int): 1-indexed contig position number.
+            contig_name (str): Unique contig description.
+        """
+        from array import array
+
+        if contig_name is None:
+            contig_name = self._current_filter_contig
+        self._current_filter_contig = contig_name
+        raw_values = self._raw_values.setdefault(contig_name, ( array('d'), array('d') ))[raw_index]
+        last_position = first_position + len(values) - 1
+        if len(raw_values) < last_position:
+            raw_values.extend(array('d', [self.RAW_UNSET]) * ( last_position - len(raw_values) ))
+        raw_values[first_position - 1:last_position] = array('d', values)
+
+    def get_raw_values(self, raw_index, contig_name=None):
+        """
+        Returns:
+            array: The raw depths or proportions of the contig, which may be
+            shorter than the contig; positions past the end are RAW_UNSET.
+        """
+        from array import array
+
+        if contig_name is None:
+            contig_name = self._current_filter_contig
+        self._current_filter_contig = contig_name
+        return self._raw_values.get(contig_name, ( array('d'), array('d') ))[raw_index]
+
+    def apply_filter_thresholds(self, min_coverage, min_proportion):
+        """
+        Sets the coverage and proportion filters of every contig from the raw
+        values, as if the genome had been read in with these thresholds.
+        The comparisons are done a whole contig at a time: each one maps a
+        float method over the raw values, giving a 0 or 1 byte per position,
+        and the status words are built from those bytes as lanes.
+        """
+        for contig_name in self._raw_values:
+            raw_depths = self.get_raw_values(self.RAW_DEPTHS, contig_name)
+            raw_proportions = self.get_raw_values(self.RAW_PROPORTIONS, contig_name)
+            status_words = self._filter_status.setdefault(contig_name, bytearray())
+            contig_length = max(len(status_words), len(raw_depths), len(raw_proportions))
+            status_words.extend(bytes(contig_length - len(status_words)))
+            word_lanes = int.from_bytes(status_words.translate(self.FILTER_CLEAR_TABLES[self.COVERAGE_FILTER]).translate(
+                self.FILTER_CLEAR_TABLES[self.PROPORTION_FILTER]), 'little')
+            for filter_index, raw_values, threshold in (
+                    ( self.COVERAGE_FILTER, raw_depths, float(min_coverage) ),
+                    ( self.PROPORTION_FILTER, raw_proportions, float(min_proportion) )):
+                # NaN is the one value not equal to itself, and fails every comparison.
+                set_lanes = int.from_bytes(bytes(map(float.__eq__, raw_values, raw_values)), 'little')
+                pass_lanes = int.from_bytes(bytes(map(threshold.__le__, raw_values)), 'little')
+                not_applicable_lanes = int.from_bytes(bytes(map(self.RAW_NOT_APPLICABLE.__eq__, raw_values)), 'little')
+                # The codes of '?', 'Y', 'N', and '-' are 0, 1, 2, and 3.
+                code_lanes = ( set_lanes << 1 ) - pass_lanes + not_applicable_lanes
+                word_lanes |= code_lanes << ( 2 * filter_index )
+            self._filter_status[contig_name] = bytearray(word_lanes.to_bytes(contig_length, 'little'))
+
+    def _set_filter_state(self, filter_index, pass_value, current_pos, contig_name):
+        """
+        If passed more than one state, will change the continuous range of
+        positions starting at current_pos, one position per state.
+
+        Args:
+            filter_index (int): One of WAS_CALLED_FILTER, COVERAGE_FILTER, or PROPORTION_FILTER.
+            pass_value (str): A filter state, such as 'Y' or 'N', or a run of them.
+            current_pos (int): 1-indexed contig position number.
+            contig_name (str): Unique contig description.
+        """
+        if contig_name is None:
+            contig_name = self._current_filter_contig
+        self._current_filter_contig = contig_name
+        status_words = self._filter_status.setdefault(contig_name, bytearray())
+        last_pos = current_pos + max(0, len(pass_value) - 1)
+        if len(status_words) < last_pos:
+            status_words.extend(bytes(last_pos - len(status_words)))
+        shift = 2 * filter_index
+        if len(pass_value) <= 1:
+            status_words[current_pos - 1] = ( status_words[current_pos - 1] & ~( 3 << shift ) ) | (
+                _FILTER_STATES[filter_index].index(pass_value.encode()) << shift )
+        else:
+            pass_values = pass_value.encode()
+            if pass_values.translate(None, _FILTER_STATES[filter_index]):
+                raise ValueError("'{0}' is not a run of filter states".format(pass_value))
+            # OR the new codes into the cleared status words, every position at once.
+            kept_words = status_words[current_pos - 1:last_pos].translate(self.FILTER_CLEAR_TABLES[filter_index])
+            status_words[current_pos - 1:last_pos] = (
+                int.from_bytes(kept_words, 'little') |
+                int.from_bytes(pass_values.translate(self.FILTER_CODE_TABLES[filter_index]), 'little')
+            ).to_bytes(len(pass_values), 'little')
+
+    def _get_filter_state(self, filter_index, current_pos, contig_name):
+        if contig_name is None:
+            contig_name = self._current_filter_contig
+        self._current_filter_contig = contig_name
+        status_words = self._filter_status.get(contig_name, b'')
+        status_word = status_words[current_pos - 1] if current_pos <= len(status_words) else 0
+        return chr(self.FILTER_STATE_TABLES[filter_index][status_word])
+
+    def get_filter_status(self, contig_name=None, contig_length=None, first_position=1):
+        """
+        Args:
+            contig_name (str): Unique contig description.
+            contig_length (int): Optional number of positions to pad or truncate the result to.
+            first_position (int): Optional 1-indexed first position, to get only the end of the contig.
+
+        Returns:
+            bytes: The status word of every position in the contig.
+        """
+        if contig_name is None:
+            contig_name = self._current_filter_contig
+        self._current_filter_contig = contig_name
+        status_words = bytes(self._filter_status.get(contig_name, b'')[first_position - 1:contig_length])
+        if contig_length is not None:
+            status_words += bytes(max(0, contig_length - first_position + 1 - len(status_words)))
+        return status_words
+
+    def set_was_called(self, pass_value, current_pos, contig_name=None):
+        self._set_filter_state(self.WAS_CALLED_FILTER, pass_value, current_pos, contig_name)
+
+    def set_coverage_pass(self, pass_value, current_pos, contig_name=None):
+        self._set_filter_state(self.COVERAGE_FILTER, pass_value, current_pos, contig_name)
+
+    def set_proportion_pass(self, pass_value, current_pos, contig_name=None):
+        self._set_filter_state(self.PROPORTION_FILTER, pass_value, current_pos, contig_name)
+
+    def get_was_called(self, current_pos, contig_name=None):
+        return self._get_filter_state(self.WAS_CALLED_FILTER, current_pos, contig_name)
+
+    def get_coverage_pass(self, current_pos, contig_name=None):
+        return self._get_filter_state(self.COVERAGE_FILTER, current_pos, contig_name)
+
+    def get_proportion_pass(self, current_pos, contig_name=None):
+        return self._get_filter_state(self.PROPORTION_FILTER, current_pos, contig_name)
+
+    def get_was_called_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """
+        Args:
+            contig_name (str): Unique contig description.
+            contig_length (int): Optional number of positions to pad or truncate the result to.
+            first_position (int): Optional 1-indexed first position, to get only the end of the contig.
+
+        Returns:
+            bytes: The was-called filter state of every position in the contig, one character each.
+        """
+        return self.get_filter_status(contig_name, contig_length, first_position).translate(
+            self.FILTER_STATE_TABLES[self.WAS_CALLED_FILTER])
+
+    def get_coverage_pass_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """ Like get_was_called_contig, for the coverage filter. """
+        return self.get_filter_status(contig_name, contig_length, first_position).translate(
+            self.FILTER_STATE_TABLES[self.COVERAGE_FILTER])
+
+    def get_proportion_pass_contig(self, contig_name=None, contig_length=None, first_position=1):
+        """ Like get_was_called_contig, for the proportion filter. """
+        return self.get_filter_status(contig_name, contig_length, first_position).translate(
+            self.FILTER_STATE_TABLES[self.PROPORTION_FILTER])
+
+
+class GenomeStore(object):
+    """
+    The NASP binary genome format: one packed sample genome in a file that
+    is read back by memory-mapping it, with no parsing, instead of reading
+    its VCF or fasta in again.
+    The file starts with MAGIC, the length of the header as an 8-byte
+    little-endian integer, and the header, a JSON object with the metadata
+    of the genome and, for each contig, its length, its side table of calls
+    without a 4-bit code, and the offset and size of each of its sections:
+        calls: The PackedCalls codes, two positions per byte.
+        status: The VCFGenome status words, one byte per position.
+        depths, proportions: The raw values of a VCFGenome, as little-endian
+            doubles, for filtering again with other thresholds.
+    Sections start on 8-byte boundaries.
+    """
+
+    MAGIC = b'NASPGNM\x01'
+    GENOME_CLASSES = {'VCFGenome': VCFGenome, 'FastaGenome': FastaGenome}
+
+    @staticmethod
+    def _get_header_bytes(header):
+        import json
+
+        header_bytes = json.dumps(header, sort_keys=True).encode()
+        return header_bytes + b' ' * ( -( len(GenomeStore.MAGIC) + 8 + len(header_bytes) ) % 8 )
+
+    @staticmethod
+    def write(genome, store_filename, source=None, filter_thresholds=None):
+        """
+        Args:
+            genome (VCFGenome or FastaGenome): A packed genome.
+            store_filename (str): The file to write, through a temporary file
+                beside it so that no reader sees half of it.
+            source (dict): Optional JSON-safe data saved in the header, such
+                as what the genome was read in from.
+            filter_thresholds (tuple): Optional ( min_coverage, min_proportion )
+                the filters of the genome were set with, so that reading it
+                with the same thresholds does not filter it again.
+
+        Raises:
+            ValueError: If the genome is not packed.
+        """
+        import os
+        import struct
+        import sys
+        import tempfile
+
+        if not getattr(genome, '_packed', False):
+            raise ValueError("only packed genomes can be stored")
+        header = {'genome_class': type(genome).__name__, 'nickname': genome.nickname(),
+                  'file_path': genome.file_path(), 'file_type': genome.file_type(),
+                  'generators': list(genome._generators), 'source': source, 'contigs': [],
+                  'raw_values': isinstance(genome, VCFGenome) and genome.has_raw_values(),
+                  'filter_thresholds': None if filter_thresholds is None else [float(threshold) for threshold in
+                                                                               filter_thresholds]}
+        sections = []
+        section_offset = 0
+        is_vcf_genome = isinstance(genome, VCFGenome)
+        contig_names = set(genome.get_contigs())
+        if is_vcf_genome:
+            contig_names.update(genome._filter_status)
+            contig_names.update(genome._raw_values or ())
+        for contig_name in sorted(contig_names):
+            contig_header = {'name': contig_name}
+            contig_sections = []
+            if contig_name in genome._genome:
+                packed_calls = genome._genome[contig_name]
+                contig_header['length'] = len(packed_calls)
+                contig_header['indels'] = [[index, value] for index, value in
+                                           sorted(genome._indel_values.get(contig_name, {}).items())]
+                contig_sections.append(( 'calls', packed_calls.packed_bytes() ))
+            if is_vcf_genome and contig_name in genome._filter_status:
+                contig_sections.append(( 'status', genome.get_filter_status(contig_name) ))
+            if is_vcf_genome and genome.has_raw_values() and contig_name in genome._raw_values:
+                for section_name, raw_index in ( ( 'depths', VCFGenome.RAW_DEPTHS ),
+                                                 ( 'proportions', VCFGenome.RAW_PROPORTIONS ) ):
+                    raw_values = genome.get_raw_values(raw_index, contig_name)
+                    if sys.byteorder != 'little':
+                        raw_values = raw_values[:]
+                        raw_values.byteswap()
+                    contig_sections.append(( section_name, raw_values.tobytes() ))
+            for section_name, section_data in contig_sections:
+                contig_header[section_name] = [section_offset, len(section_data)]
+                sections.append(section_data + bytes(-len(section_data) % 8))
+                section_offset += len(sections[-1])
+            header['contigs'].append(contig_header)
+        header_bytes = GenomeStore._get_header_bytes(header)
+        ( store_handle, temporary_filename ) = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(store_filename)))
+        try:
+            with os.fdopen(store_handle, 'wb') as store_file:
+                store_file.write(GenomeStore.MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+                store_file.writelines(sections)
+            os.chmod(temporary_filename, 0o644)
+            os.replace(temporary_filename, store_filename)
+        except BaseException:
+            os.remove(temporary_filename)
+            raise
+
+    @staticmethod
+    def read_header(store_filename):
+        """
+        Returns:
+            tuple: The header, as a dict, and the file offset of the sections.
+
+        Raises:
+            MalformedInputFile: If the file is not a genome store.
+        """
+        import json
+        import struct
+
+        with open(store_filename, 'rb') as store_handle:
+            file_start = store_handle.read(len(GenomeStore.MAGIC) + 8)
+            if len(file_start) < len(GenomeStore.MAGIC) + 8 or not file_start.startswith(GenomeStore.MAGIC):
+                raise MalformedInputFile(store_filename, "not a NASP genome store")
+            header_length = struct.unpack('<Q', file_start[len(GenomeStore.MAGIC):])[0]
+            try:
+                header = json.loads(store_handle.read(header_length).decode())
+            except ValueError:
+                raise MalformedInputFile(store_filename, "genome store header is damaged")
+        return header, len(file_start) + header_length
+
+    @staticmethod
+    def read(store_filename, min_coverage=None, min_proportion=None):
+        """
+        Args:
+            store_filename (str): A file written by GenomeStore.write.
+            min_coverage (int): With min_proportion, the thresholds to filter
+                the raw values with, if the store has them and they are not
+                the ones it was written with; the genome then does not keep
+                them.  Otherwise the filters are as they were when the genome
+                was stored.
+            min_proportion (float): See min_coverage.
 
-class VCFGenome(Genome, GenomeMeta):
+        Returns:
+            VCFGenome or FastaGenome: The packed genome.
+        """
+        import mmap
+        import sys
+        from array import array
+
+        ( header, sections_offset ) = GenomeStore.read_header(store_filename)
+        if header['genome_class'] not in GenomeStore.GENOME_CLASSES:
+            raise MalformedInputFile(store_filename, "unknown genome class '{0}'".format(header['genome_class']))
+        genome_class = GenomeStore.GENOME_CLASSES[header['genome_class']]
+        has_raw_values = header['raw_values']
+        if min_coverage is not None and min_proportion is not None:
+            # The stored filters are already right, and reading the raw values in is most of the work.
+            if header['filter_thresholds'] == [float(min_coverage), float(min_proportion)]:
+                has_raw_values = False
+        genome = genome_class(packed=True, raw_values=True) if has_raw_values else genome_class(packed=True)
+        genome.set_nickname(header['nickname'])
+        genome.set_file_path(header['file_path'])
+        genome.set_file_type(header['file_type'])
+        genome.add_generators(header['generators'])
+        with open(store_filename, 'rb') as store_handle:
+            store_data = mmap.mmap(store_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for contig_header in header['contigs']:
+                    contig_name = contig_header['name']
+
+                    def get_section(section_name):
+                        ( section_offset, section_size ) = contig_header[section_name]
+                        return store_data[sections_offset + section_offset:sections_offset + section_offset +
+                                                                           section_size]
+
+                    if 'calls' in contig_header:
+                        genome._genome[contig_name] = PackedCalls.from_packed(get_section('calls'),
+                                                                              contig_header['length'])
+                    if contig_header.get('indels'):
+                        genome._indel_values[contig_name] = dict(
+                            ( index, value ) for index, value in contig_header['indels'])
+                    if 'status' in contig_header:
+                        genome._filter_status[contig_name] = bytearray(get_section('status'))
+                    if has_raw_values and 'depths' in contig_header:
+                        raw_values = ( array('d'), array('d') )
+                        for raw_index, section_name in enumerate(( 'depths', 'proportions' )):
+                            raw_values[raw_index].frombytes(get_section(section_name))
+                            if sys.byteorder != 'little':
+                                raw_values[raw_index].byteswap()
+                        genome._raw_values[contig_name] = raw_values
+            finally:
+                store_data.close()
+        if has_raw_values and min_coverage is not None and min_proportion is not None:
+            genome.apply_filter_thresholds(min_coverage, min_proportion)
+            genome._raw_values = None
+        return genome
+
+
+class PatternRegistry(object):
     """
-    A standard sample for analysis.  Has genome data, metadata, and data for
-    the three filters.
+    Assigns the Pattern# of the matrix outputs.  Numbers are handed out in
+    the order that patterns are first seen, starting at 1, so a run that
+    sees its positions in reference order always numbers them the same way.
+    A part of a run, like one shard of a contig, can have its own registry;
+    merging those into the run's registry in reference order gives each
+    part a remapping from its own numbers to the run's, and the numbers the
+    whole run would have assigned.  The part's matrix lines then only need
+    their last column rewritten, see remap_matrix_lines.
     """
 
-    def __init__(self):
-        Genome.__init__(self)
-        GenomeMeta.__init__(self)
-        self._indels = IndelList()
-        self._was_called = GenomeStatus()
-        self._passed_coverage = GenomeStatus()
-        self._passed_proportion = GenomeStatus()
+    def __init__(self, patterns=None):
+        """
+        Args:
+            patterns (list): Optional patterns that are already numbered, in order of their Pattern#.
+        """
+        self._pattern_numbers = {}
+        self._patterns = []
+        for pattern in ( patterns or [] ):
+            self.get_number(pattern)
 
-    def set_was_called(self, pass_value, current_pos, contig_name=None):
-        self._was_called.set_value(pass_value, current_pos, "N", contig_name)
+    def __len__(self):
+        return len(self._pattern_numbers)
 
-    def set_coverage_pass(self, pass_value, current_pos, contig_name=None):
-        self._passed_coverage.set_value(pass_value, current_pos, "?", contig_name)
+    def __contains__(self, pattern):
+        return pattern in self._pattern_numbers
 
-    def set_proportion_pass(self, pass_value, current_pos, contig_name=None):
-        self._passed_proportion.set_value(pass_value, current_pos, "?", contig_name)
+    def get_number(self, pattern):
+        """
+        Args:
+            pattern (str): The pattern, as it is written to the matrix.
 
-    def get_was_called(self, current_pos, contig_name=None):
-        return self._was_called.get_value(current_pos, None, contig_name, "N")
+        Returns:
+            int: The Pattern#, which is assigned now if the pattern is new.
+        """
+        pattern_number = self._pattern_numbers.get(pattern)
+        if pattern_number is None:
+            self._patterns.append(pattern)
+            pattern_number = len(self._patterns)
+            self._pattern_numbers[pattern] = pattern_number
+        return pattern_number
 
-    def get_coverage_pass(self, current_pos, contig_name=None):
-        return self._passed_coverage.get_value(current_pos, None, contig_name, "?")
+    def get_patterns(self):
+        """
+        Returns:
+            list: Every pattern, in order of their Pattern#, so that it can be
+            given back to the constructor to resume numbering.
+        """
+        return list(self._patterns)
 
-    def get_proportion_pass(self, current_pos, contig_name=None):
-        return self._passed_proportion.get_value(current_pos, None, contig_name, "?")
+    def merge(self, other):
+        """
+        Adds the patterns of another registry that are new to this one, in
+        the other registry's order.
+
+        Args:
+            other (PatternRegistry): Registry of a later part of the run, or its list of patterns.
+
+        Returns:
+            dict: The other registry's Pattern# values to this one's, only
+            for the numbers that differ, so it is empty if nothing needs
+            rewriting.
+        """
+        if isinstance(other, PatternRegistry):
+            other = other.get_patterns()
+        pattern_remap = {}
+        for other_number, pattern in enumerate(other, 1):
+            pattern_number = self.get_number(pattern)
+            if pattern_number != other_number:
+                pattern_remap[other_number] = pattern_number
+        return pattern_remap
+
+    @staticmethod
+    def remap_matrix_lines(matrix_lines, pattern_remap):
+        """
+        Rewrites the Pattern# at the end of matrix lines.  Pattern# is the
+        last column, so only the end of each line is looked at, and lines
+        that are not remapped, like the header, are passed through as is.
+
+        Args:
+            matrix_lines (iterable): Matrix lines, with their line endings, like an open file.
+            pattern_remap (dict): As returned by merge.
+
+        Yields:
+            str: The lines with the new Pattern#.
+        """
+        if not pattern_remap:
+            yield from matrix_lines
+            return
+        pattern_remap = dict(( str(other_number), str(pattern_number) ) for other_number, pattern_number in
+                             pattern_remap.items())
+        for matrix_line in matrix_lines:
+            ( line_start, separator, other_number ) = matrix_line.rstrip("\n").rpartition("\t")
+            pattern_number = pattern_remap.get(other_number)
+            if pattern_number is None:
+                yield matrix_line
+            else:
+                yield "{0}{1}{2}\n".format(line_start, separator, pattern_number)
 
 
 class CollectionStatistics(object):
@@ -623,32 +1898,58 @@ class CollectionStatistics(object):
     automatically.
     For this reason, the object needs to know when the run moves on to the
     next position, and the flush_cumulative_stat_cache function does this.
+    Stats can also be recorded for many positions at once, as lanes: an int
+    with one byte per position, set to 1 where true and 0 where not, like
+    int.from_bytes(bytes(booleans), 'little').  Lanes of different stats and
+    samples are combined with bitwise operators, and are only counted when
+    the cache is flushed, so the work per position is done by the int
+    operations instead of by Python.
     """
 
     def __init__(self):
         """
-        _cumulative_cache keeps a running tally of sample stats at the
-        current position, and then writes the results to _sample_stats when
-        flush_cumulative_stat_cache() is called.
+        _cumulative_cache keeps the lanes where each stat was recorded,
+        passed, and failed for each sample nickname and for all samples
+        since the last flush, and then writes the any/all counts to
+        _sample_stats when flush_cumulative_stat_cache() is called.
         """
         self._contig_stats = {}
         self._sample_stats = {}
         self._cumulative_cache = {}
 
-    def _increment_by_contig(self, stat_id, contig_name):
+    @staticmethod
+    def to_lanes(vector):
+        """
+        Args:
+            vector (iterable): Booleans or 0/1 values for a range of positions, or lanes already.
+
+        Returns:
+            int: The lanes.
+        """
+        if isinstance(vector, int):
+            return vector
+        return int.from_bytes(bytes(vector), 'little')
+
+    @staticmethod
+    def count_lanes(lanes):
+        """ Returns the number of positions set in lanes. """
+        return lanes.to_bytes(( lanes.bit_length() + 7 ) // 8, 'little').count(1)
+
+    def _increment_by_contig(self, stat_id, contig_name, count=1):
         """ Makes sure the contig stat is defined, then increments it. """
         if ( stat_id, contig_name ) not in self._contig_stats:
             self._contig_stats[( stat_id, contig_name )] = 0
-        self._contig_stats[( stat_id, contig_name )] += 1
+        self._contig_stats[( stat_id, contig_name )] += count
 
-    def increment_contig_stat(self, stat_id, contig_name=None):
+    def increment_contig_stat(self, stat_id, contig_name=None, count=1):
         """
         Increments the stat for the specified contig, and automatically
         increments the count for the all-contigs tally on the same stat.
+        count increments by that many positions at once.
         """
-        self._increment_by_contig(stat_id, contig_name)
+        self._increment_by_contig(stat_id, contig_name, count)
         if contig_name is not None:
-            self._increment_by_contig(stat_id, None)
+            self._increment_by_contig(stat_id, None, count)
 
     def get_contig_stat(self, stat_id, contig_name=None):
         return_value = 0
@@ -656,28 +1957,27 @@ class CollectionStatistics(object):
             return_value = self._contig_stats[( stat_id, contig_name )]
         return return_value
 
-    def _cache_cumulative_stats(self, stat_id, sample_nickname, did_pass):
+    def _cache_cumulative_stats(self, stat_id, sample_nickname, recorded, passed):
         """
-        Writes data to the stat cache for the current position.  stat_type
-        is either "p" for pass/positive or "t" for total.  Flushing the cache
-        involves checking the p/t ratio.  When updating the cache,
-        failed/negative samples just increment t, while pass/positive samples
-        increment p and t.
+        Adds a sample-analysis to the stat cache.  Flushing the cache counts
+        the positions where any of the sample-analyses passed, and where
+        all of them passed, which is where one was recorded and none failed.
         Cumulative stats are across all samples at a position, and then once
         each for all sample-analyses on a sample.
         """
-        if ( stat_id, sample_nickname, 't' ) not in self._cumulative_cache:
-            self._cumulative_cache[( stat_id, sample_nickname, 't' )] = 0
-            self._cumulative_cache[( stat_id, sample_nickname, 'p' )] = 0
-        self._cumulative_cache[( stat_id, sample_nickname, 't' )] += 1
-        if did_pass:
-            self._cumulative_cache[( stat_id, sample_nickname, 'p' )] += 1
+        cached_lanes = self._cumulative_cache.get(( stat_id, sample_nickname ))
+        if cached_lanes is None:
+            self._cumulative_cache[( stat_id, sample_nickname )] = [recorded, passed, recorded ^ passed]
+        else:
+            cached_lanes[0] |= recorded
+            cached_lanes[1] |= passed
+            cached_lanes[2] |= recorded ^ passed
 
-    def _increment_by_sample(self, stat_id, sample_nickname, sample_info, cum_type):
+    def _increment_by_sample(self, stat_id, sample_nickname, sample_info, cum_type, count=1):
         """ Defines if necessary, then increments, the sample stat. """
         if ( stat_id, sample_nickname, sample_info, cum_type ) not in self._sample_stats:
             self._sample_stats[( stat_id, sample_nickname, sample_info, cum_type )] = 0
-        self._sample_stats[( stat_id, sample_nickname, sample_info, cum_type )] += 1
+        self._sample_stats[( stat_id, sample_nickname, sample_info, cum_type )] += count
 
     def record_sample_stat(self, stat_id, sample_nickname, sample_identifier, sample_path, did_pass):
         """
@@ -687,8 +1987,68 @@ class CollectionStatistics(object):
         """
         if did_pass:
             self._increment_by_sample(stat_id, sample_nickname, ( sample_identifier, sample_path ), None)
-        self._cache_cumulative_stats(stat_id, sample_nickname, did_pass)
-        self._cache_cumulative_stats(stat_id, None, did_pass)
+        self._cache_cumulative_stats(stat_id, sample_nickname, 1, 1 if did_pass else 0)
+        self._cache_cumulative_stats(stat_id, None, 1, 1 if did_pass else 0)
+
+    def record_sample_stat_lanes(self, stat_id, sample_nickname, sample_identifier, sample_path, passed, recorded):
+        """
+        The vector version of record_sample_stat, for many positions at once.
+        Every call between flushes must cover the same range of positions.
+
+        Args:
+            stat_id (str): The stat.
+            sample_nickname (str): Nickname of the sample.
+            sample_identifier (str): Identifier of the sample-analysis.
+            sample_path (str): File path of the sample-analysis.
+            passed (int): Lanes, or a vector for to_lanes, of the positions that passed.
+            recorded (int): Lanes, or a vector for to_lanes, of the positions where the stat applied at all.
+        """
+        passed = self.to_lanes(passed)
+        recorded = self.to_lanes(recorded)
+        self.record_sample_stat_counts(stat_id, sample_nickname, sample_identifier, sample_path,
+                                       self.count_lanes(passed))
+        self._cache_cumulative_stats(stat_id, sample_nickname, recorded, passed)
+        self._cache_cumulative_stats(stat_id, None, recorded, passed)
+
+    def record_sample_stat_counts(self, stat_id, sample_nickname, sample_identifier, sample_path, pass_count):
+        """
+        The batch version of record_sample_stat, for many positions at once.
+        Only updates the per-analysis tally, as the any/all tallies cannot be
+        worked out from counts alone; see record_cumulative_stat_counts.
+        """
+        if pass_count > 0:
+            self._increment_by_sample(stat_id, sample_nickname, ( sample_identifier, sample_path ), None, pass_count)
+
+    def record_cumulative_stat_counts(self, stat_id, sample_nickname, any_count, all_count):
+        """
+        The batch version of flush_cumulative_stat_cache for one stat, given
+        the number of positions where any and all of the sample-analyses
+        recorded there passed.
+        """
+        if all_count > 0:
+            self._increment_by_sample(stat_id, sample_nickname, None, 'all', all_count)
+        if any_count > 0:
+            self._increment_by_sample(stat_id, sample_nickname, None, 'any', any_count)
+
+    def merge_stats(self, contig_stats, sample_stats):
+        """
+        Adds in the stats tallied by another CollectionStatistics, over
+        positions not seen by this one.
+
+        Args:
+            contig_stats (dict): The other's _contig_stats.
+            sample_stats (dict): The other's _sample_stats.
+        """
+        for stat_key, count in contig_stats.items():
+            self._contig_stats[stat_key] = self._contig_stats.get(stat_key, 0) + count
+        for stat_key, count in sample_stats.items():
+            self._sample_stats[stat_key] = self._sample_stats.get(stat_key, 0) + count
+
+    def increment_contig_stat_lanes(self, stat_id, contig_name, lanes):
+        """ The vector version of increment_contig_stat, for lanes or a vector for to_lanes. """
+        stat_count = self.count_lanes(self.to_lanes(lanes))
+        if stat_count > 0:
+            self.increment_contig_stat(stat_id, contig_name, stat_count)
 
     def get_sample_stat(self, stat_id, sample_nickname, sample_identifier, sample_path):
         return_value = 0
@@ -704,18 +2064,14 @@ class CollectionStatistics(object):
 
     def flush_cumulative_stat_cache(self):
         """
-        Does the math on the p/t ratio for the stat cache for the current
-        position, and writes that to the sample stats for the any/all counts.
-        p > 0:  any++
-        p = t:  all++
-        """
-        for ( stat_id, sample_nickname, stat_type ) in self._cumulative_cache:
-            if stat_type == 'p':
-                if self._cumulative_cache[( stat_id, sample_nickname, 'p' )] == self._cumulative_cache[
-                    ( stat_id, sample_nickname, 't' )]:
-                    self._increment_by_sample(stat_id, sample_nickname, None, 'all')
-                if self._cumulative_cache[( stat_id, sample_nickname, 'p' )] > 0:
-                    self._increment_by_sample(stat_id, sample_nickname, None, 'any')
+        Reduces the stat cache for the current position, or range of
+        positions, and writes that to the sample stats for the any/all counts.
+        any passed:  any++
+        recorded and none failed:  all++
+        """
+        for ( stat_id, sample_nickname ), ( recorded, passed, failed ) in self._cumulative_cache.items():
+            self.record_cumulative_stat_counts(stat_id, sample_nickname, self.count_lanes(passed),
+                                               self.count_lanes(recorded & failed ^ recorded))
         self._cumulative_cache = {}
 
 
@@ -726,8 +2082,46 @@ class GenomeCollection(CollectionStatistics):
     is computed on-the-fly as the matrix is actually written, for
     performance reasons.  Stats aren't available until after the matrix
     is written, for this reason.
+    The matrices are computed a window of positions at a time, with every
+    sample reduced to one state byte per position, see _get_matrix_states.
     """
 
+    # Positions per window in _format_matrix_contig, which needs a few bytes per sample per position.
+    MATRIX_WINDOW_SIZE = 65536
+    # Positions per shard when send_to_matrix_handles uses several processes.
+    MATRIX_SHARD_SIZE = 1048576
+
+    # A sample state byte holds the simple call code in bits 0-2, as the index in 'ACGTN', the was-called
+    # filter in bit 3, and the coverage and proportion filters in bits 4-5 and 6-7, as the index in '?YN-'.
+    # 'Y' and '-' both pass, and are the odd indexes, so bits 3, 4, and 6 are all set when a sample passed.
+    CALL_CODE_TABLE = bytes(b'ACGT'.index(character) if character in b'ACGT' else 4 for character in range(256))
+    WAS_CALLED_CODE_TABLE = bytes(8 if character == ord('Y') else 0 for character in range(256))
+    COVERAGE_CODE_TABLE = bytes(b'?YN-'.index(character) << 4 if character in b'?YN-' else 0 for character in range(256))
+    PROPORTION_CODE_TABLE = bytes(b'?YN-'.index(character) << 6 if character in b'?YN-' else 0 for character in range(256))
+
+    # Sample states to the characters of each column of a matrix line.
+    STATE_CALL_TABLE = bytes(b'ACGTNNNN'[state & 7] for state in range(256))
+    STATE_PASS_CALL_TABLE = bytes(b'ACGTNNNN'[state & 7] if state & 88 == 88 else ord('N') for state in range(256))
+    STATE_WAS_CALLED_TABLE = bytes(b'NY'[( state >> 3 ) & 1] for state in range(256))
+    STATE_COVERAGE_TABLE = bytes(b'?YN-'[( state >> 4 ) & 3] for state in range(256))
+    STATE_PROPORTION_TABLE = bytes(b'?YN-'[state >> 6] for state in range(256))
+    # The missing data matrix shows the call itself where the '*' is.
+    STATE_MISSINGDATA_TABLE = bytes(ord('*') if state & 88 == 88 and state & 7 != 4 else
+                                    ord('X') if not state & 8 else ord('N') for state in range(256))
+    # Index into VCF_FILTER_NAMES.
+    STATE_VCF_FILTER_TABLE = bytes(0 if not state & 8 else 1 if not state & 16 else 2 if not state & 64 else 3
+                                   for state in range(256))
+    VCF_FILTER_NAMES = ( "NoCall", "CovFail", "PropFail", "PASS" )
+
+    # Lanes are big integers with one byte per position, each 1 or 0, so stats for a whole window can be
+    # worked out with bitwise operators and counted.
+    STATE_WAS_CALLED_LANE_TABLE = bytes(( state >> 3 ) & 1 for state in range(256))
+    STATE_COVERAGE_LANE_TABLE = bytes(( state >> 4 ) & 1 for state in range(256))
+    STATE_PROPORTION_LANE_TABLE = bytes(( state >> 6 ) & 1 for state in range(256))
+    STATE_IS_N_LANE_TABLE = bytes(1 if state & 7 == 4 else 0 for state in range(256))
+    CALLED_BASE_LANE_TABLE = bytes(1 if character in b'ACGT' else 0 for character in range(256))
+    ZERO_LANE_TABLE = bytes(1 if value == 0 else 0 for value in range(256))
+
     def __init__(self):
         """
         _failed_genomes is just a list of filenames that had errors during
@@ -783,7 +2177,7 @@ class GenomeCollection(CollectionStatistics):
         return self._reference.get_contigs()
 
     # FIXME this function is starting to become a bit of a cluster
-    def _format_matrix_line(self, current_contig, current_pos, matrix_formats, pattern_data):
+    def _format_matrix_line(self, current_contig, current_pos, matrix_formats, pattern_registry):
         """
         A matrix line represents all the sample data at one reference
         contig-position.
@@ -991,10 +2385,7 @@ class GenomeCollection(CollectionStatistics):
         for matrix_format in ( allcallable_matrices + snp_matrices_md ):
             matrix_format['linetowrite'] += "{0}\t{1}\t{2}\t".format(str(call_data['callstring']), str(call_data['covstring']), str(call_data['propstring']))
         for matrix_format in all_matrices:
-            if current_pattern not in pattern_data:
-                pattern_data[current_pattern] = pattern_data[None]
-                pattern_data[None] += 1
-            matrix_format['linetowrite'] += "'{0}'\t{1}\n".format(current_pattern, str(pattern_data[current_pattern]))
+            matrix_format['linetowrite'] += "'{0}'\t{1}\n".format(current_pattern, str(pattern_registry.get_number(current_pattern)))
         for matrix_format in all_vcfs:
             if len(encountered_calls) > 0:
                 matrix_format['linetowrite'] += ",".join(encountered_calls)
@@ -1053,12 +2444,421 @@ class GenomeCollection(CollectionStatistics):
                                                                  genome_identifier)
         self.flush_cumulative_stat_cache()
 
-    # NOTE(jtravis): Fix documentation _write_matrix_line() does not exist
-    def send_to_matrix_handles(self, matrix_formats):
+    def _get_matrix_states(self, genome, current_contig, first_position, last_position):
+        """
+        Args:
+            genome (Genome): A VCFGenome or FastaGenome in the collection.
+            current_contig (str): Unique contig description.
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+
+        Returns:
+            tuple: The state byte of every position in the range, the calls
+            as from get_value_bytes, and the dictionary of other calls.
+        """
+        sample_calls, other_calls = genome.get_value_bytes(first_position, last_position, current_contig, 'X')
+        # The stored character of an insertion or deletion is the one simple_call looks at.
+        simple_calls = sample_calls.translate(Genome.SIMPLE_CALL_TABLE)
+        # The four parts never overlap, so or-ing them as big integers combines every position at once.
+        sample_states = (
+            int.from_bytes(simple_calls.translate(self.CALL_CODE_TABLE), 'little') |
+            int.from_bytes(genome.get_was_called_contig(current_contig, last_position, first_position).translate(
+                self.WAS_CALLED_CODE_TABLE), 'little') |
+            int.from_bytes(genome.get_coverage_pass_contig(current_contig, last_position, first_position).translate(
+                self.COVERAGE_CODE_TABLE), 'little') |
+            int.from_bytes(genome.get_proportion_pass_contig(current_contig, last_position, first_position).translate(
+                self.PROPORTION_CODE_TABLE), 'little') )
+        return sample_states.to_bytes(len(sample_calls), 'little'), sample_calls, other_calls
+
+    @staticmethod
+    def _to_lanes(data, lane_table):
+        return int.from_bytes(data.translate(lane_table), 'little')
+
+    def _record_matrix_window_stats(self, current_contig, reference_simple_calls, dups_mask, sample_states,
+                                    nickname_indices):
+        """
+        Records the stats _format_matrix_line would for every position in the
+        window, for all samples at once, using lanes.
+        For each sample stat, a sample-analysis can be recorded at a position
+        or not, and pass or not.  A group of sample-analyses passed "any" at
+        a position if one of them passed, and "all" if one of them was
+        recorded and none of them failed.
+
+        Args:
+            current_contig (str): Unique contig description.
+            reference_simple_calls (bytes): simple_call of the reference at each position.
+            dups_mask (bytearray): 1 at each position in a duplicated region of the reference, see get_dups_mask.
+            sample_states (list): The state bytes of each genome.
+            nickname_indices (dict): Sample nicknames to the indexes of their genomes.
+        """
+        window_length = len(reference_simple_calls)
+        all_lanes = int.from_bytes(b'\x01' * window_length, 'little')
+        call_code_lanes = all_lanes * 7
+        reference_codes = int.from_bytes(reference_simple_calls.translate(self.CALL_CODE_TABLE), 'little')
+        reference_clean = self._to_lanes(reference_simple_calls, self.CALLED_BASE_LANE_TABLE)
+        dups = self.to_lanes(dups_mask)
+        quality_context = reference_clean & ( dups ^ all_lanes )
+        not_all_called = 0
+        not_all_passed_coverage = 0
+        not_all_passed_proportion = 0
+        any_n = 0
+        any_snp = 0
+        all_passed_consensus = all_lanes
+        for sample_nickname, genome_indices in nickname_indices.items():
+            consensus = all_lanes
+            first_codes = None
+            code_differences = 0
+            for genome_index in genome_indices:
+                genome = self._genomes[genome_index]
+                states = sample_states[genome_index]
+                was_called = self._to_lanes(states, self.STATE_WAS_CALLED_LANE_TABLE)
+                passed_coverage = self._to_lanes(states, self.STATE_COVERAGE_LANE_TABLE)
+                passed_proportion = self._to_lanes(states, self.STATE_PROPORTION_LANE_TABLE)
+                passed = was_called & passed_coverage & passed_proportion
+                is_n = self._to_lanes(states, self.STATE_IS_N_LANE_TABLE)
+                codes = int.from_bytes(states, 'little') & call_code_lanes
+                is_reference = self._to_lanes(( codes ^ reference_codes ).to_bytes(window_length, 'little'),
+                                              self.ZERO_LANE_TABLE)
+                recorded_call = passed & quality_context
+                for stat_id, recorded, stat_passed in (
+                        ( 'was_called', all_lanes, was_called ),
+                        ( 'passed_coverage_filter', all_lanes, passed_coverage ),
+                        ( 'passed_proportion_filter', all_lanes, passed_proportion ),
+                        ( 'quality_breadth', quality_context, recorded_call ),
+                        ( 'called_reference', recorded_call, recorded_call & is_reference ),
+                        ( 'called_snp', recorded_call, recorded_call & ( is_reference | is_n ) ^ recorded_call ),
+                        ( 'called_indel', recorded_call, 0 ),
+                        ( 'called_degen', recorded_call, recorded_call & is_n ) ):
+                    self.record_sample_stat_lanes(stat_id, sample_nickname, genome.identifier(), genome.file_path(),
+                                                  stat_passed, recorded)
+                not_all_called |= was_called ^ all_lanes
+                not_all_passed_coverage |= passed_coverage ^ all_lanes
+                not_all_passed_proportion |= passed_proportion ^ all_lanes
+                any_n |= is_n
+                any_snp |= passed & reference_clean & ( is_reference | is_n ) ^ passed & reference_clean
+                consensus &= passed & ( is_n ^ all_lanes )
+                if first_codes is None:
+                    first_codes = codes
+                else:
+                    code_differences |= codes ^ first_codes
+            consensus &= self._to_lanes(code_differences.to_bytes(window_length, 'little'), self.ZERO_LANE_TABLE)
+            self.record_sample_stat_lanes('consensus', sample_nickname, None, None, consensus, all_lanes)
+            all_passed_consensus &= consensus
+        self.flush_cumulative_stat_cache()
+        quality_breadth = all_passed_consensus & ( dups | not_all_called | not_all_passed_coverage |
+                                                   not_all_passed_proportion | any_n ) ^ all_passed_consensus
+        for stat_id, stat_lanes in (
+                ( 'reference_clean', reference_clean ),
+                ( 'reference_duplicated', dups ),
+                ( 'all_called', not_all_called ^ all_lanes ),
+                ( 'all_passed_coverage', not_all_passed_coverage ^ all_lanes ),
+                ( 'all_passed_proportion', not_all_passed_proportion ^ all_lanes ),
+                ( 'all_passed_consensus', all_passed_consensus ),
+                ( 'quality_breadth', quality_breadth ),
+                ( 'best_snps', quality_breadth & any_snp ),
+                ( 'any_snps', any_snp & ( dups ^ all_lanes ) ) ):
+            self.increment_contig_stat_lanes(stat_id, current_contig, stat_lanes)
+        self.increment_contig_stat('reference_length', current_contig, window_length)
+
+    def _summarize_matrix_column(self, reference_simple_call, dups_call, column_states, nickname_indices):
+        """
+        Works out everything about a matrix line that does not depend on the
+        position or the raw calls, which is most of it, so that positions
+        with the same reference call, dups call, and sample states can share.
+
+        Args:
+            reference_simple_call (int): simple_call of the reference, as a character byte.
+            dups_call (bool): Whether the position is in a duplicated region.
+            column_states (bytes): The state byte of each genome at the position.
+            nickname_indices (dict): Sample nicknames to the indexes of their genomes.
+
+        Returns:
+            dict: The column text of the matrices and VCFs, and whether the line belongs in each filter.
+        """
+        genome_count = len(column_states)
+        simple_calls = column_states.translate(self.STATE_CALL_TABLE)
+        pass_calls = column_states.translate(self.STATE_PASS_CALL_TABLE)
+        callstring = column_states.translate(self.STATE_WAS_CALLED_TABLE)
+        covstring = column_states.translate(self.STATE_COVERAGE_TABLE)
+        propstring = column_states.translate(self.STATE_PROPORTION_TABLE)
+        refcall = 0
+        snpcall = 0
+        legend_calls = b''
+        if reference_simple_call != ord('N'):
+            refcall = pass_calls.count(reference_simple_call)
+            snpcall = genome_count - refcall - pass_calls.count(b'N')
+            legend_calls = bytes([reference_simple_call])
+        encountered_calls = bytes(sorted(( call for call in b'ACGT' if call in pass_calls and call not in legend_calls ),
+                                         key=pass_calls.index))
+        # The reference is 1 in the pattern and genotype 0, and other calls count up from 2 and 1.
+        pattern_digits = b'1' * len(legend_calls) + bytes(ord('2') + index for index in range(len(encountered_calls)))
+        genotype_digits = b'0' * len(legend_calls) + bytes(ord('1') + index for index in range(len(encountered_calls)))
+        legend_calls += encountered_calls
+        pattern = ( b'1' if reference_simple_call != ord('N') else b'N' ) + pass_calls.translate(
+            bytes.maketrans(legend_calls, pattern_digits))
+        genotypes = pass_calls.translate(bytes.maketrans(legend_calls + b'N', genotype_digits + b'.')).decode()
+        consensus_check = True
+        for genome_indices in nickname_indices.values():
+            consensus_call = pass_calls[genome_indices[0]]
+            if consensus_call == ord('N') or any(pass_calls[genome_index] != consensus_call for
+                                                 genome_index in genome_indices[1:]):
+                consensus_check = False
+                break
+        vcf_filters = column_states.translate(self.STATE_VCF_FILTER_TABLE)
+        return {
+            'counts': "{0}\t0\t{1}\t{2}/{5}\t{3}/{5}\t{4}/{5}\t".format(
+                snpcall, refcall, callstring.count(b'Y'), covstring.count(b'Y') + covstring.count(b'-'),
+                propstring.count(b'Y') + propstring.count(b'-'), genome_count) + "{0}\t{1}\t{2}\t{3}\t0\t{4}\t".format(
+                *( simple_calls.count(call) for call in b'ACGTN' )),
+            'status': "{0}\t{1}\t".format(str(dups_call), str(consensus_check)),
+            'filters': "{0}\t{1}\t{2}\t".format(callstring.decode(), covstring.decode(), propstring.decode()),
+            'pattern': pattern.decode(),
+            'vcf': ( ",".join(chr(call) for call in encountered_calls) or "." ) +
+                   "\t.\tPASS\tAN={0};NS={1}\tGT:FT".format(len(encountered_calls) + 1, snpcall + refcall) +
+                   "".join("\t{0}:{1}".format(genotype, self.VCF_FILTER_NAMES[vcf_filter]) for genotype, vcf_filter in
+                           zip(genotypes, vcf_filters)) + "\n",
+            'missingdata': column_states.translate(self.STATE_MISSINGDATA_TABLE),
+            'fasta': bytes([reference_simple_call]) + pass_calls,
+            'bestsnp': snpcall > 0 and snpcall + refcall == genome_count and not dups_call and consensus_check,
+            'includeref': snpcall + refcall == genome_count and not dups_call and consensus_check,
+            'missingdata_line': snpcall > 0 and not dups_call,
+        }
+
+    def _format_matrix_contig(self, current_contig, matrix_formats, pattern_registry, first_position=1,
+                              last_position=None, position_offset=0):
+        """
+        Writes the matrix and VCF lines for every position of the contig,
+        or of a range of it, and adds its positions to the fasta outputs.  The output is exactly
+        what _format_matrix_line would make one position at a time, but the
+        work is done for a window of positions and all samples at once: the
+        stats with lanes, and everything else by summarizing each distinct
+        column of sample states once.  Only the raw calls are handled per
+        position, and only for lines that are written.
+
+        Args:
+            current_contig (str): Unique contig description.
+            matrix_formats (list): The output formats, as for send_to_matrix_handles.
+            pattern_registry (PatternRegistry): Assigns the Pattern# of the matrix outputs.
+            first_position (int): Optional 1-indexed first position number.
+            last_position (int): Optional last position number, inclusive, or None for the end of the contig.
+            position_offset (int): Optional number to add to the position numbers written, for when the
+                genomes only hold a window of the contig.
+        """
+        genome_count = len(self._genomes)
+        failed_genome_tabs = "\t" * len(self._failed_genomes)
+        nickname_indices = {}
+        for genome_index, genome in enumerate(self._genomes):
+            nickname_indices.setdefault(genome.nickname(), []).append(genome_index)
+        # Genomes with the same identifier share a fasta contig, and the last one wins.
+        fasta_indices = {'Reference': 0}
+        for genome_index, genome in enumerate(self._genomes):
+            fasta_indices[genome.identifier()] = genome_index + 1
+        all_matrices = any(matrix_format['dataformat'] == 'matrix' for matrix_format in matrix_formats)
+        column_summaries = {}
+        if last_position is None:
+            last_position = self._reference.get_contig_length(current_contig)
+        for window_start in range(first_position, last_position + 1, self.MATRIX_WINDOW_SIZE):
+            window_end = min(last_position, window_start + self.MATRIX_WINDOW_SIZE - 1)
+            window_length = window_end - window_start + 1
+            reference_calls, other_reference_calls = self._reference.get_value_bytes(window_start, window_end,
+                                                                                      current_contig, 'X')
+            reference_simple_calls = reference_calls.translate(Genome.SIMPLE_CALL_TABLE)
+            dups_mask = self._reference.get_dups_mask(window_start, window_end, current_contig)
+            sample_states = []
+            sample_calls = []
+            other_sample_calls = {}
+            for genome_index, genome in enumerate(self._genomes):
+                states, calls, other_calls = self._get_matrix_states(genome, current_contig, window_start,
+                                                                     window_end)
+                sample_states.append(states)
+                sample_calls.append(calls)
+                for offset, call in other_calls.items():
+                    other_sample_calls.setdefault(offset, []).append(( genome_index, call ))
+            self._record_matrix_window_stats(current_contig, reference_simple_calls, dups_mask, sample_states,
+                                             nickname_indices)
+            # Sample-major, so every window_length-th byte starting at an offset is the column at that offset.
+            sample_states = b''.join(sample_states)
+            sample_calls = b''.join(sample_calls)
+            if len(column_summaries) > self.MATRIX_WINDOW_SIZE:
+                column_summaries.clear()
+            fasta_columns = dict(( matrix_format_index, [] ) for matrix_format_index, matrix_format in
+                                 enumerate(matrix_formats) if matrix_format['dataformat'] == 'fasta')
+            for offset in range(window_length):
+                current_pos = window_start + offset + position_offset
+                dups_call = dups_mask[offset] == 1
+                column_states = sample_states[offset::window_length]
+                column_key = ( reference_simple_calls[offset], dups_call, column_states )
+                column_summary = column_summaries.get(column_key)
+                if column_summary is None:
+                    column_summary = self._summarize_matrix_column(reference_simple_calls[offset], dups_call,
+                                                                   column_states, nickname_indices)
+                    column_summaries[column_key] = column_summary
+                reference_call = other_reference_calls.get(offset, chr(reference_calls[offset]))
+                if all_matrices:
+                    pattern_text = "'{0}'\t{1}\n".format(column_summary['pattern'],
+                                                         pattern_registry.get_number(column_summary['pattern']))
+                calls_text = None
+                for matrix_format_index, matrix_format in enumerate(matrix_formats):
+                    matrix_filter = matrix_format['filter']
+                    if matrix_filter in ( 'bestsnp', 'includeref' ) and not column_summary[matrix_filter] or (
+                            matrix_filter == 'missingdata' and not column_summary['missingdata_line'] ):
+                        continue
+                    if matrix_format['dataformat'] == 'matrix':
+                        if calls_text is None:
+                            column_calls = sample_calls[offset::window_length].decode('latin-1')
+                            if offset in other_sample_calls:
+                                column_calls = list(column_calls)
+                                for genome_index, call in other_sample_calls[offset]:
+                                    column_calls[genome_index] = call
+                            calls_text = "\t".join(column_calls) + "\t" if genome_count > 0 else ""
+                        line_to_write = "{0}::{1}\t{2}\t".format(current_contig, current_pos, reference_call)
+                        if matrix_filter in ( 'allcallable', 'bestsnp', 'includeref' ):
+                            line_to_write += calls_text
+                        elif matrix_filter == 'missingdata':
+                            line_to_write += "".join(
+                                ( call if missingdata_call == ord('*') else chr(missingdata_call) ) + "\t" for
+                                call, missingdata_call in zip(column_calls, column_summary['missingdata']))
+                        line_to_write += failed_genome_tabs + column_summary['counts'] + "{0}\t{1}\t".format(
+                            current_contig, current_pos) + column_summary['status']
+                        if matrix_filter in ( 'allcallable', 'missingdata' ):
+                            line_to_write += column_summary['filters']
+                        matrix_format['handle'].write(line_to_write + pattern_text)
+                    elif matrix_format['dataformat'] == 'vcf':
+                        matrix_format['handle'].write("{0}\t{1}\t.\t{2}\t".format(current_contig, current_pos,
+                                                                                   reference_call) + column_summary['vcf'])
+                    elif matrix_format['dataformat'] == 'fasta' and matrix_filter in (
+                            'bestsnp', 'includeref', 'missingdata' ):
+                        fasta_columns[matrix_format_index].append(column_summary['fasta'])
+            for matrix_format_index, matrix_format in enumerate(matrix_formats):
+                if fasta_columns.get(matrix_format_index):
+                    fasta_data = b''.join(fasta_columns[matrix_format_index])
+                    for genome_identifier, fasta_index in fasta_indices.items():
+                        matrix_format['fastadata'].append_contig(
+                            fasta_data[fasta_index::genome_count + 1].decode('latin-1'), genome_identifier)
+
+    def _format_matrix_shard(self, current_contig, first_position, last_position, matrix_format_choices):
+        """
+        Runs _format_matrix_contig on a range of positions in a worker
+        process, with the output kept in memory so that it can be sent back
+        and merged by _merge_matrix_shard.  The worker has its own copy of
+        the collection, so its stats are reset for every shard.
+
+        Args:
+            current_contig (str): Unique contig description.
+            first_position (int): 1-indexed first position number.
+            last_position (int): Last position number, inclusive.
+            matrix_format_choices (list): The dataformat and filter of each output format.
+
+        Returns:
+            tuple: The matrix and VCF text of each format, the fasta data of
+            each format by contig, the patterns in order of their Pattern# in
+            this shard, and the contig and sample stats.
+        """
+        from io import StringIO
+
+        self._contig_stats = {}
+        self._sample_stats = {}
+        matrix_formats = [{'dataformat': dataformat, 'filter': matrix_filter, 'handle': StringIO(),
+                           'fastadata': GenomeStatus()} for dataformat, matrix_filter in matrix_format_choices]
+        pattern_registry = PatternRegistry()
+        self._format_matrix_contig(current_contig, matrix_formats, pattern_registry, first_position, last_position)
+        fasta_data = [dict(( fasta_contig, ''.join(matrix_format['fastadata'].get_value(1, -1, fasta_contig)) ) for
+                           fasta_contig in matrix_format['fastadata'].get_contigs()) for matrix_format in matrix_formats]
+        return [matrix_format['handle'].getvalue() for matrix_format in
+                matrix_formats], fasta_data, pattern_registry.get_patterns(), self._contig_stats, self._sample_stats
+
+    def _merge_matrix_shard(self, matrix_formats, pattern_registry, shard_output):
+        """
+        Writes the output of _format_matrix_shard to the real outputs.
+        Shards must be merged in reference order, so that merging the
+        shard's patterns into the run's registry numbers them as a single
+        pass would have, and the shard's Pattern# values only need
+        replacing with the run's.
+
+        Args:
+            matrix_formats (list): The output formats, as for send_to_matrix_handles.
+            pattern_registry (PatternRegistry): Assigns the Pattern# of the matrix outputs.
+            shard_output (tuple): As returned by _format_matrix_shard.
+        """
+        ( format_text, fasta_data, patterns, contig_stats, sample_stats ) = shard_output
+        pattern_remap = pattern_registry.merge(patterns)
+        for matrix_format, shard_text, shard_fasta_data in zip(matrix_formats, format_text, fasta_data):
+            if matrix_format['dataformat'] == 'matrix':
+                matrix_format['handle'].writelines(
+                    PatternRegistry.remap_matrix_lines(shard_text.splitlines(True), pattern_remap))
+            elif matrix_format['dataformat'] == 'vcf':
+                matrix_format['handle'].write(shard_text)
+            elif matrix_format['dataformat'] == 'fasta':
+                for fasta_contig, fasta_contig_data in shard_fasta_data.items():
+                    matrix_format['fastadata'].append_contig(fasta_contig_data, fasta_contig)
+        self.merge_stats(contig_stats, sample_stats)
+
+    def get_matrix_windows(self):
         """
-        Writes headers and handles per-matrix logic.  Calls _write_matrix_line
-        to handle the per-line computation and analysis.
+        Returns:
+            list: The ( contig, first position, last position ) of every
+            MATRIX_WINDOW_SIZE positions of the reference, in matrix order.
         """
+        matrix_windows = []
+        for current_contig in self.get_contigs():
+            contig_length = self._reference.get_contig_length(current_contig)
+            for first_position in range(1, contig_length + 1, self.MATRIX_WINDOW_SIZE):
+                matrix_windows.append(( current_contig, first_position,
+                                        min(contig_length, first_position + self.MATRIX_WINDOW_SIZE - 1) ))
+        return matrix_windows
+
+    def send_to_matrix_handles(self, matrix_formats, num_threads=1, window_genomes=None):
+        """
+        Writes headers and handles per-matrix logic.  Calls
+        _format_matrix_contig to handle the per-line computation and analysis.
+        With more than one thread, the contigs are split into shards of at
+        most MATRIX_SHARD_SIZE positions, which are computed in a pool of
+        worker processes and merged back in order.
+        Given window_genomes, the matrices are streamed instead: the genomes
+        of the collection only need their metadata, and window_genomes must
+        yield, for each window of get_matrix_windows in order, the genomes
+        holding the data of that window, as positions starting at 1, in the
+        order they were added to the collection.  Only one window of the
+        genomes has to be in memory at a time.
+        """
+        self._write_matrix_headers(matrix_formats)
+        pattern_registry = PatternRegistry()
+        if window_genomes is not None:
+            for ( current_contig, first_position, last_position ), genomes in zip(self.get_matrix_windows(),
+                                                                                  window_genomes):
+                window_collection = GenomeCollection()
+                window_collection.set_reference(self._reference.get_window(first_position, last_position,
+                                                                           current_contig))
+                for genome in genomes:
+                    window_collection.add_genome(genome)
+                window_collection._failed_genomes = self._failed_genomes
+                window_collection._format_matrix_contig(current_contig, matrix_formats, pattern_registry,
+                                                        position_offset=first_position - 1)
+                self.merge_stats(window_collection._contig_stats, window_collection._sample_stats)
+        elif num_threads > 1:
+            from multiprocessing import Pool
+
+            matrix_format_choices = [( matrix_format['dataformat'], matrix_format['filter'] ) for
+                                     matrix_format in matrix_formats]
+            shards = []
+            for current_contig in self.get_contigs():
+                contig_length = self._reference.get_contig_length(current_contig)
+                for first_position in range(1, contig_length + 1, self.MATRIX_SHARD_SIZE):
+                    shards.append(( current_contig, first_position,
+                                    min(contig_length, first_position + self.MATRIX_SHARD_SIZE - 1),
+                                    matrix_format_choices ))
+            with Pool(num_threads, _set_matrix_shard_collection, ( self, )) as pool:
+                for shard_output in pool.imap(_format_matrix_shard, shards):
+                    self._merge_matrix_shard(matrix_formats, pattern_registry, shard_output)
+        else:
+            for current_contig in self.get_contigs():
+                self._format_matrix_contig(current_contig, matrix_formats, pattern_registry)
+        for matrix_format in matrix_formats:
+            if matrix_format['dataformat'] == 'fasta':
+                matrix_format['fastadata'].send_to_fasta_handle(matrix_format['handle'])
+
+    def _write_matrix_headers(self, matrix_formats):
+        """ Writes the headers of the matrix and VCF outputs, and sets up the fasta outputs. """
         for matrix_format in matrix_formats:
             if matrix_format['dataformat'] == 'matrix':
                 matrix_format['handle'].write("LocusID\tReference\t")
@@ -1095,27 +2895,12 @@ class GenomeCollection(CollectionStatistics):
                 for genome in self._genomes:
                     matrix_format['handle'].write("\t" + genome.identifier())
                 matrix_format['handle'].write("\n")
-        # Key None stores next unused
-        pattern_data = {None: 1}
-        for current_contig in self.get_contigs():
-            for current_pos in range(1, self._reference.get_contig_length(current_contig) + 1):
-                self._format_matrix_line(current_contig, current_pos, matrix_formats, pattern_data)
-                for matrix_format in matrix_formats:
-                    if matrix_format['dataformat'] == 'matrix' and matrix_format['linetowrite'] is not None:
-                        matrix_format['handle'].write(matrix_format['linetowrite'])
-                        matrix_format['linetowrite'] = ''
-                    if matrix_format['dataformat'] == 'vcf' and matrix_format['linetowrite'] is not None:
-                        matrix_format['handle'].write(matrix_format['linetowrite'])
-                        matrix_format['linetowrite'] = ''
-        for matrix_format in matrix_formats:
-            if matrix_format['dataformat'] == 'fasta':
-                matrix_format['fastadata'].send_to_fasta_handle(matrix_format['handle'])
 
-    def write_to_matrices(self, matrix_formats):
+    def write_to_matrices(self, matrix_formats, num_threads=1, window_genomes=None):
         """ Opens files for writing; abstracted for flexibility/testing. """
         for matrix_format in matrix_formats:
             matrix_format['handle'] = open(matrix_format['filename'], 'w')
-        self.send_to_matrix_handles(matrix_formats)
+        self.send_to_matrix_handles(matrix_formats, num_threads, window_genomes)
         for matrix_format in matrix_formats:
             matrix_format['handle'].close()
 
@@ -1193,14 +2978,594 @@ class GenomeCollection(CollectionStatistics):
         # print( self._stats._sample_stats )
 
 
+# The collection being written by send_to_matrix_handles, in each of its worker processes.
+_matrix_shard_collection = None
+
+
+def _set_matrix_shard_collection(collection):
+    """ Pool initializer for GenomeCollection.send_to_matrix_handles. """
+    global _matrix_shard_collection
+    _matrix_shard_collection = collection
+
+
+def _format_matrix_shard(shard):
+    """ Pool worker for GenomeCollection.send_to_matrix_handles. """
+    return _matrix_shard_collection._format_matrix_shard(*shard)
+
+
+# The fixed start of a gzip member header with extra fields, and the extra subfield that makes it a BGZF block.
+_GZIP_MAGIC = b'\x1f\x8b'
+_BGZF_SUBFIELD = b'BC\x02\x00'
+
+
+def _is_bgzf_header(block_header):
+    """
+    Args:
+        block_header (bytes): The first bytes of a gzip member, at least up to the end of its extra field.
+
+    Returns:
+        bool: True if the member is a BGZF block, which carries its own size in a 'BC' extra subfield.
+    """
+    import struct
+
+    if len(block_header) < 12 or block_header[:2] != _GZIP_MAGIC or not block_header[3] & 4:
+        return False
+    extra_length = struct.unpack('<H', block_header[10:12])[0]
+    extra_offset = 12
+    while extra_offset + 4 <= min(len(block_header), 12 + extra_length):
+        if block_header[extra_offset:extra_offset + 4] == _BGZF_SUBFIELD:
+            return True
+        extra_offset += 4 + struct.unpack('<H', block_header[extra_offset + 2:extra_offset + 4])[0]
+    return False
+
+
+def _inflate_bgzf_block(block_data, file_path):
+    """
+    Decompresses one BGZF block, as read by BGZFReader, and checks it
+    against its trailer.
+    """
+    import struct
+    import zlib
+
+    extra_length = struct.unpack('<H', block_data[10:12])[0]
+    inflated_data = zlib.decompress(block_data[12 + extra_length:-8], -15)
+    ( block_crc, block_size ) = struct.unpack('<II', block_data[-8:])
+    if block_size != len(inflated_data) or block_crc != zlib.crc32(inflated_data) & 0xffffffff:
+        raise MalformedInputFile(file_path, "BGZF block fails its CRC or size check")
+    return inflated_data
+
+
+class BGZFReader(io.RawIOBase):
+    """
+    Reads a BGZF file, the blocked gzip written by bgzip, decompressing
+    the blocks ahead of the reader in a pool of threads.  zlib gives up the
+    GIL while it inflates, so the blocks really are decompressed in
+    parallel while the reader parses the ones before them.
+    Meant to be wrapped in an io.BufferedReader, as by open_input_file.
+    """
+
+    def __init__(self, file_path, num_threads=2):
+        """
+        Attributes:
+            _pending_blocks (deque): Futures of the decompressed blocks not yet read, in file order.
+            _current_block (bytes): The decompressed block being read from.
+            _block_offset (int): How much of _current_block has been read.
+        """
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        io.RawIOBase.__init__(self)
+        self._file_path = file_path
+        self._file_handle = open(file_path, 'rb')
+        self._executor = ThreadPoolExecutor(max(1, num_threads))
+        self._max_pending = 4 * max(1, num_threads)
+        self._pending_blocks = deque()
+        self._current_block = b''
+        self._block_offset = 0
+        self._end_of_file = False
+
+    def _read_block(self):
+        """ Returns the next whole compressed block from the file, or None at the end of it. """
+        import struct
+
+        block_header = self._file_handle.read(12)
+        if block_header == b'':
+            return None
+        if len(block_header) < 12:
+            raise MalformedInputFile(self._file_path, "BGZF file is truncated")
+        extra_length = struct.unpack('<H', block_header[10:12])[0]
+        block_header += self._file_handle.read(extra_length)
+        if not _is_bgzf_header(block_header):
+            raise MalformedInputFile(self._file_path, "gzip member is not a BGZF block")
+        extra_offset = 12
+        while block_header[extra_offset:extra_offset + 4] != _BGZF_SUBFIELD:
+            extra_offset += 4 + struct.unpack('<H', block_header[extra_offset + 2:extra_offset + 4])[0]
+        block_size = struct.unpack('<H', block_header[extra_offset + 4:extra_offset + 6])[0] + 1
+        block_data = block_header + self._file_handle.read(block_size - len(block_header))
+        if len(block_data) < block_size:
+            raise MalformedInputFile(self._file_path, "BGZF file is truncated")
+        return block_data
+
+    def seek_virtual(self, virtual_offset):
+        """
+        Moves to a virtual file offset, as found in tabix and CSI indexes:
+        the file offset of a block shifted up 16 bits, plus the offset into
+        its decompressed data.  Must be called before any buffered reader
+        wrapping this one has read anything.
+        """
+        for pending_block in self._pending_blocks:
+            pending_block.cancel()
+        self._pending_blocks.clear()
+        self._file_handle.seek(virtual_offset >> 16)
+        self._end_of_file = False
+        self._current_block = b''
+        self._queue_blocks()
+        if self._pending_blocks:
+            self._current_block = self._pending_blocks.popleft().result()
+        self._block_offset = virtual_offset & 0xffff
+
+    def _queue_blocks(self):
+        while not self._end_of_file and len(self._pending_blocks) < self._max_pending:
+            block_data = self._read_block()
+            if block_data is None:
+                self._end_of_file = True
+            else:
+                self._pending_blocks.append(self._executor.submit(_inflate_bgzf_block, block_data, self._file_path))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._block_offset >= len(self._current_block):
+            self._queue_blocks()
+            if not self._pending_blocks:
+                return 0
+            self._current_block = self._pending_blocks.popleft().result()
+            self._block_offset = 0
+        read_length = min(len(buffer), len(self._current_block) - self._block_offset)
+        buffer[:read_length] = self._current_block[self._block_offset:self._block_offset + read_length]
+        self._block_offset += read_length
+        return read_length
+
+    def close(self):
+        if not self.closed:
+            for pending_block in self._pending_blocks:
+                pending_block.cancel()
+            self._executor.shutdown()
+            self._file_handle.close()
+        io.RawIOBase.close(self)
+
+
+def open_input_file(file_path, mode='r', num_threads=1):
+    """
+    Opens an input file for reading, decompressing it as it is read if it
+    is gzip compressed, whatever its name.  Given more than one thread, a
+    BGZF file has its blocks decompressed in parallel by a BGZFReader.
+
+    Args:
+        file_path (str): The file to open.
+        mode (str): 'r' for text or 'rb' for bytes.
+        num_threads (int): Threads that may decompress BGZF blocks.
+
+    Returns:
+        file object: The opened file.  Plain and gzip files are seekable.
+    """
+    import gzip
+
+    with open(file_path, 'rb') as file_handle:
+        file_header = file_handle.read(512)
+    if file_header[:2] != _GZIP_MAGIC:
+        return open(file_path, mode)
+    if num_threads > 1 and _is_bgzf_header(file_header):
+        input_handle = io.BufferedReader(BGZFReader(file_path, num_threads))
+    else:
+        input_handle = gzip.open(file_path, 'rb')
+    if 'b' in mode:
+        return input_handle
+    return io.TextIOWrapper(input_handle)
+
+
+class TabixIndex(object):
+    """
+    A tabix (.tbi) or CSI (.csi) index of a BGZF file, as written by tabix
+    or bcftools index, read in so that the records of a region can be found
+    without reading the records before them.
+    Both split each contig into nested bins, and list for each bin the
+    chunks of the file, as virtual offsets, that hold records overlapping
+    it.  Tabix also keeps the smallest offset of any record overlapping
+    each 16 kbp window, and CSI the smallest offset for each bin.
+    """
+
+    def __init__(self, index_path):
+        """
+        Attributes:
+            _contig_indexes (dict): Contig names to their reference number in the index.
+            _bin_chunks (list): For each contig, bin numbers to a list of ( first, last ) virtual offsets.
+            _min_offsets (list): For each contig, the linear index of tabix or the bin offsets of CSI.
+        """
+        import gzip
+        import struct
+
+        self._index_path = index_path
+        self._contig_indexes = {}
+        self._bin_chunks = []
+        self._min_offsets = []
+        with gzip.open(index_path, 'rb') as index_handle:
+            index_data = index_handle.read()
+        try:
+            if index_data[:4] == b'TBI\x01':
+                self._is_csi = False
+                ( self._min_shift, self._depth ) = ( 14, 5 )
+                contig_count = struct.unpack_from('<i', index_data, 4)[0]
+                names_length = struct.unpack_from('<i', index_data, 32)[0]
+                contig_names = index_data[36:36 + names_length]
+                data_offset = 36 + names_length
+            elif index_data[:4] == b'CSI\x01':
+                self._is_csi = True
+                ( self._min_shift, self._depth, aux_length ) = struct.unpack_from('<iii', index_data, 4)
+                # The auxiliary data of a tabix-style CSI holds the same header as a .tbi, names and all.
+                names_length = struct.unpack_from('<i', index_data, 40)[0] if aux_length >= 28 else 0
+                contig_names = index_data[44:44 + names_length]
+                data_offset = 16 + aux_length
+                contig_count = struct.unpack_from('<i', index_data, data_offset)[0]
+                data_offset += 4
+            else:
+                raise MalformedInputFile(index_path, "not a tabix or CSI index")
+            for contig_number, contig_name in enumerate(contig_names.split(b'\x00')[:contig_count]):
+                self._contig_indexes[contig_name.decode()] = contig_number
+            for _ in range(contig_count):
+                bin_chunks = {}
+                min_offsets = {}
+                bin_count = struct.unpack_from('<i', index_data, data_offset)[0]
+                data_offset += 4
+                for _ in range(bin_count):
+                    if self._is_csi:
+                        ( bin_number, min_offsets_for_bin, chunk_count ) = struct.unpack_from('<IQi', index_data,
+                                                                                              data_offset)
+                        min_offsets[bin_number] = min_offsets_for_bin
+                        data_offset += 16
+                    else:
+                        ( bin_number, chunk_count ) = struct.unpack_from('<Ii', index_data, data_offset)
+                        data_offset += 8
+                    chunk_offsets = struct.unpack_from('<{0}Q'.format(2 * chunk_count), index_data, data_offset)
+                    bin_chunks[bin_number] = list(zip(chunk_offsets[0::2], chunk_offsets[1::2]))
+                    data_offset += 16 * chunk_count
+                if not self._is_csi:
+                    interval_count = struct.unpack_from('<i', index_data, data_offset)[0]
+                    min_offsets = struct.unpack_from('<{0}Q'.format(interval_count), index_data, data_offset + 4)
+                    data_offset += 4 + 8 * interval_count
+                self._bin_chunks.append(bin_chunks)
+                self._min_offsets.append(min_offsets)
+        except struct.error:
+            raise MalformedInputFile(index_path, "index is truncated")
+
+    @staticmethod
+    def get_index_path(file_path):
+        """ The path of the .tbi or .csi index beside a BGZF file, or None if it has neither. """
+        import os
+
+        with open(file_path, 'rb') as file_handle:
+            if not _is_bgzf_header(file_handle.read(512)):
+                return None
+        for index_extension in ( '.tbi', '.csi' ):
+            if os.path.isfile(file_path + index_extension):
+                return file_path + index_extension
+        return None
+
+    def _bin_overlaps(self, bin_number, first_position, last_position):
+        """ True if the bin overlaps the 1-indexed region; False for the pseudo-bin of index metadata. """
+        level_start = 0
+        for level in range(self._depth + 1):
+            if bin_number < level_start + ( 1 << ( 3 * level ) ):
+                shift = self._min_shift + 3 * ( self._depth - level )
+                return ( first_position - 1 ) >> shift <= bin_number - level_start <= ( last_position - 1 ) >> shift
+            level_start += 1 << ( 3 * level )
+        return False
+
+    def get_start_offset(self, contig_name, first_position, last_position=None):
+        """
+        Args:
+            contig_name (str): Unique contig description.
+            first_position (int): 1-indexed first position of the region.
+            last_position (int): 1-indexed last position of the region, or None for the end of the contig.
+
+        Returns:
+            int: The virtual offset to start reading the records of the region
+            from, or None if the index has no records in it.  Records before
+            the region may follow it, and reading stops at the first record
+            past the region.
+        """
+        contig_number = self._contig_indexes.get(contig_name)
+        if contig_number is None:
+            return None
+        if last_position is None:
+            last_position = 1 << ( self._min_shift + 3 * self._depth )
+        min_offsets = self._min_offsets[contig_number]
+        if self._is_csi:
+            # The smallest bin holding the first position that the index has, as htslib does.
+            bin_number = ( ( 1 << ( 3 * self._depth ) ) - 1 ) // 7 + ( ( first_position - 1 ) >> self._min_shift )
+            while bin_number > 0 and bin_number not in min_offsets:
+                bin_number = ( bin_number - 1 ) >> 3
+            min_offset = min_offsets.get(bin_number, 0)
+        else:
+            linear_window = ( first_position - 1 ) >> self._min_shift
+            min_offset = min_offsets[min(linear_window, len(min_offsets) - 1)] if min_offsets else 0
+        start_offset = None
+        for bin_number, bin_chunks in self._bin_chunks[contig_number].items():
+            if not self._bin_overlaps(bin_number, first_position, last_position):
+                continue
+            for chunk_start, chunk_end in bin_chunks:
+                if chunk_end > min_offset and ( start_offset is None or max(chunk_start, min_offset) < start_offset ):
+                    start_offset = max(chunk_start, min_offset)
+        return start_offset
+
+
+class FastaIndex(object):
+    """
+    A samtools faidx index (.fai) of a fasta file: for each contig, its
+    length, the file offset of its first base, and the bases and bytes on
+    each of its lines.  With it, a contig or any range of one is read by
+    seeking straight to it and dropping the line breaks from the whole
+    range at once.
+    """
+
+    # The characters that _import_fasta_line takes as calls.
+    CALL_CHARACTERS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.-'
+
+    def __init__(self, fasta_filename, contig_entries, contig_prefix=""):
+        """
+        Args:
+            fasta_filename (str): The indexed fasta file.
+            contig_entries (list): A ( name, length, offset, line bases, line bytes ) tuple per contig, as in the .fai.
+            contig_prefix (str): The prefix to remove from the contig names.
+        """
+        self._fasta_filename = fasta_filename
+        self._contig_entries = contig_entries
+        self._contigs = {}
+        for contig_entry in contig_entries:
+            self._contigs[contig_entry[0][len(contig_prefix):]] = contig_entry
+        self._file_handle = None
+        self._file_data = None
+
+    @staticmethod
+    def get_index_filename(fasta_filename):
+        return fasta_filename + ".fai"
+
+    @staticmethod
+    def load(fasta_filename, contig_prefix=""):
+        """
+        Reuses the .fai beside the fasta file if it is at least as new as
+        the fasta, or else builds the index and saves it there, if the
+        directory can be written to.
+
+        Args:
+            fasta_filename (str): fasta file to index
+            contig_prefix (str): the prefix will be removed from the contig names
+
+        Returns:
+            FastaIndex: The index, or None if the file is compressed, or has
+            lines that samtools could not index or that _import_fasta_line
+            would read differently, or a contig name without the prefix.
+        """
+        import os
+
+        with open(fasta_filename, 'rb') as fasta_handle:
+            if fasta_handle.read(2) == _GZIP_MAGIC:
+                return None
+        index_filename = FastaIndex.get_index_filename(fasta_filename)
+        contig_entries = None
+        if os.path.isfile(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(fasta_filename):
+            contig_entries = FastaIndex._read_index_file(index_filename)
+        if contig_entries is None:
+            contig_entries = FastaIndex._index_fasta_file(fasta_filename)
+            if contig_entries is None:
+                return None
+            FastaIndex._write_index_file(index_filename, contig_entries)
+        for contig_entry in contig_entries:
+            if not contig_entry[0].startswith(contig_prefix) or contig_entry[0] == contig_prefix:
+                return None
+        return FastaIndex(fasta_filename, contig_entries, contig_prefix)
+
+    def save(self):
+        """ Saves the index as the .fai beside the fasta file. """
+        FastaIndex._write_index_file(FastaIndex.get_index_filename(self._fasta_filename), self._contig_entries)
+
+    @staticmethod
+    def _read_index_file(index_filename):
+        """ The entries of a .fai file, or None if it cannot be read. """
+        contig_entries = []
+        try:
+            with open(index_filename, 'r') as index_handle:
+                for index_line in index_handle:
+                    index_fields = index_line.rstrip("\n").split("\t")
+                    contig_entries.append(tuple([index_fields[0]] + [int(field) for field in index_fields[1:5]]))
+        except ( OSError, ValueError, IndexError ):
+            return None
+        return contig_entries
+
+    @staticmethod
+    def _write_index_file(index_filename, contig_entries):
+        """ Saves the entries as a .fai, through a temporary file so that a reader never sees half of one. """
+        import os
+        import tempfile
+
+        try:
+            ( index_handle, temporary_filename ) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_filename)))
+        except OSError:
+            return
+        try:
+            with os.fdopen(index_handle, 'w') as index_file:
+                for contig_entry in contig_entries:
+                    index_file.write("\t".join(str(field) for field in contig_entry) + "\n")
+            os.chmod(temporary_filename, 0o644)
+            os.replace(temporary_filename, index_filename)
+        except OSError:
+            os.remove(temporary_filename)
+
+    @staticmethod
+    def _index_fasta_file(fasta_filename):
+        """
+        Builds the entries of a .fai, as samtools faidx would.
+
+        Returns:
+            list: A ( name, length, offset, line bases, line bytes ) tuple per
+            contig, or None if the file cannot be indexed.
+        """
+        import re
+
+        contig_entries = []
+        contig_names = set()
+        current_entry = None
+        contig_ended = False
+        file_offset = 0
+        with open(fasta_filename, 'rb') as fasta_handle:
+            for line_from_fasta in fasta_handle:
+                if line_from_fasta[0:1] == b'>':
+                    contig_match = re.match(br'^>([^\s]+)(?:\s|$)', line_from_fasta)
+                    if contig_match is None or contig_match.group(1) in contig_names:
+                        return None
+                    contig_names.add(contig_match.group(1))
+                    if current_entry is not None:
+                        contig_entries.append(tuple(current_entry))
+                    current_entry = [contig_match.group(1).decode(), 0, file_offset + len(line_from_fasta), 0, 0]
+                    contig_ended = False
+                else:
+                    line_bases = line_from_fasta.rstrip()
+                    line_ending = line_from_fasta[len(line_bases):]
+                    if line_ending not in ( b'\n', b'\r\n', b'' ):
+                        return None
+                    if len(line_bases) > 0:
+                        if current_entry is None or contig_ended or line_bases.translate(None, FastaIndex.CALL_CHARACTERS):
+                            return None
+                        if current_entry[3] == 0:
+                            current_entry[3:5] = [len(line_bases), len(line_from_fasta)]
+                        elif len(line_bases) > current_entry[3] or (
+                                line_ending and len(line_from_fasta) - len(line_bases) != current_entry[4] - current_entry[3] ):
+                            return None
+                        contig_ended = len(line_bases) < current_entry[3]
+                        current_entry[1] += len(line_bases)
+                    else:
+                        # Blank lines may only follow the last line of a contig.
+                        contig_ended = True
+                file_offset += len(line_from_fasta)
+        if current_entry is not None:
+            contig_entries.append(tuple(current_entry))
+        return contig_entries
+
+    def open(self, use_mmap=False):
+        """
+        Opens the fasta file for get_calls, memory-mapped if use_mmap, and
+        returns the index, so that it can be used in a with statement.
+        Without this, get_calls opens and closes the file on every call.
+        """
+        import mmap
+        import os
+
+        self.close()
+        self._file_handle = open(self._fasta_filename, 'rb')
+        if use_mmap and os.path.getsize(self._fasta_filename) > 0:
+            self._file_data = mmap.mmap(self._file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def close(self):
+        if self._file_data is not None:
+            self._file_data.close()
+            self._file_data = None
+        if self._file_handle is not None:
+            self._file_handle.close()
+            self._file_handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_contigs(self):
+        """
+        Returns:
+            list: The contig names, without the prefix, in file order.
+        """
+        return [contig_name for contig_name, contig_entry in sorted(self._contigs.items(),
+                                                                    key=lambda item: item[1][2])]
+
+    def get_contig_length(self, contig_name):
+        return self._contigs[contig_name][1]
+
+    def get_calls(self, contig_name, first_position=1, last_position=None):
+        """
+        Args:
+            contig_name (str): Unique contig description, without the prefix.
+            first_position (int): 1-indexed first position number.
+            last_position (int): Optional last position number, inclusive, or None for the end of the contig.
+
+        Returns:
+            str: The calls from first_position to last_position, or to the end of the contig if it is shorter.
+
+        Raises:
+            InvalidContigName: If the contig is not in the index.
+        """
+        return self.get_call_bytes(contig_name, first_position, last_position).decode('latin-1')
+
+    def get_call_bytes(self, contig_name, first_position=1, last_position=None):
+        """
+        The bytes version of get_calls, for copying calls without decoding them.
+
+        Returns:
+            bytes: The calls from first_position to last_position, or to the end of the contig if it is shorter.
+        """
+        if contig_name not in self._contigs:
+            raise InvalidContigName(contig_name, self.get_contigs())
+        ( _, contig_length, contig_offset, line_bases, line_bytes ) = self._contigs[contig_name]
+        if last_position is None or last_position > contig_length:
+            last_position = contig_length
+        if first_position > last_position:
+            return b''
+        first_offset = contig_offset + ( first_position - 1 ) // line_bases * line_bytes + (
+            first_position - 1 ) % line_bases
+        last_offset = contig_offset + ( last_position - 1 ) // line_bases * line_bytes + (
+            last_position - 1 ) % line_bases + 1
+        if self._file_data is not None:
+            range_data = self._file_data[first_offset:last_offset]
+        elif self._file_handle is not None:
+            self._file_handle.seek(first_offset)
+            range_data = self._file_handle.read(last_offset - first_offset)
+        else:
+            with open(self._fasta_filename, 'rb') as fasta_handle:
+                fasta_handle.seek(first_offset)
+                range_data = fasta_handle.read(last_offset - first_offset)
+        return range_data.translate(None, b'\r\n')
+
+
 class VCFRecord(object):
-    """ VCF parser, object representing an input VCF being read. """
+    """
+    VCF parser, object representing an input VCF being read.
+    A record is only split into its columns when it is fetched; the INFO
+    column and each sample column are split the first time they are asked
+    for, and the FORMAT key positions are worked out once per distinct
+    FORMAT string rather than once per record.
+    """
 
-    def __init__(self, file_path):
+    RECORD_BATCH_SIZE = 4096
+    # index_positions has one offset per 2 ** INDEX_WINDOW_SHIFT positions, like the linear index of tabix.
+    INDEX_WINDOW_SHIFT = 14
+
+    def __init__(self, file_path, num_threads=1):
+        """
+        Args:
+            file_path (str): The VCF to read, which may be gzip or BGZF compressed.
+            num_threads (int): Threads that may decompress a BGZF file.  A file
+                opened with more than one cannot seek.
+        """
         self._file_path = file_path
-        self._file_handle = open(self._file_path, 'r')
+        self._num_threads = num_threads
+        self._file_handle = open_input_file(self._file_path, 'r', num_threads)
         self._header_list = []
         self._sample_list = []
+        self._header_indexes = {}
+        self._sample_indexes = {}
+        self._format_layouts = {}
+        self._region_index = None
         self._current_record = {}
         self._get_header_map()
 
@@ -1225,35 +3590,79 @@ class VCFRecord(object):
                 sample_headers_started = True
         if not sample_headers_started:
             self._sample_list.append('vcf_sample')
-            # print( self._header_list )
-            # print( self._sample_list )
+        for header_index, current_header in enumerate(self._header_list):
+            self._header_indexes[current_header] = header_index
+        if sample_headers_started:
+            for current_sample in self._sample_list:
+                self._sample_indexes[current_sample] = self._header_indexes[current_sample]
+
+    def _get_record_field(self, field_name):
+        """ The raw text of a column of the current record, KeyError if the record has no such column. """
+        field_index = self._header_indexes.get(field_name)
+        if field_index is None or field_index >= len(self._current_record['fields']):
+            raise KeyError(field_name)
+        return self._current_record['fields'][field_index]
 
     def _get_record_alts(self):
         """
         Get and parse the list of non-reference calls that might appear in
         one or more samples.
         """
-        self._current_record['alts'] = [self._current_record['global']['REF']]
-        if self._current_record['global']['ALT'] != '.':
-            self._current_record['alts'] += self._current_record['global']['ALT'].split(',')
+        self._current_record['ref'] = self._get_record_field('REF')
+        self._current_record['alts'] = [self._current_record['ref']]
+        alt_calls = self._get_record_field('ALT')
+        if alt_calls != '.':
+            self._current_record['alts'] += alt_calls.split(',')
 
     def _get_record_info(self):
-        self._current_record['info'] = {}
-        info_strings = self._current_record['global']['INFO'].split(';')
-        for info_string in info_strings:
-            info_keyval = info_string.split('=', 1)
-            if len(info_keyval) > 1:
-                self._current_record['info'][info_keyval[0]] = info_keyval[1]
-            else:
-                self._current_record['info'][info_keyval[0]] = None
+        """ The INFO column of the current record as a dict, split the first time it is needed. """
+        if self._current_record['info'] is None:
+            self._current_record['info'] = {}
+            for info_string in self._get_record_field('INFO').split(';'):
+                info_keyval = info_string.split('=', 1)
+                if len(info_keyval) > 1:
+                    self._current_record['info'][info_keyval[0]] = info_keyval[1]
+                else:
+                    self._current_record['info'][info_keyval[0]] = None
+        return self._current_record['info']
+
+    def _get_format_layout(self, format_string):
+        """ FORMAT keys to their index in a sample column, cached as most records share a handful of layouts. """
+        format_layout = self._format_layouts.get(format_string)
+        if format_layout is None:
+            format_layout = {}
+            for key_index, format_key in enumerate(format_string.split(':')):
+                format_layout[format_key] = key_index
+            self._format_layouts[format_string] = format_layout
+        return format_layout
+
+    def _get_sample_value(self, current_sample, format_key):
+        """
+        The value of a FORMAT key for a sample of the current record.
 
-    def _get_record_samples(self):
-        if 'FORMAT' in self._current_record['global']:
-            self._current_record['samples'] = {}
-            sample_header = self._current_record['global']['FORMAT'].split(':')
+        Returns:
+            str: The value, or None if the key is not in the FORMAT or the
+                sample column is too short to hold it.
+        """
+        sample_values = self._current_record['samples'].get(current_sample)
+        if sample_values is None:
+            sample_values = self._current_record['fields'][self._sample_indexes[current_sample]].split(':')
+            self._current_record['samples'][current_sample] = sample_values
+        key_index = self._current_record['layout'].get(format_key)
+        if key_index is None or key_index >= len(sample_values):
+            return None
+        return sample_values[key_index]
+
+    def _set_current_record(self, current_line):
+        record_fields = current_line.rstrip().split("\t")
+        self._current_record = {'fields': record_fields, 'info': None, 'samples': {}, 'layout': None}
+        self._get_record_alts()
+        format_index = self._header_indexes.get('FORMAT')
+        if format_index is not None and format_index < len(record_fields):
             for current_sample in self._sample_list:
-                self._current_record['samples'][current_sample] = dict(
-                    zip(sample_header, self._current_record['global'][current_sample].split(':')))
+                if self._sample_indexes[current_sample] >= len(record_fields):
+                    raise KeyError(current_sample)
+            self._current_record['layout'] = self._get_format_layout(record_fields[format_index])
 
     def fetch_next_record(self):
         """
@@ -1266,90 +3675,243 @@ class VCFRecord(object):
             current_line = self._file_handle.readline()
         return_value = False
         if current_line != '':
-            record_list = current_line.rstrip().split("\t")
-            self._current_record['global'] = dict(zip(self._header_list, record_list))
-            self._get_record_alts()
-            self._get_record_info()
-            self._get_record_samples()
+            self._set_current_record(current_line)
             return_value = True
-        # print( self._current_record )
         return return_value
 
+    def fetch_record_batch(self, batch_size=None):
+        """
+        Reads the next run of records in one go, for callers that would
+        otherwise fetch and query one record at a time.
+
+        Args:
+            batch_size (int): Most records to read, RECORD_BATCH_SIZE by default.
+
+        Returns:
+            list: A (contig, position, reference call, sample infos) tuple per
+                record, where sample infos lists get_sample_info for each sample
+                in get_samples order.  Empty once the file is used up.
+        """
+        if batch_size is None:
+            batch_size = self.RECORD_BATCH_SIZE
+        record_batch = []
+        while len(record_batch) < batch_size and self.fetch_next_record():
+            record_batch.append(( self.get_contig(), self.get_position(), self._current_record['ref'],
+                                  [self.get_sample_info(current_sample) for current_sample in self._sample_list] ))
+        return record_batch
+
+    def index_contigs(self):
+        """
+        Finds where the records of each contig start, so that a contig can be
+        read on its own by passing its offset to seek.
+
+        Returns:
+            dict: Contig names to the byte offset of their first record, in the decompressed data of a
+                compressed file.
+
+        Raises:
+            MalformedInputFile: If the records of a contig are not all together.
+        """
+        contig_offsets = {}
+        last_contig = None
+        file_offset = 0
+        with open_input_file(self._file_path, 'rb') as vcf_handle:
+            for current_line in vcf_handle:
+                if current_line[0:1] != b'#':
+                    current_contig = current_line.split(b'\t', 1)[0].decode()
+                    if current_contig != last_contig:
+                        if current_contig in contig_offsets:
+                            raise MalformedInputFile(self._file_path, "records of contig '{0}' are not together".format(
+                                current_contig))
+                        contig_offsets[current_contig] = file_offset
+                        last_contig = current_contig
+                file_offset += len(current_line)
+        return contig_offsets
+
+    def index_positions(self):
+        """
+        Builds an index of the file for fetch_region, when it has no tabix
+        or CSI index: like the linear index of tabix, the offset of the
+        first record at or past the start of each 16 kbp window of each
+        contig.
+
+        Returns:
+            dict: Contig names to a list of byte offsets, one per window, in
+                the decompressed data of a compressed file.
+
+        Raises:
+            MalformedInputFile: If the records of a contig are not all together and in position order.
+        """
+        window_offsets = {}
+        current_offsets = None
+        last_contig = None
+        last_position = 0
+        file_offset = 0
+        with open_input_file(self._file_path, 'rb') as vcf_handle:
+            for current_line in vcf_handle:
+                if current_line[0:1] != b'#':
+                    record_fields = current_line.split(b'\t', 2)
+                    current_contig = record_fields[0].decode()
+                    current_position = int(record_fields[1])
+                    if current_contig != last_contig:
+                        if current_contig in window_offsets:
+                            raise MalformedInputFile(self._file_path, "records of contig '{0}' are not together".format(
+                                current_contig))
+                        current_offsets = window_offsets[current_contig] = []
+                        last_contig = current_contig
+                    elif current_position < last_position:
+                        raise MalformedInputFile(self._file_path, "records must be sorted by position to be indexed")
+                    last_position = current_position
+                    while len(current_offsets) <= ( current_position - 1 ) >> self.INDEX_WINDOW_SHIFT:
+                        current_offsets.append(file_offset)
+                file_offset += len(current_line)
+        return window_offsets
+
+    def _open_region(self, contig_name, first_position, last_position):
+        """
+        Opens the file at or before the first record of the region, through
+        the tabix or CSI index of the file if it has one, or else through
+        index_positions, which is built the first time it is needed.
+
+        Returns:
+            file object: The opened file, or None if the region has no records.
+        """
+        if self._region_index is None:
+            index_path = TabixIndex.get_index_path(self._file_path)
+            self._region_index = TabixIndex(index_path) if index_path is not None else self.index_positions()
+        if isinstance(self._region_index, TabixIndex):
+            start_offset = self._region_index.get_start_offset(contig_name, first_position, last_position)
+            if start_offset is None:
+                return None
+            bgzf_reader = BGZFReader(self._file_path, self._num_threads)
+            bgzf_reader.seek_virtual(start_offset)
+            return io.TextIOWrapper(io.BufferedReader(bgzf_reader))
+        window_offsets = self._region_index.get(contig_name, [])
+        first_window = ( first_position - 1 ) >> self.INDEX_WINDOW_SHIFT
+        if first_window >= len(window_offsets):
+            return None
+        region_handle = open_input_file(self._file_path, 'r')
+        region_handle.seek(window_offsets[first_window])
+        return region_handle
+
+    def fetch_region(self, contig_name, first_position=1, last_position=None):
+        """
+        Reads only the records of a region, which must be sorted by
+        position, as tabix requires.  A generator: each record of the region
+        in turn becomes the current record, as by fetch_next_record, and its
+        position is yielded.  The records of the rest of the file are not
+        read, and fetch_next_record carries on from where it was.
+
+        Args:
+            contig_name (str): Unique contig description.
+            first_position (int): 1-indexed first position of the region.
+            last_position (int): 1-indexed last position of the region, or None for the end of the contig.
+        """
+        region_handle = self._open_region(contig_name, first_position, last_position)
+        if region_handle is None:
+            return
+        with region_handle:
+            for current_line in region_handle:
+                if current_line[0:1] == '#':
+                    continue
+                self._set_current_record(current_line)
+                current_position = self.get_position()
+                if self.get_contig() != contig_name or ( last_position is not None and
+                                                         current_position > last_position ):
+                    break
+                if current_position >= first_position:
+                    yield current_position
+
+    def seek(self, file_offset):
+        """ Moves to a record start, as found by index_contigs, for the next fetch_next_record. """
+        self._file_handle.seek(file_offset)
+        self._current_record = {}
+
+    def close(self):
+        self._file_handle.close()
+
     def get_samples(self):
         return self._sample_list
 
     def get_contig(self):
-        return self._current_record['global']['CHROM']
+        return self._get_record_field('CHROM')
 
     def get_position(self):
-        return int(self._current_record['global']['POS'])
+        return int(self._get_record_field('POS'))
 
     def get_reference_call(self):
-        return self._current_record['global']['REF']
+        return self._current_record['ref']
 
     def get_sample_call(self, current_sample):
         # FIXME indels
         return_value = None
-        if len(self._current_record['alts']) == 1:
-            return_value = self._current_record['alts'][0]
-        elif 'FORMAT' in self._current_record['global']:
-            if 'GT' in self._current_record['samples'][current_sample]:
-                alt_number = self._current_record['samples'][current_sample]['GT'].split('/', 1)[0].split('|', 1)[0]
+        record_alts = self._current_record['alts']
+        if len(record_alts) == 1:
+            return_value = record_alts[0]
+        elif self._current_record['layout'] is not None:
+            sample_genotype = self._get_sample_value(current_sample, 'GT')
+            if sample_genotype is not None:
+                alt_number = sample_genotype.split('/', 1)[0].split('|', 1)[0]
                 if alt_number.isdigit():
-                    return_value = self._current_record['alts'][int(alt_number)]
+                    return_value = record_alts[int(alt_number)]
                     # OMG varscan
-                    if len(self._current_record['global']['REF']) > 1 and (
-                                len(self._current_record['global']['REF']) - 1 ) == len(return_value) and \
-                                    self._current_record['global']['REF'][:len(return_value)] != return_value and \
-                                    self._current_record['global']['REF'][-len(return_value):] == return_value:
-                        return_value = self._current_record['alts'][0]
-        #elif len(self._current_record['alts']) > 1:
-        #    return_value = self._current_record['alts'][1]
+                    reference_call = self._current_record['ref']
+                    if len(reference_call) > 1 and ( len(reference_call) - 1 ) == len(return_value) and \
+                            reference_call[:len(return_value)] != return_value and \
+                            reference_call[-len(return_value):] == return_value:
+                        return_value = record_alts[0]
         return return_value
 
     def get_coverage(self, current_sample):
         sample_coverage = None
-        if 'FORMAT' in self._current_record['global'] and 'DP' in self._current_record['samples'][current_sample] and \
-                        self._current_record['samples'][current_sample]['DP'] is not None and \
-                self._current_record['samples'][current_sample]['DP'].isdigit():
-            sample_coverage = int(self._current_record['samples'][current_sample]['DP'])
-        elif 'DP' in self._current_record['info'] and self._current_record['info']['DP'] is not None and \
-                self._current_record['info']['DP'].isdigit():
-            sample_coverage = int(self._current_record['info']['DP']) / len(self._sample_list)
-        elif 'ADP' in self._current_record['info'] and self._current_record['info']['ADP'] is not None and \
-                self._current_record['info']['ADP'].isdigit():
-            sample_coverage = int(self._current_record['info']['ADP']) / len(self._sample_list)
-        # NASP output
-        elif 'FORMAT' in self._current_record['global'] and 'FT' in self._current_record['samples'][current_sample]:
-            failed_filters = self._current_record['samples'][current_sample]['FT'].split(',')
-            if 'CovFail' in failed_filters:
-                sample_coverage = -1
-            elif 'PASS' in failed_filters or 'PropFail' in failed_filters:
-                sample_coverage = 'PASS'
+        has_format = self._current_record['layout'] is not None
+        sample_depth = self._get_sample_value(current_sample, 'DP') if has_format else None
+        if sample_depth is not None and sample_depth.isdigit():
+            sample_coverage = int(sample_depth)
+        else:
+            record_info = self._get_record_info()
+            if record_info.get('DP') is not None and record_info['DP'].isdigit():
+                sample_coverage = int(record_info['DP']) / len(self._sample_list)
+            elif record_info.get('ADP') is not None and record_info['ADP'].isdigit():
+                sample_coverage = int(record_info['ADP']) / len(self._sample_list)
+            # NASP output
+            elif has_format and self._get_sample_value(current_sample, 'FT') is not None:
+                failed_filters = self._get_sample_value(current_sample, 'FT').split(',')
+                if 'CovFail' in failed_filters:
+                    sample_coverage = -1
+                elif 'PASS' in failed_filters or 'PropFail' in failed_filters:
+                    sample_coverage = 'PASS'
         return sample_coverage
 
     def get_proportion(self, current_sample, sample_coverage, is_a_snp):
         sample_proportion = None
-        if 'FORMAT' in self._current_record['global'] and 'AD' in self._current_record['samples'][current_sample]:
-            call_depths = self._current_record['samples'][current_sample]['AD'].split(',')
+        has_format = self._current_record['layout'] is not None
+        allele_depths = self._get_sample_value(current_sample, 'AD') if has_format else None
+        if allele_depths is not None:
+            call_depths = allele_depths.split(',')
             # gatk, reliable and documented
             if len(call_depths) > 1:
-                alt_number = self._current_record['samples'][current_sample]['GT'].split('/', 1)[0].split('|', 1)[0]
+                sample_genotype = self._get_sample_value(current_sample, 'GT')
+                if sample_genotype is None:
+                    raise KeyError('GT')
+                alt_number = sample_genotype.split('/', 1)[0].split('|', 1)[0]
                 if alt_number.isdigit():
                     sample_proportion = int(call_depths[int(alt_number)]) / sample_coverage
                     # varscan, reliable and documented
             elif is_a_snp:
                 sample_proportion = int(call_depths[0]) / sample_coverage
-            elif not is_a_snp and 'RD' in self._current_record['samples'][current_sample]:
-                sample_proportion = int(self._current_record['samples'][current_sample]['RD']) / sample_coverage
+            elif self._get_sample_value(current_sample, 'RD') is not None:
+                sample_proportion = int(self._get_sample_value(current_sample, 'RD')) / sample_coverage
+            return sample_proportion
+        record_info = self._get_record_info()
         # solsnp, undocumented, no multi-sample support
-        elif 'AR' in self._current_record['info']:
-            sample_proportion = float(self._current_record['info']['AR'])
+        if 'AR' in record_info:
+            sample_proportion = float(record_info['AR'])
             if not is_a_snp:
                 sample_proportion = 1 - sample_proportion
         # samtools, estimate, dubious accuracy
-        elif 'DP4' in self._current_record['info']:
-            call_depths = self._current_record['info']['DP4'].split(',')
+        elif 'DP4' in record_info:
+            call_depths = record_info['DP4'].split(',')
             if is_a_snp:
                 sample_proportion = ( int(call_depths[2]) + int(call_depths[3]) ) / (
                     sample_coverage * len(self._sample_list) )
@@ -1357,8 +3919,8 @@ class VCFRecord(object):
                 sample_proportion = ( int(call_depths[0]) + int(call_depths[1]) ) / (
                     sample_coverage * len(self._sample_list) )
         # NASP output
-        elif 'FORMAT' in self._current_record['global'] and 'FT' in self._current_record['samples'][current_sample]:
-            failed_filters = self._current_record['samples'][current_sample]['FT'].split(',')
+        elif has_format and self._get_sample_value(current_sample, 'FT') is not None:
+            failed_filters = self._get_sample_value(current_sample, 'FT').split(',')
             if 'PropFail' in failed_filters:
                 sample_proportion = -1
             elif 'PASS' in failed_filters:
@@ -1374,7 +3936,7 @@ class VCFRecord(object):
         sample_info['is_a_snp'] = False
         if sample_info['call'] is not None and sample_info['call'] != 'N':
             sample_info['was_called'] = True
-            if Genome.simple_call(sample_info['call']) != Genome.simple_call(self._current_record['global']['REF']):
+            if Genome.simple_call(sample_info['call']) != Genome.simple_call(self._current_record['ref']):
                 sample_info['is_a_snp'] = True
         # FIXME indels
         sample_info['is_an_insert'] = None
@@ -30,7 +30,21 @@ def _parse_args():
     parser.add_argument("--minimum-coverage", type=int, default=10, help="Minimum coverage depth at a position.")
     parser.add_argument("--minimum-proportion", type=float, default=0.9,
                         help="Minimum proportion of reads that must match the call at a position.")
-    parser.add_argument("--num-threads", type=int, default=1, help="Number of threads to use when processing input.")
+    parser.add_argument("--num-threads", type=int, default=1,
+                        help="Number of threads to use when processing input and writing matrices.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the input files through the matrices a window of positions at a time, instead "
+                             "of reading them all in first.  Uses memory per input file rather than per position, "
+                             "but reads every file twice.")
+    parser.add_argument("--genome-store",
+                        help="Folder of NASP binary genome files to reuse, instead of reading in again, the input "
+                             "files they were written from, which are written there for input files that have "
+                             "none.  The coverage and proportion filters are applied as the files are loaded, so "
+                             "they can be changed without reading the VCFs in again.")
+    parser.add_argument("--run-state",
+                        help="Folder to keep the state of an incremental run in: the input files of every run so "
+                             "far, and their genome store files, unless --genome-store is given.  Only the input "
+                             "files that are new since the last run need to be given, and only they are read in.")
     parser.add_argument("--dto-file", help="Path to a matrix_dto XML file that defines all the parameters.")
     return parser.parse_args()
 
@@ -63,21 +77,22 @@ def _parse_input_config(commandline_args):
     return commandline_args
 
 
-def import_reference(reference, reference_path, dups_path):
+def import_reference(reference, reference_path, dups_path, num_threads=1):
     """
     Take an empty reference object and populate it with the data from a
-    reference file, and a dups file if any.
+    reference file, and a dups file if any.  Either may be gzip or BGZF
+    compressed, and BGZF files are decompressed with num_threads threads.
     Does not return anything, as the passed-in object is modified.
     """
-    reference.import_fasta_file(reference_path)
+    reference.import_fasta_file(reference_path, "", num_threads)
     if dups_path is not None:
-        reference.import_dups_file(dups_path)
+        reference.import_dups_file(dups_path, "", num_threads)
         # from sys import stdout
         #reference._genome._send_to_fasta_handle( stdout )
         #reference._dups._send_to_fasta_handle( stdout )
 
 
-def import_external_fasta(input_file):
+def import_external_fasta(input_file, num_threads=1):
     """
     Create a FastaGenome object, set its metadata, and populate it with the
     data from a fasta file.
@@ -86,9 +101,9 @@ def import_external_fasta(input_file):
     """
     from nasp.nasp_objects import FastaGenome
 
-    genome = FastaGenome()
+    genome = FastaGenome(packed=True)
     set_genome_metadata(genome, input_file)
-    genome.import_fasta_file(genome.file_path(), "franken::")
+    genome.import_fasta_file(genome.file_path(), "franken::", num_threads)
     # from sys import stdout
     #genome._genome._send_to_fasta_handle( stdout )
     return [genome]
@@ -96,61 +111,365 @@ def import_external_fasta(input_file):
 
 # FIXME split into a larger number of smaller more testable functions
 # FIXME This belongs in VCFGenome object perhaps?
-def read_vcf_file(reference, min_coverage, min_proportion, input_file):
+def read_vcf_file(reference, min_coverage, min_proportion, input_file, num_threads=1, region=None,
+                  raw_values=False):
     """
     Submit VCF to be read in to VCF parser, populate genome data and filter
     data from the parsed VCF data, return a list of the read-in genomes.
+    A BGZF compressed VCF is decompressed with num_threads threads.
+    Given a ( contig, first position, last position ) region, only the
+    records of that region are read, through VCFRecord.fetch_region.
+    With raw_values, the genomes also keep the depths and proportions the
+    coverage and proportion filters were set from.
     """
     genomes = {}
     file_path = get_file_path(input_file)
     with open(file_path, 'r') as vcf_filehandle:
-        from nasp.nasp_objects import VCFGenome, Genome, ReferenceCallMismatch, VCFRecord
+        from nasp.nasp_objects import VCFGenome, VCFRecord
 
-        vcf_record = VCFRecord(file_path)
+        vcf_record = VCFRecord(file_path, num_threads)
         vcf_samples = vcf_record.get_samples()
         for vcf_sample in vcf_samples:
-            genomes[vcf_sample] = VCFGenome()
+            genomes[vcf_sample] = VCFGenome(packed=True, raw_values=raw_values)
             set_genome_metadata(genomes[vcf_sample], input_file)
             genomes[vcf_sample].set_nickname(vcf_sample)
-        while vcf_record.fetch_next_record():
-            current_contig = vcf_record.get_contig()
-            current_pos = vcf_record.get_position()
-            # Skip if position isn't in reference; maybe user truncated reference to exclude an uninteresting region.
-            if current_pos <= reference.get_contig_length(current_contig):
-                reference_call = reference.get_call(current_pos, None, current_contig)
-                simplified_refcall = Genome.simple_call(reference_call)
-                if ( simplified_refcall != 'N' ) and (
-                    simplified_refcall != Genome.simple_call(vcf_record.get_reference_call()[0]) ):
-                    # Reference call from reference fasta differs from reference call in VCF file at the same position.
-                    raise ReferenceCallMismatch(reference_call, vcf_record.get_reference_call(), file_path,
-                                                current_contig, current_pos)
-                for vcf_sample in vcf_samples:
-                    sample_info = vcf_record.get_sample_info(vcf_sample)
-                    # FIXME indels
-                    if sample_info['call'] is not None:
-                        genomes[vcf_sample].set_call(sample_info['call'], current_pos, 'X', current_contig)
-                    if sample_info['was_called']:
-                        genomes[vcf_sample].set_was_called('Y', current_pos, current_contig)
-                    if sample_info['coverage'] is not None:
-                        if sample_info['coverage'] == 'PASS' or sample_info['coverage'] >= min_coverage:
-                            genomes[vcf_sample].set_coverage_pass('Y', current_pos, current_contig)
-                        else:
-                            genomes[vcf_sample].set_coverage_pass('N', current_pos, current_contig)
-                    if sample_info['proportion'] is not None:
-                        if sample_info['proportion'] == 'PASS' or sample_info['proportion'] >= min_proportion:
-                            genomes[vcf_sample].set_proportion_pass('Y', current_pos, current_contig)
-                        else:
-                            genomes[vcf_sample].set_proportion_pass('N', current_pos, current_contig)
-                    elif not sample_info['is_a_snp']:
-                        # Some big SNP callers, like GATK, do not provide proportion information when
-                        # the position is called reference.  We cannot filter these positions.
-                        genomes[vcf_sample].set_proportion_pass('-', current_pos, current_contig)
+        if region is not None:
+            for _ in vcf_record.fetch_region(*region):
+                read_vcf_record(reference, min_coverage, min_proportion, file_path, vcf_record, genomes)
+        else:
+            record_batch = vcf_record.fetch_record_batch()
+            while record_batch:
+                read_vcf_batch(reference, min_coverage, min_proportion, file_path, record_batch, genomes,
+                               vcf_samples)
+                record_batch = vcf_record.fetch_record_batch()
+        vcf_record.close()
     # from sys import stdout
     #for genome in genomes:
     #    genomes[genome]._genome._send_to_fasta_handle( stdout )
     return genomes.values()
 
 
+def read_vcf_record(reference, min_coverage, min_proportion, file_path, vcf_record, genomes, position_offset=0):
+    """
+    Populate genome data and filter data of the genome of each sample from
+    the current VCF record.  With a position_offset, the data is set that
+    many positions earlier, for genomes that only hold a window of the
+    contig.
+    """
+    from nasp.nasp_objects import Genome, ReferenceCallMismatch
+
+    current_contig = vcf_record.get_contig()
+    current_pos = vcf_record.get_position()
+    # Skip if position isn't in reference; maybe user truncated reference to exclude an uninteresting region.
+    if current_pos <= reference.get_contig_length(current_contig):
+        reference_call = reference.get_call(current_pos, None, current_contig)
+        simplified_refcall = Genome.simple_call(reference_call)
+        if ( simplified_refcall != 'N' ) and (
+            simplified_refcall != Genome.simple_call(vcf_record.get_reference_call()[0]) ):
+            # Reference call from reference fasta differs from reference call in VCF file at the same position.
+            raise ReferenceCallMismatch(reference_call, vcf_record.get_reference_call(), file_path,
+                                        current_contig, current_pos)
+        genome_pos = current_pos - position_offset
+        for vcf_sample in vcf_record.get_samples():
+            sample_info = vcf_record.get_sample_info(vcf_sample)
+            # FIXME indels
+            if sample_info['call'] is not None:
+                genomes[vcf_sample].set_call(sample_info['call'], genome_pos, 'X', current_contig)
+            if sample_info['was_called']:
+                genomes[vcf_sample].set_was_called('Y', genome_pos, current_contig)
+            if sample_info['coverage'] is not None:
+                if sample_info['coverage'] == 'PASS' or sample_info['coverage'] >= min_coverage:
+                    genomes[vcf_sample].set_coverage_pass('Y', genome_pos, current_contig)
+                else:
+                    genomes[vcf_sample].set_coverage_pass('N', genome_pos, current_contig)
+            if sample_info['proportion'] is not None:
+                if sample_info['proportion'] == 'PASS' or sample_info['proportion'] >= min_proportion:
+                    genomes[vcf_sample].set_proportion_pass('Y', genome_pos, current_contig)
+                else:
+                    genomes[vcf_sample].set_proportion_pass('N', genome_pos, current_contig)
+            elif not sample_info['is_a_snp']:
+                # Some big SNP callers, like GATK, do not provide proportion information when
+                # the position is called reference.  We cannot filter these positions.
+                genomes[vcf_sample].set_proportion_pass('-', genome_pos, current_contig)
+
+
+def read_vcf_batch(reference, min_coverage, min_proportion, file_path, record_batch, genomes, vcf_samples):
+    """
+    The batch version of read_vcf_record, for a run of records from
+    VCFRecord.fetch_record_batch.  The calls, depths and proportions of each
+    sample are gathered by position first, later records winning as they
+    would one at a time, and then set a run of consecutive positions at a
+    time.  Genomes that keep raw values get the depths and proportions too.
+    """
+    from nasp.nasp_objects import Genome, ReferenceCallMismatch
+
+    batch_contig = None
+    contig_length = 0
+    sample_states = {}
+    for current_contig, current_pos, vcf_reference_call, sample_infos in record_batch:
+        if current_contig != batch_contig:
+            _set_vcf_batch_states(genomes, sample_states, batch_contig, min_coverage, min_proportion)
+            batch_contig = current_contig
+            contig_length = reference.get_contig_length(current_contig)
+            sample_states = dict(( vcf_sample, ( {}, {}, {}, {} ) ) for vcf_sample in vcf_samples)
+        # Skip if position isn't in reference; maybe user truncated reference to exclude an uninteresting region.
+        if current_pos > contig_length:
+            continue
+        reference_call = reference.get_call(current_pos, None, current_contig)
+        simplified_refcall = Genome.simple_call(reference_call)
+        if ( simplified_refcall != 'N' ) and ( simplified_refcall != Genome.simple_call(vcf_reference_call[0]) ):
+            # Reference call from reference fasta differs from reference call in VCF file at the same position.
+            raise ReferenceCallMismatch(reference_call, vcf_reference_call, file_path, current_contig, current_pos)
+        for vcf_sample, sample_info in zip(vcf_samples, sample_infos):
+            calls, was_called, coverages, proportions = sample_states[vcf_sample]
+            # FIXME indels
+            if sample_info['call'] is not None:
+                calls[current_pos] = sample_info['call']
+            if sample_info['was_called']:
+                was_called[current_pos] = 'Y'
+            if sample_info['coverage'] is not None:
+                coverages[current_pos] = sample_info['coverage']
+            if sample_info['proportion'] is not None:
+                proportions[current_pos] = sample_info['proportion']
+            elif not sample_info['is_a_snp']:
+                # Some big SNP callers, like GATK, do not provide proportion information when
+                # the position is called reference.  We cannot filter these positions.
+                proportions[current_pos] = None
+    _set_vcf_batch_states(genomes, sample_states, batch_contig, min_coverage, min_proportion)
+
+
+def _get_position_runs(position_values):
+    """
+    Yields ( first position, values ) for each run of consecutive positions
+    in a dict of positions to values.
+    """
+    run_start = None
+    run_values = []
+    for current_pos in sorted(position_values):
+        if run_values and current_pos != run_start + len(run_values):
+            yield run_start, run_values
+            run_values = []
+        if not run_values:
+            run_start = current_pos
+        run_values.append(position_values[current_pos])
+    if run_values:
+        yield run_start, run_values
+
+
+def _set_vcf_batch_states(genomes, sample_states, contig_name, min_coverage, min_proportion):
+    from nasp.nasp_objects import VCFGenome
+
+    for vcf_sample, ( calls, was_called, coverages, proportions ) in sample_states.items():
+        genome = genomes[vcf_sample]
+        for first_position, run_calls in _get_position_runs(calls):
+            genome.set_call(run_calls if len(run_calls) > 1 else run_calls[0], first_position, 'X', contig_name)
+        for first_position, run_states in _get_position_runs(was_called):
+            genome.set_was_called(''.join(run_states), first_position, contig_name)
+        for first_position, run_coverages in _get_position_runs(coverages):
+            genome.set_coverage_pass(''.join(
+                'Y' if sample_coverage == 'PASS' or sample_coverage >= min_coverage else 'N' for sample_coverage in
+                run_coverages), first_position, contig_name)
+            if genome.has_raw_values():
+                genome.set_raw_values(VCFGenome.RAW_DEPTHS, [
+                    VCFGenome.RAW_PASS if sample_coverage == 'PASS' else sample_coverage for sample_coverage in
+                    run_coverages], first_position, contig_name)
+        for first_position, run_proportions in _get_position_runs(proportions):
+            genome.set_proportion_pass(''.join(
+                '-' if sample_proportion is None else
+                'Y' if sample_proportion == 'PASS' or sample_proportion >= min_proportion else 'N' for
+                sample_proportion in run_proportions), first_position, contig_name)
+            if genome.has_raw_values():
+                genome.set_raw_values(VCFGenome.RAW_PROPORTIONS, [
+                    VCFGenome.RAW_NOT_APPLICABLE if sample_proportion is None else
+                    VCFGenome.RAW_PASS if sample_proportion == 'PASS' else sample_proportion for sample_proportion in
+                    run_proportions], first_position, contig_name)
+
+
+def open_vcf_stream(reference, min_coverage, min_proportion, input_file, matrix_windows):
+    """
+    The streaming version of read_vcf_file.  The file is checked and
+    indexed by contig now, so that it can fail before any matrix is
+    written, but its records are only read in a window at a time.
+
+    Args:
+        reference (ReferenceGenome): The reference.
+        min_coverage (int): Minimum coverage depth at a position.
+        min_proportion (float): Minimum proportion of reads that must match the call at a position.
+        input_file (str): The packed input filename string.
+        matrix_windows (list): As returned by GenomeCollection.get_matrix_windows.
+
+    Returns:
+        tuple: The genome of each sample, with only its metadata, and a
+        generator of the genomes holding the data of each window.
+    """
+    from nasp.nasp_objects import VCFGenome, VCFRecord
+
+    file_path = get_file_path(input_file)
+    vcf_record = VCFRecord(file_path)
+    contig_offsets = vcf_record.index_contigs()
+    sample_genomes = []
+    for vcf_sample in vcf_record.get_samples():
+        sample_genome = VCFGenome()
+        set_genome_metadata(sample_genome, input_file)
+        sample_genome.set_nickname(vcf_sample)
+        sample_genomes.append(sample_genome)
+    return sample_genomes, _stream_vcf_windows(reference, min_coverage, min_proportion, file_path, vcf_record,
+                                               contig_offsets, sample_genomes, matrix_windows)
+
+
+def _stream_vcf_windows(reference, min_coverage, min_proportion, file_path, vcf_record, contig_offsets,
+                        sample_genomes, matrix_windows):
+    """ Generator for open_vcf_stream. """
+    from nasp.nasp_objects import VCFGenome, MalformedInputFile
+
+    vcf_samples = vcf_record.get_samples()
+    current_contig = None
+    has_record = False
+    for window_contig, first_position, last_position in matrix_windows:
+        genomes = {}
+        for vcf_sample, sample_genome in zip(vcf_samples, sample_genomes):
+            genomes[vcf_sample] = VCFGenome(packed=True)
+            genomes[vcf_sample].copy_metadata(sample_genome)
+            genomes[vcf_sample].add_contig(window_contig)
+        if window_contig != current_contig:
+            current_contig = window_contig
+            has_record = window_contig in contig_offsets
+            if has_record:
+                vcf_record.seek(contig_offsets[window_contig])
+                has_record = vcf_record.fetch_next_record()
+        while has_record and vcf_record.get_contig() == window_contig and vcf_record.get_position() <= last_position:
+            if vcf_record.get_position() < first_position:
+                raise MalformedInputFile(file_path, "records must be sorted by position to be streamed")
+            read_vcf_record(reference, min_coverage, min_proportion, file_path, vcf_record, genomes,
+                            first_position - 1)
+            has_record = vcf_record.fetch_next_record()
+        yield [genomes[vcf_sample] for vcf_sample in vcf_samples]
+    vcf_record.close()
+
+
+def open_fasta_stream(input_file, matrix_windows):
+    """
+    The streaming version of import_external_fasta; see open_vcf_stream.
+    """
+    from nasp.nasp_objects import FastaGenome
+
+    sample_genome = FastaGenome()
+    set_genome_metadata(sample_genome, input_file)
+    contig_offsets = FastaGenome.index_fasta_file(sample_genome.file_path(), "franken::")
+    return [sample_genome], _stream_fasta_windows(sample_genome, contig_offsets, matrix_windows)
+
+
+def _stream_fasta_windows(sample_genome, contig_offsets, matrix_windows):
+    """ Generator for open_fasta_stream. """
+    import re
+    from nasp.nasp_objects import FastaGenome, open_input_file
+
+    current_contig = None
+    with open_input_file(sample_genome.file_path(), 'r') as fasta_handle:
+        for window_contig, first_position, last_position in matrix_windows:
+            genome = FastaGenome(packed=True)
+            genome.copy_metadata(sample_genome)
+            genome.add_contig(window_contig)
+            if window_contig != current_contig:
+                current_contig = window_contig
+                # The calls read in but not yet used, and the position of the first one.
+                contig_calls = ''
+                calls_start = 1
+                has_lines = window_contig in contig_offsets
+                if has_lines:
+                    fasta_handle.seek(contig_offsets[window_contig])
+            while has_lines and calls_start + len(contig_calls) <= last_position:
+                line_from_fasta = fasta_handle.readline()
+                if line_from_fasta == '' or re.match(r'^>franken::[^\s]+(?:\s|$)', line_from_fasta):
+                    has_lines = False
+                else:
+                    data_match = re.match(r'^([A-Za-z.-]+)\s*$', line_from_fasta)
+                    if data_match:
+                        contig_calls += data_match.group(1)
+            window_calls = contig_calls[first_position - calls_start:last_position - calls_start + 1]
+            contig_calls = contig_calls[last_position - calls_start + 1:]
+            calls_start = last_position + 1
+            if window_calls:
+                genome.append_contig(window_calls, window_contig)
+            yield [genome]
+
+
+def open_input_stream(reference, min_coverage, min_proportion, input_file, matrix_windows):
+    """
+    Open an input file of any type for streaming; see open_vcf_stream.
+    Returns None for files that do not hold genomes.
+    """
+    file_type = determine_file_type(input_file)
+    if file_type == "frankenfasta":
+        return open_fasta_stream(input_file, matrix_windows)
+    elif file_type == "vcf":
+        return open_vcf_stream(reference, min_coverage, min_proportion, input_file, matrix_windows)
+    return None
+
+
+def check_input_stream(input_stream):
+    """
+    Stream all the windows of an input file and throw them away, in a
+    stream_output_matrices worker, to find out if the file can be read in.
+
+    Args:
+        input_stream (tuple): The packed input filename string, and the matrix windows.
+
+    Returns:
+        str: None, unless reading the file in failed.
+    """
+    ( input_file, matrix_windows ) = input_stream
+    ( reference, min_coverage, min_proportion, _, _, _ ) = _input_options
+    try:
+        opened_stream = open_input_stream(reference, min_coverage, min_proportion, input_file, matrix_windows)
+        if opened_stream is not None:
+            for _ in opened_stream[1]:
+                pass
+    except Exception as input_error:
+        logging.exception("Unable to read in data from '{0}'!".format(get_file_path(input_file)))
+        return "{0}: {1}".format(type(input_error).__name__, input_error)
+    return None
+
+
+def stream_output_matrices(genomes, input_files, matrix_folder, matrix_format_choices, min_coverage,
+                           min_proportion, num_threads=1):
+    """
+    The streaming version of parse_input_files and write_output_matrices.
+    Every input file is opened at once, and they are read in together a
+    window of positions at a time, as the matrices are written, so only one
+    window of each is ever in memory.  The files must have all the records
+    of a contig together, in position order, as the callers write them.
+    The files that cannot be read in are listed in the matrix headers, so
+    the files are all read through once first, in a pool of num_threads
+    processes, to find them.
+    """
+    from multiprocessing import Pool
+
+    matrix_windows = genomes.get_matrix_windows()
+    input_streams = []
+    if len(input_files) > 0:
+        with Pool(max(1, min(num_threads, len(input_files))), _set_input_options,
+                  ( genomes.reference(), min_coverage, min_proportion, None )) as pool:
+            input_errors = pool.map(check_input_stream, [( input_file, matrix_windows ) for input_file in input_files],
+                                    1)
+        for input_file, input_error in zip(input_files, input_errors):
+            if input_error is not None:
+                genomes.add_failed_genome(get_file_path(input_file))
+                continue
+            opened_stream = open_input_stream(genomes.reference(), min_coverage, min_proportion, input_file,
+                                              matrix_windows)
+            if opened_stream is not None:
+                for sample_genome in opened_stream[0]:
+                    genomes.add_genome(sample_genome)
+                input_streams.append(opened_stream[1])
+    if len(input_streams) > 0:
+        window_genomes = ( [genome for stream_genomes in window_stream_genomes for genome in stream_genomes] for
+                           window_stream_genomes in zip(*input_streams) )
+    else:
+        window_genomes = ( [] for _ in matrix_windows )
+    genomes.write_to_matrices(get_matrix_formats(matrix_folder, matrix_format_choices), 1, window_genomes)
+
+
 # FIXME The information these three functions capture is in the XML file.
 # FIXME These should all be deprecated and the XML data used instead.
 def determine_file_type(input_file):
@@ -197,85 +516,313 @@ def set_genome_metadata(genome, input_file):
         # print( genome.identifier() )
 
 
-def manage_input_thread(reference, min_coverage, min_proportion, input_q, output_q):
-    """
-    Manage one input file worker thread, for reading the data from the file.
-    Input filenames are pulled one at a time from the input queue, and the
-    genome data from the read-in files is placed on the output queue.
-    When an input filename of "None" appears, we know we're done and put
-    "None" on the output queue so the controlling thread knows we won't be
-    adding more data.
-    """
-    input_file = input_q.get()
-    while input_file is not None:
-        try:
-            new_genomes = []
-            file_type = determine_file_type(input_file)
-            if file_type == "frankenfasta":
-                new_genomes = import_external_fasta(input_file)
-            elif file_type == "vcf":
-                new_genomes = read_vcf_file(reference, min_coverage, min_proportion, input_file)
-            for new_genome in new_genomes:
-                output_q.put(new_genome)
-        except:
-            failed_file_path = get_file_path(input_file)
-            logging.exception("Unable to read in data from '{0}'!".format(failed_file_path))
-            # If the genome on the output queue is just a string, its contents
-            # are the name of the file we failed to read in.
-            output_q.put(failed_file_path)
-        input_file = input_q.get()
-    output_q.put(None)
-
-
-def parse_input_files(input_files, num_threads, genomes, min_coverage, min_proportion):
-    """
-    Use a pool of worker threads to, in parallel, read in the input files.
-    Populate the genome collection with the read-in data.
-    This is the "poison pill" thread management algorithm, where threads are
-    each given a "you can stop now" task once the actual queue of tasks is
-    complete.
-    """
-    # Lines below marked "Single-thread" can be uncommented and replace
-    # the lines marked "Multi-thread" to get single-thread behavior.
-    from multiprocessing import Process, Queue  # Multi-thread
-    # from queue import Queue  # Single-thread
-    from time import sleep
-
-    input_q = Queue()
-    output_q = Queue()
-    for input_file in input_files:
-        input_q.put(input_file)
-    # If the number of jobs is already smaller than the thread pool...
-    if num_threads > input_q.qsize():
-        num_threads = input_q.qsize()
-    sleep(1)
-    thread_list = []
-    for current_thread in range(num_threads):
-        input_q.put(None)
-        current_thread = Process(target=manage_input_thread,
-                                 args=[genomes.reference(), min_coverage, min_proportion, input_q,
-                                       output_q])  # Multi-thread
-        current_thread.start()  # Multi-thread
-        #manage_input_thread( genomes.reference(), min_coverage, min_proportion, input_q, output_q )  # Single-thread
-        thread_list.append(current_thread)  # Multi-thread
-    sleep(1)
-    while num_threads > 0:
-        new_genome = output_q.get()
-        if new_genome is None:
-            num_threads -= 1
-        elif isinstance(new_genome, str):
-            # Reading this file in failed.  We only know the filename.
-            genomes.add_failed_genome(new_genome)
+# Per-position data smaller than this is sent back with the rest of the genome.
+SCRATCH_BUFFER_SIZE = 4096
+
+
+def pack_genome(genome, scratch_dir=None):
+    """
+    Prepare a read-in genome to be handed back to the controlling process.
+    Everything a worker returns is pickled, sent through a pipe, and
+    unpickled by the one controlling process, which is too much work for it
+    with many large genomes.  Given a scratch directory, the per-position
+    data of the genome is written to a scratch file instead, and only the
+    rest of the genome and where its data is needs to be sent; see
+    unpack_genome.
+    """
+    if scratch_dir is None:
+        return genome
+    import os
+    import pickle
+    import tempfile
+    from io import BytesIO
+
+    scratch_handle, scratch_path = tempfile.mkstemp(suffix=".genome", dir=scratch_dir)
+    with os.fdopen(scratch_handle, 'wb') as scratch_file:
+        def write_buffer(genome_object):
+            # The per-position data of compact, packed, and VCF filter storage is all bytearrays.
+            if type(genome_object) is bytearray and len(genome_object) >= SCRATCH_BUFFER_SIZE:
+                buffer_location = ( scratch_file.tell(), len(genome_object) )
+                scratch_file.write(genome_object)
+                return buffer_location
+            return None
+
+        genome_data = BytesIO()
+        pickler = pickle.Pickler(genome_data, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = write_buffer
+        pickler.dump(genome)
+    return scratch_path, genome_data.getvalue()
+
+
+def unpack_genome(packed_genome):
+    """
+    Take back a genome prepared by pack_genome, reading its per-position
+    data straight back into place from its scratch file, which is then
+    removed.
+    """
+    if not isinstance(packed_genome, tuple):
+        return packed_genome
+    import os
+    import pickle
+    from io import BytesIO
+
+    scratch_path, genome_data = packed_genome
+    with open(scratch_path, 'rb') as scratch_file:
+        def read_buffer(buffer_location):
+            buffer_offset, buffer_length = buffer_location
+            genome_object = bytearray(buffer_length)
+            scratch_file.seek(buffer_offset)
+            scratch_file.readinto(genome_object)
+            return genome_object
+
+        unpickler = pickle.Unpickler(BytesIO(genome_data))
+        unpickler.persistent_load = read_buffer
+        genome = unpickler.load()
+    os.remove(scratch_path)
+    return genome
+
+
+def get_input_file_size(input_file):
+    """ Get the size in bytes of the file in the packed input filename string, or 0 if it cannot be read. """
+    import os
+
+    try:
+        return os.path.getsize(get_file_path(input_file))
+    except OSError:
+        return 0
+
+
+# Genome store files are named <key>.<index>.naspgenome, see get_genome_store_paths.
+GENOME_STORE_SUFFIX = ".naspgenome"
+
+
+def get_genome_store_source(reference, input_file):
+    """
+    Describe an input file the way the genome store files written from it
+    record it, so that they are only reused while the file, and the contigs
+    of the reference it was read in against, are unchanged.
+    """
+    import hashlib
+    import os
+
+    file_stat = os.stat(get_file_path(input_file))
+    reference_contigs = hashlib.sha1()
+    for contig_name in reference.get_contigs():
+        reference_contigs.update("{0}\t{1}\n".format(contig_name, reference.get_contig_length(contig_name)).encode())
+    return {'input_file': input_file, 'size': file_stat.st_size, 'mtime': file_stat.st_mtime,
+            'reference': reference_contigs.hexdigest()}
+
+
+def get_genome_store_paths(genome_store, input_file, count):
+    """ The paths of the count genome store files of an input file. """
+    import hashlib
+    import os
+
+    store_key = hashlib.sha1(input_file.encode()).hexdigest()
+    return [os.path.join(genome_store, "{0}.{1}{2}".format(store_key, store_index, GENOME_STORE_SUFFIX))
+            for store_index in range(count)]
+
+
+def find_genome_stores(reference, input_file, genome_store):
+    """
+    Returns:
+        list: The paths of the genome store files of an input file, or None
+        if any of them is missing or was written from an older version of it.
+    """
+    from nasp.nasp_objects import GenomeStore, MalformedInputFile
+
+    source = get_genome_store_source(reference, input_file)
+    store_paths = get_genome_store_paths(genome_store, input_file, 1)
+    try:
+        ( header, _ ) = GenomeStore.read_header(store_paths[0])
+        if header['source'] is None or header['source']['count'] < 1:
+            return None
+        store_paths = get_genome_store_paths(genome_store, input_file, header['source']['count'])
+        for store_index, store_path in enumerate(store_paths):
+            ( header, _ ) = GenomeStore.read_header(store_path)
+            store_source = dict(header['source'] or {})
+            if store_source.pop('index', None) != store_index or store_source.pop('count', None) != len(store_paths) \
+                    or store_source != source:
+                return None
+    except ( OSError, MalformedInputFile ):
+        return None
+    return store_paths
+
+
+def write_genome_stores(reference, input_file, genome_store, new_genomes, filter_thresholds=None):
+    """
+    Write the read-in genomes of an input file to genome store files, with
+    the ( min_coverage, min_proportion ) they were filtered with, if any.
+
+    Returns:
+        list: The paths of the files, in the order of new_genomes.
+    """
+    from nasp.nasp_objects import GenomeStore
+
+    new_genomes = list(new_genomes)
+    store_paths = get_genome_store_paths(genome_store, input_file, len(new_genomes))
+    for store_index, ( new_genome, store_path ) in enumerate(zip(new_genomes, store_paths)):
+        source = get_genome_store_source(reference, input_file)
+        source.update({'index': store_index, 'count': len(new_genomes)})
+        GenomeStore.write(new_genome, store_path, source, filter_thresholds)
+    return store_paths
+
+
+# The run state of an incremental run, in its run state folder.
+RUN_STATE_FILENAME = "run_state.json"
+
+
+def get_run_input_files(run_state, input_files):
+    """
+    Get the input files of an incremental run: those of the earlier runs
+    saved in the run state folder, in the order they were first given,
+    followed by the new ones.
+    """
+    import json
+    import os
+
+    run_input_files = []
+    run_state_path = os.path.join(run_state, RUN_STATE_FILENAME)
+    if os.path.exists(run_state_path):
+        with open(run_state_path) as run_state_handle:
+            run_input_files = json.load(run_state_handle)['input_files']
+    for input_file in ( input_files or [] ):
+        if input_file not in run_input_files:
+            run_input_files.append(input_file)
+    return run_input_files
+
+
+def save_run_input_files(run_state, input_files):
+    """ Save the input files of an incremental run to its run state folder, for the next run. """
+    import json
+    import os
+    import tempfile
+
+    if not os.path.isdir(run_state):
+        os.makedirs(run_state)
+    ( run_state_handle, temporary_path ) = tempfile.mkstemp(dir=run_state)
+    with os.fdopen(run_state_handle, 'w') as run_state_file:
+        json.dump({'input_files': list(input_files)}, run_state_file, indent=1)
+    os.chmod(temporary_path, 0o644)
+    os.replace(temporary_path, os.path.join(run_state, RUN_STATE_FILENAME))
+
+
+# The reference, min_coverage, min_proportion, scratch_dir, decompression threads, and genome store folder of an
+# input file worker.
+_input_options = None
+
+
+def _set_input_options(reference, min_coverage, min_proportion, scratch_dir, num_threads=1, genome_store=None):
+    """ Pool initializer for parse_input_files. """
+    global _input_options
+    _input_options = ( reference, min_coverage, min_proportion, scratch_dir, num_threads, genome_store )
+
+
+def read_input_file(input_file):
+    """
+    Read in the genomes from one input file, in a parse_input_files worker.
+    Errors are logged and returned, so that the other files can still be
+    read in.
+
+    Args:
+        input_file (str): The packed input filename string.
+
+    Returns:
+        dict: 'input_file' and 'file_path', 'file_size' in bytes, 'genomes'
+        as prepared by pack_genome, 'genome_stores', the genome store files
+        to load the genomes from instead, 'seconds' it took to read them in,
+        and 'error', which is None unless reading the file in failed.
+    """
+    from time import time
+
+    ( reference, min_coverage, min_proportion, scratch_dir, num_threads, genome_store ) = _input_options
+    start_time = time()
+    input_result = {'input_file': input_file, 'file_path': get_file_path(input_file),
+                    'file_size': get_input_file_size(input_file), 'genomes': [], 'genome_stores': [], 'error': None}
+    try:
+        if genome_store is not None:
+            genome_stores = find_genome_stores(reference, input_file, genome_store)
+            if genome_stores is not None:
+                input_result['genome_stores'] = genome_stores
+                input_result['seconds'] = time() - start_time
+                return input_result
+        new_genomes = []
+        file_type = determine_file_type(input_file)
+        if file_type == "frankenfasta":
+            new_genomes = import_external_fasta(input_file, num_threads)
+        elif file_type == "vcf":
+            new_genomes = read_vcf_file(reference, min_coverage, min_proportion, input_file, num_threads,
+                                        raw_values=genome_store is not None)
+        if genome_store is not None:
+            input_result['genome_stores'] = write_genome_stores(reference, input_file, genome_store, new_genomes,
+                                                                ( min_coverage, min_proportion ))
         else:
-            genomes.add_genome(new_genome)
-    sleep(1)
-    for current_thread in thread_list:  # Multi-thread
-        current_thread.join()  # Multi-thread
+            input_result['genomes'] = [pack_genome(new_genome, scratch_dir) for new_genome in new_genomes]
+    except Exception as input_error:
+        logging.exception("Unable to read in data from '{0}'!".format(input_result['file_path']))
+        input_result['error'] = "{0}: {1}".format(type(input_error).__name__, input_error)
+    input_result['seconds'] = time() - start_time
+    return input_result
 
 
-def write_output_matrices(genomes, matrix_folder, matrix_format_choices):
+def parse_input_files(input_files, num_threads, genomes, min_coverage, min_proportion, genome_store=None):
+    """
+    Use a pool of worker processes to, in parallel, read in the input files.
+    Populate the genome collection with the read-in data, and add the files
+    that could not be read in as failed genomes, in input order.
+    The largest files are started first, so that the run is not left waiting
+    on one large file started last.  The read-in genomes are handed back
+    through scratch files in a temporary directory that is removed once
+    they are all in.
+    When there are fewer files than threads, the threads left over go to
+    decompressing BGZF input files.
+    Given a genome_store folder, input files that have up to date genome
+    store files there are not read in again, and those that do not get
+    them; either way the genomes are then loaded from the files, filtered
+    with min_coverage and min_proportion as they are.
+
+    Returns:
+        list: The result of read_input_file for each file, in the order
+        they finished, without the genomes.
+    """
+    from multiprocessing import Pool
+    import os
+    import shutil
+    import tempfile
+    from nasp.nasp_objects import GenomeStore
+
+    input_results = []
+    if len(input_files) == 0:
+        return input_results
+    if genome_store is not None and not os.path.isdir(genome_store):
+        os.makedirs(genome_store)
+    ordered_input_files = sorted(input_files, key=get_input_file_size, reverse=True)
+    scratch_dir = tempfile.mkdtemp(prefix="nasp_genomes_")
+    try:
+        num_processes = max(1, min(num_threads, len(input_files)))
+        with Pool(num_processes, _set_input_options, ( genomes.reference(), min_coverage, min_proportion, scratch_dir,
+                                                       max(1, num_threads // num_processes), genome_store )) as pool:
+            for input_result in pool.imap_unordered(read_input_file, ordered_input_files):
+                for packed_genome in input_result.pop('genomes'):
+                    genomes.add_genome(unpack_genome(packed_genome))
+                for store_path in input_result.pop('genome_stores'):
+                    genomes.add_genome(GenomeStore.read(store_path, min_coverage, min_proportion))
+                if input_result['error'] is None:
+                    logging.info("Read in '{0}' ({1:.1f} MB) in {2:.1f} seconds, {3:.1f} MB/s.".format(
+                        input_result['file_path'], input_result['file_size'] / 1048576, input_result['seconds'],
+                        input_result['file_size'] / 1048576 / max(input_result['seconds'], 0.001)))
+                input_results.append(input_result)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    failed_paths = set(input_result['file_path'] for input_result in input_results if input_result['error'] is not None)
+    for input_file in input_files:
+        if get_file_path(input_file) in failed_paths:
+            genomes.add_failed_genome(get_file_path(input_file))
+    return input_results
+
+
+def get_matrix_formats(matrix_folder, matrix_format_choices):
     """
-    Write matrices from genome collection data.
     Defines the matrix types for future expansion of custom matrix options.
     This information eventually should come from the user interface and be
     included in the XML configuration file, rather than hardcoded here.
@@ -335,7 +882,16 @@ def write_output_matrices(genomes, matrix_folder, matrix_format_choices):
                 'dataformat': 'vcf',
                 'filter': 'includeref'
             }] )
-    genomes.write_to_matrices(matrix_formats)
+    return matrix_formats
+
+
+def write_output_matrices(genomes, matrix_folder, matrix_format_choices, num_threads=1):
+    """
+    Write matrices from genome collection data, in the formats given by
+    get_matrix_formats.  With num_threads above one, the matrices are
+    computed by contig shard in that many processes.
+    """
+    genomes.write_to_matrices(get_matrix_formats(matrix_folder, matrix_format_choices), num_threads)
 
 
 def write_stats_data(genomes, stats_folder):
@@ -354,21 +910,41 @@ def main():
     3.  Read in all query genomes in parallel
     4.  Write output matrices
     5.  Write stats files
+    Given a run state folder, the input files are those of the earlier runs
+    in it as well as the new ones, and the genomes of the earlier ones are
+    loaded from their genome store files instead of being read in again.
     """
+    import os
+
     commandline_args = _parse_args()
     if commandline_args.dto_file:
         commandline_args = _parse_input_config(commandline_args)
     logging.basicConfig(level=logging.WARNING)
     from nasp.nasp_objects import ReferenceGenome, GenomeCollection
 
-    reference = ReferenceGenome()
-    import_reference(reference, commandline_args.reference_fasta, commandline_args.reference_dups)
+    reference = ReferenceGenome(packed=True)
+    import_reference(reference, commandline_args.reference_fasta, commandline_args.reference_dups,
+                     commandline_args.num_threads)
     genomes = GenomeCollection()
     genomes.set_reference(reference)
-    parse_input_files(commandline_args.input_files, commandline_args.num_threads, genomes,
-                      commandline_args.minimum_coverage, commandline_args.minimum_proportion)
-    write_output_matrices(genomes, commandline_args.matrix_folder, commandline_args.filter_matrix_format)
+    input_files = commandline_args.input_files
+    genome_store = commandline_args.genome_store
+    if commandline_args.run_state is not None:
+        input_files = get_run_input_files(commandline_args.run_state, input_files)
+        if genome_store is None:
+            genome_store = os.path.join(commandline_args.run_state, "genomes")
+    if commandline_args.stream:
+        stream_output_matrices(genomes, input_files, commandline_args.matrix_folder,
+                               commandline_args.filter_matrix_format, commandline_args.minimum_coverage,
+                               commandline_args.minimum_proportion, commandline_args.num_threads)
+    else:
+        parse_input_files(input_files, commandline_args.num_threads, genomes, commandline_args.minimum_coverage,
+                          commandline_args.minimum_proportion, genome_store)
+        write_output_matrices(genomes, commandline_args.matrix_folder, commandline_args.filter_matrix_format,
+                              commandline_args.num_threads)
     write_stats_data(genomes, commandline_args.stats_folder)
+    if commandline_args.run_state is not None:
+        save_run_input_files(commandline_args.run_state, input_files)
 
 
 if __name__ == "__main__":
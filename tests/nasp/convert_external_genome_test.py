@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from nasp.convert_external_genome import write_frankenfasta
+from nasp.nasp_objects import FastaIndex, MalformedInputFile
+
+
+class FrankenfastaTestCase(unittest.TestCase):
+    """ write_frankenfasta must place the external calls the same way whether the external fasta is indexed or not. """
+
+    DELTA = ("/path/to/reference.fasta /path/to/external.fasta\nNUCMER\n"
+             ">r1 ext1 12 10\n1 10 1 10 0 0 0\n4\n-3\n0\n"
+             ">r2 ext2 8 10\n1 5 10 6 0 0 0\n0\n"
+             ">r1 ext2 12 10\n9 12 1 4 0 0 0\n0\n")
+
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temporary_directory)
+        self.delta_filename = os.path.join(self.temporary_directory, "external.filtered.delta")
+        with open(self.delta_filename, 'w') as delta_handle:
+            delta_handle.write(self.DELTA)
+        self.external_filename = os.path.join(self.temporary_directory, "external.fasta")
+        with open(self.external_filename, 'w') as external_handle:
+            external_handle.write(">ext1 first\nAACCGG\nTTAC\n>ext2\nGGGTTT\nAAAC\n")
+
+    def _write_frankenfasta(self, delta_filename=None):
+        output_handle = BytesIO()
+        write_frankenfasta(delta_filename or self.delta_filename, self.external_filename, output_handle)
+        return output_handle.getvalue()
+
+    def test_alignments(self):
+        # r2 is written first, as its last alignment comes before the last one of r1.  The overlapping alignment on r1
+        # marks its conflicts with an 'N'.
+        self.assertEqual(b">franken::r2\nGTTTAXXX\n>franken::r1\nAAC.CGTTNNGT\n", self._write_frankenfasta())
+
+    def test_not_indexed(self):
+        with open(self.external_filename, 'a') as external_handle:
+            external_handle.write(">unaligned\nAC\nACGT\n")
+        self.assertIsNone(FastaIndex.load(self.external_filename))
+        self.assertEqual(b">franken::r2\nGTTTAXXX\n>franken::r1\nAAC.CGTTNNGT\n", self._write_frankenfasta())
+
+    def test_lowercase_reverse_strand(self):
+        # Calls keep their case whichever strand they are read from, and letters that are not IUPAC codes are kept.
+        with open(self.external_filename, 'w') as external_handle:
+            external_handle.write(">ext1 first\nAACCGG\nTTAC\n>ext2\nGGgtac\ngkmz\n")
+        self.assertEqual(b">franken::r2\nzkmcgXXX\n>franken::r1\nAAC.CGTTNNgt\n", self._write_frankenfasta())
+
+    def test_malformed_alignment(self):
+        with open(self.delta_filename, 'w') as delta_handle:
+            delta_handle.write(self.DELTA.replace("9 12 1 4", "9 12 8 11"))
+        self.assertRaises(MalformedInputFile, self._write_frankenfasta)
+        with open(self.delta_filename, 'w') as delta_handle:
+            delta_handle.write(self.DELTA.replace(">r2 ext2", ">r2 ext3"))
+        self.assertRaises(MalformedInputFile, self._write_frankenfasta)
@@ -93,9 +93,9 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
 
     def test_samtools_view_sort_index_pipe_command(self):
         tests = {
-            'paired_basic': "/path/to/samtools view -S -b -h - | /path/to/samtools sort - '/path/to/output_folder/fake|aligner/fake|aligner-NA10831_ATCACG_L002'; /path/to/samtools index '/path/to/output_folder/fake|aligner/fake|aligner-NA10831_ATCACG_L002.bam'",
+            'paired_basic': "/path/to/samtools view -S -u -h - | /path/to/samtools sort -@ 1 -m 768M - '/path/to/output_folder/fake|aligner/fake|aligner-NA10831_ATCACG_L002' && /path/to/samtools index '/path/to/output_folder/fake|aligner/fake|aligner-NA10831_ATCACG_L002.bam'",
 
-            'paired_pipe': "/path/to/samtools view -S -b -h - | /path/to/samtools sort - '/path/to/output_folder/fake|aligner/fake|aligner-NA|10831_ATCACG_L002'; /path/to/samtools index '/path/to/output_folder/fake|aligner/fake|aligner-NA|10831_ATCACG_L002.bam'",
+            'paired_pipe': "/path/to/samtools view -S -u -h - | /path/to/samtools sort -@ 1 -m 768M - '/path/to/output_folder/fake|aligner/fake|aligner-NA|10831_ATCACG_L002' && /path/to/samtools index '/path/to/output_folder/fake|aligner/fake|aligner-NA|10831_ATCACG_L002.bam'",
         }
 
         for sample_type, expect in tests.items():
@@ -104,6 +104,27 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             self.assertEqual(expect, result, 'Failed {0} test data set'.format(sample_type))
 
 
+    def test_align_sort_index_command(self):
+        expect = ("rm -f '/path/to/output_folder/fake|aligner/sample.aligned' && started=$(date +%s) && "
+                  "{ /path/to/aligner 'NA|10831.fastq' && date +%s > '/path/to/output_folder/fake|aligner/sample.aligned'; } | "
+                  "/path/to/samtools view -S -u -h - | /path/to/samtools sort -@ 4 -m 512M - '/path/to/output_folder/fake|aligner/sample' && "
+                  "sorted=$(date +%s) && aligned=$(cat '/path/to/output_folder/fake|aligner/sample.aligned') && "
+                  "/path/to/samtools index '/path/to/output_folder/fake|aligner/sample.bam' && "
+                  "printf 'align\\t%s\\nsort\\t%s\\nindex\\t%s\\n' $((aligned - started)) $((sorted - aligned)) $(($(date +%s) - sorted)) > '/path/to/output_folder/fake|aligner/sample.timings' && "
+                  "rm -f '/path/to/output_folder/fake|aligner/sample.aligned' /path/to/sample.sai")
+        result = dispatcher._align_sort_index_command("/path/to/aligner 'NA|10831.fastq'", self.samtools.path,
+                                                      '/path/to/output_folder/fake|aligner/sample.bam',
+                                                      dispatcher.AlignmentPlan(4, 4, 512), ('/path/to/sample.sai',))
+        self.assertEqual(expect, result)
+
+
+    def test_plan_alignment(self):
+        self.assertEqual(dispatcher.AlignmentPlan(2, 2, 1024), dispatcher._plan_alignment(self.job_params))
+        self.assertEqual(dispatcher.AlignmentPlan(8, 2, 3072),
+                         dispatcher._plan_alignment({'num_cpus': '8', 'mem_requested': '16', 'sort_cpus': '2', 'sort_mem': '6'}))
+        self.assertEqual(dispatcher.AlignmentPlan(1, 1, 512), dispatcher._plan_alignment({}))
+
+
     def test_bwamem_command(self):
         tests = {
             'paired_basic': "/path/to/bwa mem -R '@RG\\tID:NA10831_ATCACG_L002\\tSM:NA10831_ATCACG_L002' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' -t 2 /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002_R1_001.fastq.gz /path/to/fastq/NA10831_ATCACG_L002_R2_001.fastq.gz",
@@ -124,13 +145,13 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
 
     def test_bwa_command(self):
         tests = {
-            'paired_basic': "/path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002_R1_001.fastq.gz -t 2 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002-R1.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002_R2_001.fastq.gz -t 2 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002-R1.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa sampe -r '@RG\\tID:NA10831_ATCACG_L002\\tSM:NA10831_ATCACG_L002' /path/to/reference/reference.fasta /path/to/output_folder/bwa/NA10831_ATCACG_L002-R1.sai /path/to/output_folder/bwa/NA10831_ATCACG_L002-R2.sai /path/to/fastq/NA10831_ATCACG_L002_R1_001.fastq.gz /path/to/fastq/NA10831_ATCACG_L002_R2_001.fastq.gz -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
+            'paired_basic': "{ /path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002_R1_001.fastq.gz -t 1 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002-R1.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' & /path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002_R2_001.fastq.gz -t 1 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002-R2.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' && wait $!; } && /path/to/bwa sampe -r '@RG\\tID:NA10831_ATCACG_L002\\tSM:NA10831_ATCACG_L002' /path/to/reference/reference.fasta /path/to/output_folder/bwa/NA10831_ATCACG_L002-R1.sai /path/to/output_folder/bwa/NA10831_ATCACG_L002-R2.sai /path/to/fastq/NA10831_ATCACG_L002_R1_001.fastq.gz /path/to/fastq/NA10831_ATCACG_L002_R2_001.fastq.gz -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
 
-            'paired_pipe': "/path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' -t 2 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -t 2 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa sampe -r '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' /path/to/reference/reference.fasta '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R2.sai' '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
+            'paired_pipe': "{ /path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' -t 1 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' & /path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -t 1 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R2.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' && wait $!; } && /path/to/bwa sampe -r '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' /path/to/reference/reference.fasta '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R2.sai' '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
 
-            'single_basic': "/path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002.fastq.gz -t 2 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa samse -r '@RG\\tID:NA10831_ATCACG_L002\\tSM:NA10831_ATCACG_L002' /path/to/reference/reference.fasta /path/to/output_folder/bwa/NA10831_ATCACG_L002.sai /path/to/fastq/NA10831_ATCACG_L002.fastq.gz -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
+            'single_basic': "/path/to/bwa aln  /path/to/reference/reference.fasta /path/to/fastq/NA10831_ATCACG_L002.fastq.gz -t 2 -f /path/to/output_folder/bwa/NA10831_ATCACG_L002.sai -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' && /path/to/bwa samse -r '@RG\\tID:NA10831_ATCACG_L002\\tSM:NA10831_ATCACG_L002' /path/to/reference/reference.fasta /path/to/output_folder/bwa/NA10831_ATCACG_L002.sai /path/to/fastq/NA10831_ATCACG_L002.fastq.gz -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
 
-            'single_pipe': "/path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002.fastq.gz' -t 2 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa samse -r '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' /path/to/reference/reference.fasta '/path/to/output_folder/bwa/NA|10831_ATCACG_L002.sai' '/path/to/fastq/NA|10831_ATCACG_L002.fastq.gz' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'"
+            'single_pipe': "/path/to/bwa aln  /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002.fastq.gz' -t 2 -f '/path/to/output_folder/bwa/NA|10831_ATCACG_L002.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' && /path/to/bwa samse -r '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' /path/to/reference/reference.fasta '/path/to/output_folder/bwa/NA|10831_ATCACG_L002.sai' '/path/to/fastq/NA|10831_ATCACG_L002.fastq.gz' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'"
         }
 
         bwa = self.aligners['bwa']
@@ -202,13 +223,18 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             'output_folder': self.output_folder
         }
 
+        # The aligner streams into samtools sort, which gets both cores and half of the memory, see
+        # test_align_sort_index_command.
+        expected_command = dispatcher._align_sort_index_command(
+            "/path/to/bowtie2 --very-sensitive-local --un 'pipe|in|name.fastq.gz' --al 'space in name.fastq.gz' --threads 2 --rg 'SM:NA|10831_ATCACG_L002' --rg-id 'NA|10831_ATCACG_L002' -x /path/to/reference/reference -1 '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' -2 '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz'",
+            self.samtools.path, '/path/to/output_folder/bowtie2/NA|10831_ATCACG_L002-bowtie2.bam', dispatcher.AlignmentPlan(2, 2, 1024))
         expected_submit_job_calls = [
             call(
                 'pbs',
-                "/path/to/bowtie2 --very-sensitive-local --un 'pipe|in|name.fastq.gz' --al 'space in name.fastq.gz' --threads 2 --rg 'SM:NA|10831_ATCACG_L002' --rg-id 'NA|10831_ATCACG_L002' -x reference -1 'NA|10831_ATCACG_L002_R1_001.fastq.gz' -2 'NA|10831_ATCACG_L002_R2_001.fastq.gz'",
-                {'work_dir': 'output_folder/bowtie2', 'queue': 'test|queue', 'name': 'nasp_bowtie2_NA|10831_ATCACG_L002', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'walltime': 6, 'mem_requested': 4, 'num_cpus': 2},
+                expected_command,
+                {'work_dir': '/path/to/output_folder/bowtie2', 'queue': 'test|queue', 'name': 'nasp_bowtie2_NA|10831_ATCACG_L002', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'walltime': 6, 'mem_requested': 4, 'num_cpus': 2},
                 (('jobid', 'action'),)
-            ),
+            )
         ]
 
         dispatcher._align_reads(self.assemblies['paired_pipe'], configuration, self.index_job_id, self.reference)
@@ -223,11 +249,18 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             'output_folder': self.output_folder
         }
 
+        # The aligner streams into samtools sort, which gets both cores and half of the memory, see
+        # test_align_sort_index_command.
+        expected_command = dispatcher._align_sort_index_command(
+            dispatcher._bwa_command(self.aligners['bwa'].path, self.aligners['bwa'].args, 2, self.reference,
+                                    self.output_folder, *self.assemblies['paired_pipe']),
+            self.samtools.path, '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-bwa.bam', dispatcher.AlignmentPlan(2, 2, 1024),
+            ('/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R1.sai', '/path/to/output_folder/bwa/NA|10831_ATCACG_L002-R2.sai'))
         expected_submit_job_calls = [
             call(
                 'pbs',
-                "/path/to/bwa aln  reference.fasta 'NA|10831_ATCACG_L002_R1_001.fastq.gz' -t 2 -f 'output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa aln  reference.fasta 'NA|10831_ATCACG_L002_R2_001.fastq.gz' -t 2 -f 'output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'; /path/to/bwa sampe -r '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' reference.fasta 'output_folder/bwa/NA|10831_ATCACG_L002-R1.sai' 'output_folder/bwa/NA|10831_ATCACG_L002-R2.sai' 'NA|10831_ATCACG_L002_R1_001.fastq.gz' 'NA|10831_ATCACG_L002_R2_001.fastq.gz' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0'",
-                {'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'work_dir': 'output_folder/bwa', 'queue': 'test|queue', 'num_cpus': 2, 'name': 'nasp_bwa_NA|10831_ATCACG_L002', 'mem_requested': 4, 'walltime': 6},
+                expected_command,
+                {'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'work_dir': '/path/to/output_folder/bwa', 'queue': 'test|queue', 'num_cpus': 2, 'name': 'nasp_bwa_NA|10831_ATCACG_L002', 'mem_requested': 4, 'walltime': 6},
                 (('jobid', 'action'),)
             )
         ]
@@ -244,13 +277,18 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             'output_folder': self.output_folder
         }
 
+        # The aligner streams into samtools sort, which gets both cores and half of the memory, see
+        # test_align_sort_index_command.
+        expected_command = dispatcher._align_sort_index_command(
+            "/path/to/bwa mem -R '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' -t 2 /path/to/reference/reference.fasta '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz'",
+            self.samtools.path, '/path/to/output_folder/bwamem/NA|10831_ATCACG_L002-bwamem.bam', dispatcher.AlignmentPlan(2, 2, 1024))
         expected_submit_job_calls = [
             call(
                 'pbs',
-                "/path/to/bwa mem -R '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' -x '-k17 -W40 -r10 -A1 -B1 -O1 -E1 -L0' -t 2 reference.fasta 'NA|10831_ATCACG_L002_R1_001.fastq.gz' 'NA|10831_ATCACG_L002_R2_001.fastq.gz'",
-                {'work_dir': 'output_folder/bwamem', 'queue': 'test|queue', 'name': 'nasp_bwamem_NA|10831_ATCACG_L002', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'walltime': 6, 'mem_requested': 4, 'num_cpus': 2},
+                expected_command,
+                {'work_dir': '/path/to/output_folder/bwamem', 'queue': 'test|queue', 'name': 'nasp_bwamem_NA|10831_ATCACG_L002', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'walltime': 6, 'mem_requested': 4, 'num_cpus': 2},
                 (('jobid', 'action'),)
-            ),
+            )
         ]
 
         dispatcher._align_reads(self.assemblies['paired_pipe'], configuration, self.index_job_id, self.reference)
@@ -265,11 +303,16 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             'output_folder': self.output_folder
         }
 
+        # The aligner streams into samtools sort, which gets both cores and half of the memory, see
+        # test_align_sort_index_command.
+        expected_command = dispatcher._align_sort_index_command(
+            "/path/to/novoalign -d /path/to/reference/reference.fasta.idx -f '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -i PE 500,100 -c 2 -o SAM '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' -K mismatch:stats.txt -i MP 99-99 99,99",
+            self.samtools.path, '/path/to/output_folder/novo/NA|10831_ATCACG_L002-novo.bam', dispatcher.AlignmentPlan(2, 2, 1024))
         expected_submit_job_calls = [
             call(
                 'pbs',
-                "/path/to/novoalign -d reference.fasta.idx -f 'NA|10831_ATCACG_L002_R1_001.fastq.gz' 'NA|10831_ATCACG_L002_R2_001.fastq.gz' -i PE 500,100 -c 2 -o SAM '@RG\\tID:NA|10831_ATCACG_L002\\tSM:NA|10831_ATCACG_L002' -K mismatch:stats.txt -i MP 99-99 99,99",
-                {'name': 'nasp_novo_NA|10831_ATCACG_L002', 'queue': 'test|queue', 'mem_requested': 4, 'walltime': 6, 'num_cpus': 2, 'work_dir': 'output_folder/novo', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|'},
+                expected_command,
+                {'name': 'nasp_novo_NA|10831_ATCACG_L002', 'queue': 'test|queue', 'mem_requested': 4, 'walltime': 6, 'num_cpus': 2, 'work_dir': '/path/to/output_folder/novo', 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|'},
                 (('jobid', 'action'),)
             )
         ]
@@ -286,11 +329,16 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
             'output_folder': self.output_folder
         }
 
+        # The aligner streams into samtools sort, which gets both cores and half of the memory, see
+        # test_align_sort_index_command.
+        expected_command = dispatcher._align_sort_index_command(
+            "/path/to/snap paired /path/to/output_folder/reference/snap '/path/to/fastq/NA|10831_ATCACG_L002_R1_001.fastq.gz' '/path/to/fastq/NA|10831_ATCACG_L002_R2_001.fastq.gz' -t 2 -b --TODO -o sam -",
+            self.samtools.path, '/path/to/output_folder/snap/NA|10831_ATCACG_L002-snap.bam', dispatcher.AlignmentPlan(2, 2, 1024))
         expected_submit_job_calls = [
             call(
                 'pbs',
-                "/path/to/snap paired output_folder/reference/snap 'NA|10831_ATCACG_L002_R1_001.fastq.gz' 'NA|10831_ATCACG_L002_R2_001.fastq.gz' -t 2 -b --TODO -o sam -",
-                {'walltime': 6, 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'num_cpus': 2, 'name': 'nasp_snap_NA|10831_ATCACG_L002', 'queue': 'test|queue', 'mem_requested': 4, 'work_dir': 'output_folder/snap'},
+                expected_command,
+                {'walltime': 6, 'args': '--fake-job-parameter -f |ake -j o|b -p arameter|', 'num_cpus': 2, 'name': 'nasp_snap_NA|10831_ATCACG_L002', 'queue': 'test|queue', 'mem_requested': 4, 'work_dir': '/path/to/output_folder/snap'},
                 (('jobid', 'action'),)
             )
         ]
@@ -361,3 +409,285 @@ class DispatcherShellEscapeCommandsTestCase(unittest.TestCase):
         result = dispatcher._slurm_command(**self.job_params)
         self.assertEqual(expect, result)
 
+
+
+class DispatcherStageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.mock_submit_job = Mock(side_effect=(str(n) for n in itertools.count(start=1, step=1)))
+        self.addCleanup(setattr, dispatcher, '_submit_job', dispatcher._submit_job)
+        dispatcher._submit_job = self.mock_submit_job
+        dispatcher._stage_keys.clear()
+
+        self.output_folder = tempfile.mkdtemp()
+        self.reference = os.path.join(self.output_folder, 'reference', 'reference.fasta')
+        os.makedirs(os.path.dirname(self.reference))
+        with open(self.reference, 'w') as reference_handle:
+            reference_handle.write(">contig\nACGT\n")
+        self.configuration = {
+            'output_folder': self.output_folder,
+            'job_submitter': 'NONE',
+            'force': 'False',
+            'dup_finder': ('DupFinder', '/path/to/nucmer', '', {}),
+        }
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.output_folder)
+
+    def _run_find_dups(self):
+        """ Runs the submitted duplicates stage as the job would: its output is written, then its stamp. """
+        import subprocess
+
+        (_, final_file) = dispatcher._find_dups(self.configuration, None, self.reference)
+        with open(final_file, 'w') as final_handle:
+            final_handle.write("contig\t0000\n")
+        (_, command) = self.mock_submit_job.call_args[0][0:2]
+        subprocess.check_call(command.split("\n")[-1], shell=True)
+
+    def test_find_dups_up_to_date(self):
+        self._run_find_dups()
+        dispatcher._stage_keys.clear()
+        (job_id, final_file) = dispatcher._find_dups(self.configuration, None, self.reference)
+        self.assertEqual(dispatcher.CACHED_JOB_ID, job_id)
+        self.assertEqual(os.path.join(self.output_folder, 'reference', 'duplicates.txt'), final_file)
+        self.assertEqual(1, self.mock_submit_job.call_count)
+
+    def test_find_dups_changed_input(self):
+        self._run_find_dups()
+        dispatcher._stage_keys.clear()
+        with open(self.reference, 'a') as reference_handle:
+            reference_handle.write(">other\nACGT\n")
+        (job_id, _) = dispatcher._find_dups(self.configuration, None, self.reference)
+        self.assertEqual('2', job_id)
+
+    def test_find_dups_changed_upstream_stage(self):
+        self._run_find_dups()
+        dispatcher._stage_keys.clear()
+        dispatcher._stage_keys[os.path.abspath(self.reference)] = 'new reference stage'
+        (job_id, _) = dispatcher._find_dups(self.configuration, None, self.reference)
+        self.assertEqual('2', job_id)
+
+    def test_find_dups_force(self):
+        self._run_find_dups()
+        dispatcher._stage_keys.clear()
+        self.configuration['force'] = 'True'
+        (job_id, _) = dispatcher._find_dups(self.configuration, None, self.reference)
+        self.assertEqual('2', job_id)
+        self.assertEqual("find_duplicates --nucmerpath /path/to/nucmer --reference %s" % self.reference,
+                         self.mock_submit_job.call_args[0][1])
+
+    def test_convert_external_genomes(self):
+        from unittest.mock import patch
+        from nasp import convert_external_genome
+
+        self.configuration['assembly_importer'] = ('AssemblyImporter', '/path/to/delta-filter', '', {'num_cpus': '4'})
+        self.configuration['assemblies'] = []
+        for name in ('a', 'b', 'c', 'd'):
+            fasta = os.path.join(self.output_folder, name + '.fasta')
+            with open(fasta, 'w') as fasta_handle:
+                fasta_handle.write(">contig\nACGT\n")
+            self.configuration['assemblies'].append((name, fasta))
+        new_assembly = self.configuration['assemblies'].pop()
+        (job_id, franken_fastas) = dispatcher._convert_external_genomes(self.configuration, None, self.reference)
+        self.assertEqual('1', job_id)
+        self.assertEqual(1, self.mock_submit_job.call_count)
+        self.assertEqual([(name, os.path.join(self.output_folder, 'external', name + '.frankenfasta')) for name in
+                          ('a', 'b', 'c')], franken_fastas)
+        manifest = os.path.join(self.output_folder, 'external', 'external_genomes.manifest')
+        self.assertEqual("convert_external_genome --nucmerpath /path/to/nucmer --nucmerargs '' --deltafilterpath "
+                         "/path/to/delta-filter --deltafilterargs '' --reference %s --manifest %s --numthreads 4" % (
+                             self.reference, manifest), self.mock_submit_job.call_args[0][1])
+        external_genomes = convert_external_genome.read_manifest(manifest)
+        self.assertEqual(self.configuration['assemblies'], [external_genome[0:2] for external_genome in external_genomes])
+
+        # Run the workers of the job, with 'c' failing: the others are still stamped as they are converted.
+        def generate_delta_file(*args):
+            if args[4] == 'c':
+                raise OSError("nucmer failed")
+
+        def write_frankenfasta(delta_filename, external_filename, output_handle):
+            output_handle.write(b">franken::contig\nACGT\n")
+
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(os.path.join(self.output_folder, 'external'))
+        convert_external_genome._set_conversion_options(self.reference, '/path/to/nucmer', '', '/path/to/delta-filter', '')
+        with patch.object(convert_external_genome, 'generate_delta_file', generate_delta_file), \
+                patch.object(convert_external_genome, 'write_frankenfasta', write_frankenfasta), \
+                patch.object(convert_external_genome.logging, 'exception'):
+            conversion_errors = [convert_external_genome.convert_external_genome(external_genome) for
+                                 external_genome in external_genomes]
+        self.assertEqual([None, None, "c: nucmer failed"], conversion_errors)
+        dispatcher._stage_keys.clear()
+        # Only the external genome that failed is converted again, on its own.
+        (job_id, franken_fastas) = dispatcher._convert_external_genomes(self.configuration, None, self.reference)
+        self.assertEqual('2', job_id)
+        self.assertEqual("format_fasta --inputfasta %s --outputfasta %s --index" % (
+            self.configuration['assemblies'][2][1], os.path.join(self.output_folder, 'external', 'c.fasta')),
+                         self.mock_submit_job.call_args[0][1].split("\n")[1])
+        # With a new external genome, the two that are not up to date are converted together.
+        self.configuration['assemblies'].append(new_assembly)
+        dispatcher._stage_keys.clear()
+        (job_id, franken_fastas) = dispatcher._convert_external_genomes(self.configuration, None, self.reference)
+        self.assertEqual('3', job_id)
+        self.assertEqual(4, len(franken_fastas))
+        self.assertEqual(['c', 'd'], [external_genome[0] for external_genome in
+                                      convert_external_genome.read_manifest(manifest)])
+
+    def test_get_pending_jobs(self):
+        self.assertEqual(('1:2', 'afterany'), dispatcher._get_pending_jobs(('1:cached:2', 'afterany')))
+        self.assertIsNone(dispatcher._get_pending_jobs((dispatcher.CACHED_JOB_ID,)))
+        self.assertIsNone(dispatcher._get_pending_jobs(None))
+
+
+class DispatcherLocalExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.work_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.work_dir, 'log.txt')
+        self.executor = dispatcher._LocalExecutor(num_cpus=2, mem_gb=8)
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.work_dir)
+
+    def _submit(self, name, command, waitfor_id=None, num_cpus=1, mem_requested=1):
+        job_parms = {'name': name, 'work_dir': self.work_dir, 'num_cpus': num_cpus, 'mem_requested': mem_requested}
+        return self.executor.submit(command, job_parms, waitfor_id)
+
+    def _read_log(self):
+        with open(self.log_file) as log_handle:
+            return log_handle.read().split()
+
+    def test_dependencies(self):
+        first_job = self._submit('first', "sleep 0.2; echo first >> log.txt")
+        second_job = self._submit('second', "echo second >> log.txt", (first_job,))
+        self._submit('third', "echo third >> log.txt", ("%s:%s" % (first_job, second_job),))
+        self.assertEqual([], self.executor.run())
+        self.assertEqual(['first', 'second', 'third'], self._read_log())
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, 'first.out')))
+
+    def test_failure(self):
+        failed_job = self._submit('failed', "exit 3")
+        skipped_job = self._submit('skipped', "echo skipped >> log.txt", (failed_job,))
+        self._submit('also_skipped', "echo also_skipped >> log.txt", (skipped_job,))
+        self._submit('afterany', "echo afterany >> log.txt", (failed_job, 'afterany'))
+        self.assertEqual(['failed', 'skipped', 'also_skipped'], self.executor.run())
+        self.assertEqual(['afterany'], self._read_log())
+
+    def test_packing(self):
+        # Two single core jobs share the two cores, then a two core job waits for both to finish.
+        self._submit('small1', "echo start >> log.txt; sleep 0.3; echo end >> log.txt")
+        self._submit('small2', "echo start >> log.txt; sleep 0.3; echo end >> log.txt")
+        self._submit('large', "echo large >> log.txt", num_cpus=2)
+        self.assertEqual([], self.executor.run())
+        self.assertEqual(['start', 'start', 'end', 'end', 'large'], self._read_log())
+
+    def test_memory(self):
+        # Jobs that need more memory than is free wait for each other, and requests larger than the machine are
+        # scaled down to it.
+        self._submit('big1', "echo start >> log.txt; sleep 0.2; echo end >> log.txt", mem_requested=6)
+        self._submit('big2', "echo start >> log.txt; sleep 0.2; echo end >> log.txt", mem_requested=64)
+        self.assertEqual([], self.executor.run())
+        self.assertEqual(['start', 'end', 'start', 'end'], self._read_log())
+
+    def test_memory_rounding(self):
+        # A job scaled down to all of the memory still runs once the jobs before it, whose memory does not add up
+        # exactly in floating point, have finished.
+        self.executor = dispatcher._LocalExecutor(num_cpus=4, mem_gb=7.7)
+        first_job = self._submit('first', "echo first >> log.txt", mem_requested=0.1)
+        second_job = self._submit('second', "echo second >> log.txt", mem_requested=1.1)
+        self._submit('big', "echo big >> log.txt", ("%s:%s" % (first_job, second_job),), mem_requested=100)
+        self.assertEqual([], self.executor.run())
+        self.assertEqual(['big'], self._read_log()[2:])
+
+    def test_unset_resources(self):
+        # The configuration parser leaves unset num_cpus and mem_requested empty: each job takes a core and no memory.
+        self._submit('unset1', "echo start >> log.txt; sleep 0.2; echo end >> log.txt", num_cpus='', mem_requested='')
+        self._submit('unset2', "echo start >> log.txt; sleep 0.2; echo end >> log.txt", num_cpus='', mem_requested='')
+        self._submit('large', "echo large >> log.txt", num_cpus=2, mem_requested=8)
+        self.assertEqual([], self.executor.run())
+        self.assertEqual(['start', 'start', 'end', 'end', 'large'], self._read_log())
+
+
+class DispatcherJobArrayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.mock_submit_job = Mock(side_effect=(str(n) for n in itertools.count(start=1, step=1)))
+        self.addCleanup(setattr, dispatcher, '_submit_job', dispatcher._submit_job)
+        dispatcher._submit_job = self.mock_submit_job
+        self.work_dir = tempfile.mkdtemp()
+        self.array_folder = os.path.join(self.work_dir, 'job_arrays')
+        self.job_arrays = dispatcher._JobArrays()
+        self.job_arrays.start('SLURM', self.array_folder)
+        self.job_parms = {'name': 'test', 'work_dir': self.work_dir, 'num_cpus': 1, 'mem_requested': 1, 'walltime': 1,
+                          'queue': '', 'args': ''}
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.work_dir)
+
+    def test_submit(self):
+        align_tasks = [self.job_arrays.add('nasp_bwamem', sample, "bwa mem %s" % sample, self.job_parms, ('index',))
+                       for sample in ['sample1', 'sample2']]
+        gatk_tasks = [self.job_arrays.add('nasp_gatk', sample, "gatk %s\ntouch %s.vcf" % (sample, sample),
+                                          self.job_parms, (align_task,))
+                      for (sample, align_task) in zip(['sample1', 'sample2'], align_tasks)]
+        self.job_arrays.submit()
+        self.assertFalse(self.job_arrays.collecting)
+        runner = os.path.join(self.array_folder, 'run_array_task.sh')
+        self.mock_submit_job.assert_has_calls([
+            call('SLURM', "sh %s %s" % (runner, os.path.join(self.array_folder, 'nasp_bwamem-1.manifest')),
+                 dict(self.job_parms, name='nasp_bwamem'), ('index',), array_size=2, array_waitfor=None),
+            call('SLURM', "sh %s %s" % (runner, os.path.join(self.array_folder, 'nasp_gatk-2.manifest')),
+                 dict(self.job_parms, name='nasp_gatk'), None, array_size=2, array_waitfor='1'),
+        ])
+        self.assertEqual(['1', '1'], [self.job_arrays.get_job_id(task) for task in align_tasks])
+        self.assertEqual(['2', '2'], [self.job_arrays.get_job_id(task) for task in gatk_tasks])
+        self.assertEqual('index', self.job_arrays.get_job_id('index'))
+        with open(os.path.join(self.array_folder, 'nasp_gatk-2.manifest')) as manifest_handle:
+            self.assertEqual("1\tsample1\t{0}\tgatk sample1; touch sample1.vcf\n"
+                             "2\tsample2\t{0}\tgatk sample2; touch sample2.vcf\n".format(self.work_dir),
+                             manifest_handle.read())
+
+    def test_unmatched_tasks(self):
+        # The second sample was up to date for the first stage, so the tasks of the arrays no longer match up and the
+        # second array waits for all of the first.
+        first_task = self.job_arrays.add('nasp_bwamem', 'sample1', "bwa mem sample1", self.job_parms, ('index',))
+        self.job_arrays.add('nasp_gatk', 'sample2', "gatk sample2", self.job_parms, (dispatcher.CACHED_JOB_ID,))
+        self.job_arrays.add('nasp_gatk', 'sample1', "gatk sample1", self.job_parms, (first_task,))
+        self.job_arrays.add('nasp_gatk', 'sample3', "gatk sample3", self.job_parms, (first_task,))
+        self.job_arrays.submit()
+        self.assertEqual(3, self.mock_submit_job.call_count)
+        self.assertEqual(((None,), {'array_size': 1, 'array_waitfor': None}),
+                         (self.mock_submit_job.call_args_list[1][0][3:], self.mock_submit_job.call_args_list[1][1]))
+        self.assertEqual(((('1',),), {'array_size': 2, 'array_waitfor': None}),
+                         (self.mock_submit_job.call_args_list[2][0][3:], self.mock_submit_job.call_args_list[2][1]))
+
+    def test_run_array_task(self):
+        import subprocess
+
+        self.job_arrays.add('nasp_test', 'sample1', "echo sample1 > out.txt", self.job_parms)
+        self.job_arrays.add('nasp_test', 'sample2', "echo 'sample 2' |\tcat > out.txt\ntouch done", self.job_parms)
+        self.job_arrays.submit()
+        environment = dict(os.environ, SLURM_ARRAY_TASK_ID='2')
+        subprocess.check_call(self.mock_submit_job.call_args[0][1], shell=True, env=environment)
+        with open(os.path.join(self.work_dir, 'out.txt')) as out_handle:
+            self.assertEqual("sample 2\n", out_handle.read())
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, 'done')))
+
+    def test_array_commands(self):
+        self.assertEqual("sbatch -D dir -c 1 --mem=1000 --time=1:00:00 --mail-type=FAIL -J name -d afterok:1:2,aftercorr:3 --array=1-5",
+                         dispatcher._slurm_command('name', 'dir', waitfor_id=('1:2',), array_size=5, array_waitfor='3'))
+        self.assertEqual("qsub -V -d dir -w dir -l ncpus=1,mem=1gb,walltime=1:00:00 -m a -N name -W 'depend=afterany:1,afteranyarray:2[],afterokarray:3[]' -t 1-5",
+                         dispatcher._pbs_command('name', 'dir', waitfor_id=('1:2[]', 'afterany'), array_size=5,
+                                                 array_waitfor='3[]'))
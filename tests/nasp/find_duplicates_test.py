@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nasp.find_duplicates import merge_intervals, read_delta_intervals, parse_delta_file
+from nasp.nasp_objects import GenomeStatus
+
+
+class FindDuplicatesTestCase(unittest.TestCase):
+    """ find_duplicates must mark the same positions as the regex and list splicing version did. """
+
+    # c1 to itself: the self-alignment, and a repeat both ways.  c1 to c2: a nested, an adjacent, a separate and a
+    # reverse strand hit.  c2 to c1: a reverse strand hit that overlaps one on c2.
+    DELTA = ("/path/to/reference.fasta /path/to/reference.fasta\nNUCMER\n"
+             ">c1 c1 30 30\n1 30 1 30 0 0 0\n0\n3 8 20 25 0 0 0\n0\n20 25 3 8 0 0 0\n0\n"
+             ">c1 c2 30 12\n5 7 12 10 1 1 0\n2\n0\n9 10 1 2 0 0 0\n0\n12 13 4 5 0 0 0\n0\n"
+             ">c2 c1 12 30\n4 6 18 16 0 0 0\n0\n")
+
+    # duplicates.txt as written from DELTA before the intervals were merged.
+    DUPLICATES = ">c1\n001111111101100111011111100000\n>c2\n110111000111\n"
+
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temporary_directory)
+        self.delta_filename = os.path.join(self.temporary_directory, "reference.delta")
+        with open(self.delta_filename, 'w') as delta_handle:
+            delta_handle.write(self.DELTA)
+
+    def test_merge_intervals(self):
+        self.assertEqual([], merge_intervals([]))
+        # Overlapping, adjacent and nested intervals are joined, and separate ones are kept.
+        self.assertEqual([( 1, 10 ), ( 12, 13 ), ( 20, 30 )],
+                         merge_intervals([( 20, 25 ), ( 3, 8 ), ( 5, 6 ), ( 9, 10 ), ( 1, 4 ), ( 12, 13 ), ( 24, 30 )]))
+        self.assertEqual([( 5, 9 )], merge_intervals([( 5, 9 ), ( 5, 7 ), ( 6, 9 )]))
+
+    def test_read_delta_intervals(self):
+        ( contig_lengths, dup_intervals ) = read_delta_intervals(self.delta_filename)
+        self.assertEqual({"c1": 30, "c2": 12}, contig_lengths)
+        # The self-alignment of c1 is ignored, and reverse strand hits are read from their lower end.
+        self.assertEqual({"c1": [( 3, 10 ), ( 12, 13 ), ( 16, 18 ), ( 20, 25 )], "c2": [( 1, 2 ), ( 4, 6 ), ( 10, 12 )]},
+                         dup_intervals)
+
+    def test_self_alignments_only(self):
+        with open(self.delta_filename, 'w') as delta_handle:
+            delta_handle.write(self.DELTA.split(">c1 c1")[0] + ">c1 c1 30 30\n1 30 1 30 0 0 0\n0\n1 29 1 30 0 0 0\n0\n")
+        self.assertEqual(( {"c1": 30}, {"c1": []} ), read_delta_intervals(self.delta_filename))
+
+    def test_duplicates_file(self):
+        duplicates_filename = os.path.join(self.temporary_directory, "duplicates.txt")
+        for compact in ( False, True ):
+            dups_data = GenomeStatus(compact=compact)
+            parse_delta_file(self.delta_filename, dups_data)
+            dups_data.write_to_fasta_file(duplicates_filename)
+            with open(duplicates_filename) as duplicates_handle:
+                self.assertEqual(self.DUPLICATES, duplicates_handle.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nasp import format_fasta as format_fasta_module
+from nasp.format_fasta import format_fasta
+from nasp.nasp_objects import MalformedInputFile
+
+
+class FormatFastaTestCase(unittest.TestCase):
+    """ format_fasta must write what Genome.write_to_fasta_file would, with the .fai samtools would. """
+
+    def setUp(self):
+        self.temporary_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temporary_directory)
+        self.input_filename = os.path.join(self.temporary_directory, "input.fasta")
+        self.output_filename = os.path.join(self.temporary_directory, "output.fasta")
+
+    def _format_fasta(self, input_fasta, write_index=False, max_chars_per_line=80):
+        with open(self.input_filename, 'wb') as input_handle:
+            input_handle.write(input_fasta)
+        format_fasta(self.input_filename, self.output_filename, write_index, max_chars_per_line)
+        with open(self.output_filename, 'rb') as output_handle:
+            return output_handle.read()
+
+    def test_sorted(self):
+        self.assertEqual(b">c1\nACGTA\nCGT\n>c2\nGGGG\n",
+                         self._format_fasta(b">c1 first\r\nACG\r\nTACGT  \r\n>c2\nGG\n12 3\nGG\n", max_chars_per_line=5))
+        self.assertFalse(os.path.exists(self.output_filename + ".fai"))
+
+    def test_unsorted_and_duplicates(self):
+        self.assertEqual(b">c1\nAAAAC\nCCTT\n>c2\nGGGG\n>c3\n",
+                         self._format_fasta(b">c2\nGGGG\n>c1\nAAAA\n>c3\n>c1\nCCC\nTT\n", max_chars_per_line=5))
+
+    def test_index(self):
+        self._format_fasta(b">c2\nGGGG\n>c1\nAAAA\nCCC\nTT\n>c3\n", write_index=True, max_chars_per_line=5)
+        with open(self.output_filename + ".fai") as index_handle:
+            self.assertEqual("c1\t9\t4\t5\t6\nc2\t4\t19\t4\t5\nc3\t0\t28\t0\t0\n", index_handle.read())
+
+    def test_single_line_contig(self):
+        # A contig on one line longer than a block is written as it is read, and indexed the same.
+        contig_calls = b"ACGTN" * ( format_fasta_module._BLOCK_SIZE // 5 + 3 )
+        formatted_fasta = self._format_fasta(b">c2\n" + contig_calls + b"\n>c1\nAC\n", write_index=True)
+        self.assertEqual(b">c1\nAC\n>c2\n" + b"\n".join(contig_calls[line_start:line_start + 80] for line_start in
+                                                       range(0, len(contig_calls), 80)) + b"\n", formatted_fasta)
+        with open(self.output_filename + ".fai") as index_handle:
+            self.assertEqual("c1\t2\t4\t2\t3\nc2\t%s\t11\t80\t81\n" % len(contig_calls), index_handle.read())
+
+    def test_line_across_blocks(self):
+        # A line that spans blocks is taken back when a later block shows it is not calls, as a line read whole is.
+        self.addCleanup(setattr, format_fasta_module, '_BLOCK_SIZE', format_fasta_module._BLOCK_SIZE)
+        format_fasta_module._BLOCK_SIZE = 4
+        input_fasta = b">c1\nACGTACGTAC\nGGGGGGGGG G\nTTTTTTTTTT  \nCCCCCCCCC*\nAAAA\n"
+        self.assertEqual(b">c1\nACGTA\nCGTAC\nTTTTT\nTTTTT\nAAAA\n",
+                         self._format_fasta(input_fasta, max_chars_per_line=5))
+        self.assertRaises(MalformedInputFile, self._format_fasta, b"ACGTACGTAC\n>c1\nACGT\n")
+
+    def test_calls_before_contig(self):
+        self.assertRaises(MalformedInputFile, self._format_fasta, b"ACGT\n>c1\nACGT\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
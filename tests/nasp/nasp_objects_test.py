@@ -0,0 +1,580 @@
+import gzip
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from io import StringIO
+
+from nasp.nasp_objects import GenomeStatus, Genome, PackedCalls, VCFGenome, FastaGenome, ReferenceGenome, \
+    DuplicateRegions, PatternRegistry, CollectionStatistics, GenomeCollection, VCFRecord, FastaIndex, GenomeStore, MalformedInputFile, \
+    GenomeMeta, open_input_file
+
+
+class CompactGenomeStatusTestCase(unittest.TestCase):
+    """ The compact storage mode must be indistinguishable from the list mode through the public API. """
+
+    def setUp(self):
+        self.genomes = [GenomeStatus(), GenomeStatus(compact=True)]
+
+    def assertAllEqual(self, query):
+        results = [query(genome) for genome in self.genomes]
+        for result in results[1:]:
+            self.assertEqual(results[0], result)
+        return results[0]
+
+    def test_append_and_get_value(self):
+        for genome in self.genomes:
+            genome.append_contig("ACGT", "foo")
+            genome.append_contig(['N', 'X'], "foo")
+        self.assertEqual(['A', 'C', 'G', 'T', 'N', 'X'], self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+        self.assertEqual('G', self.assertAllEqual(lambda genome: genome.get_value(3, None, "foo")))
+        self.assertEqual('?', self.assertAllEqual(lambda genome: genome.get_value(7, None, "foo", "?")))
+        self.assertEqual(['X', '?', '?'], self.assertAllEqual(lambda genome: genome.get_value(6, 8, "foo", "?")))
+
+    def test_set_value_extends_with_filler(self):
+        for genome in self.genomes:
+            genome.set_value("A", 3, "!", "foo")
+            genome.set_value("CG", 5, "X", "foo")
+        self.assertEqual(['!', '!', 'A', 'X', 'C', 'G'], self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+        self.assertEqual(6, self.assertAllEqual(lambda genome: genome.get_contig_length("foo")))
+
+    def test_insertions_and_deletions(self):
+        for genome in self.genomes:
+            genome.append_contig(['A', 'CTT', '', 'G'], "foo")
+        self.assertEqual(['A', 'CTT', '', 'G'], self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+        self.assertEqual('CTT', self.assertAllEqual(lambda genome: genome.get_value(2, None, "foo")))
+        for genome in self.genomes:
+            genome.set_value("T", 2, "X", "foo")
+        self.assertEqual(['A', 'T', '', 'G'], self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+
+    def test_send_to_fasta_handle(self):
+        for genome in self.genomes:
+            genome.append_contig("ACGTACGTAC", "foo")
+            genome.append_contig(['A', 'CTT', 'G'], "bar")
+
+        def fasta(genome):
+            handle = StringIO()
+            genome.send_to_fasta_handle(handle, "franken::", 4)
+            return handle.getvalue()
+
+        self.assertEqual(">franken::bar\nACTTG\n>franken::foo\nACGT\nACGT\nAC\n", self.assertAllEqual(fasta))
+
+    def test_compact_genome_import_fasta(self):
+        genome = Genome(compact=True)
+        genome._import_fasta_line(">franken::foo description\n", "franken::")
+        genome._import_fasta_line("ACGTN.\n")
+        self.assertEqual(['A', 'C', 'G', 'T', 'N', '.'], genome.get_call(1, -1, "foo"))
+
+
+class PackedGenomeTestCase(CompactGenomeStatusTestCase):
+    """ Packed genomes must also be indistinguishable from the list mode, including calls without a 4-bit code. """
+
+    def setUp(self):
+        self.genomes = [Genome(), Genome(compact=True), Genome(packed=True)]
+
+    def test_calls_without_codes(self):
+        for genome in self.genomes:
+            genome.append_contig("acgtBDHVNnx", "foo")
+            genome.set_value("r", 3, "X", "foo")
+        self.assertEqual(list("acrtBDHVNnx"), self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+        self.assertEqual('B', self.assertAllEqual(lambda genome: genome.get_value(5, None, "foo")))
+
+    def test_odd_offsets(self):
+        for genome in self.genomes:
+            genome.append_contig("ACG", "foo")
+            genome.append_contig("TTA", "foo")
+            genome.set_value("CC", 4, "X", "foo")
+            genome.set_value("G", 9, "X", "foo")
+        self.assertEqual(list("ACGCCAXXG"), self.assertAllEqual(lambda genome: genome.get_value(1, -1, "foo")))
+
+    def test_simple_call_packed(self):
+        calls = "ACGTXNU.RYSWKM!-acgtxu"
+        genome = Genome(packed=True)
+        genome.append_contig(list(calls) + ['', 'CTT'], "foo")
+        for allow_x in (False, True):
+            for allow_del in (False, True):
+                expected = ''.join(Genome.simple_call(call, allow_x, allow_del) for call in genome.get_call(1, -1, "foo"))
+                simple_calls = Genome.simple_call_packed(genome._genome["foo"], allow_x, allow_del)
+                self.assertEqual(expected, simple_calls.decode())
+
+    def test_reverse_complement_packed(self):
+        for calls in ("", "A", "ACGTXNU.RYSM", "ACGTXNU.RYSMW"):
+            self.assertEqual(Genome.reverse_complement(calls),
+                             Genome.reverse_complement_packed(PackedCalls(calls.encode())).decode())
+
+
+class DuplicateRegionsTestCase(unittest.TestCase):
+    """ The runs of duplicate region data must query the same as one value per position. """
+
+    def setUp(self):
+        random_source = random.Random(7)
+        self.dups_data = ''.join(random_source.choice("0000000001-") for _ in range(500))
+        self.per_position = GenomeStatus()
+        self.per_position.append_contig(self.dups_data, "foo")
+        self.regions = DuplicateRegions()
+        for line_start in range(0, len(self.dups_data), 80):
+            self.regions.append_contig(self.dups_data[line_start:line_start + 80], "foo")
+
+    def test_get_value(self):
+        self.assertEqual(len(self.dups_data), self.regions.get_contig_length("foo"))
+        for position in range(1, 503):
+            self.assertEqual(self.per_position.get_value(position, None, "foo", "?"),
+                             self.regions.get_value(position, None, "foo", "?"))
+        for ( first_position, last_position ) in [( 1, 500 ), ( 17, 230 ), ( 490, 510 ), ( 501, 510 ), ( 5, -1 )]:
+            self.assertEqual(self.per_position.get_value(first_position, last_position, "foo"),
+                             self.regions.get_value(first_position, last_position, "foo"))
+            self.assertEqual(self.per_position.get_value(first_position, last_position, "foo", "?"),
+                             self.regions.get_value(first_position, last_position, "foo", "?"))
+
+    def test_get_value_bytes_and_mask(self):
+        for ( first_position, last_position ) in [( 1, 500 ), ( 17, 230 ), ( 490, 510 ), ( 501, 510 )]:
+            dups_calls, _ = self.per_position.get_value_bytes(first_position, last_position, "foo", "?")
+            self.assertEqual(dups_calls, self.regions.get_value_bytes(first_position, last_position, "foo", "?"))
+            self.assertEqual(bytearray(1 if call == ord("1") else 0 for call in dups_calls),
+                             self.regions.get_mask(first_position, last_position, "foo"))
+
+    def test_get_window(self):
+        for ( first_position, last_position ) in [( 1, 500 ), ( 17, 230 ), ( 490, 510 ), ( 501, 510 )]:
+            window = self.regions.get_window(first_position, last_position, "foo")
+            expected = self.per_position.get_value(first_position, last_position, "foo")
+            self.assertEqual(len(expected), window.get_contig_length("foo"))
+            self.assertEqual(expected, window.get_value(1, -1, "foo"))
+
+    def test_import_delta_file(self):
+        from nasp.find_duplicates import parse_delta_file
+        delta_file = tempfile.NamedTemporaryFile('w', suffix=".delta", delete=False)
+        self.addCleanup(os.remove, delta_file.name)
+        with delta_file:
+            delta_file.write("/ref.fasta /ref.fasta\nNUCMER\n>foo foo 100 100\n1 100 1 100 0 0 0\n0\n"
+                             "10 20 60 50 1 1 0\n0\n>foo bar 100 30\n15 25 1 11 0 0 0\n0\n")
+        per_position = GenomeStatus()
+        parse_delta_file(delta_file.name, per_position)
+        regions = DuplicateRegions()
+        regions.import_delta_file(delta_file.name)
+        self.assertEqual(per_position.get_contigs(), regions.get_contigs())
+        for contig_name in per_position.get_contigs():
+            self.assertEqual(per_position.get_value(1, -1, contig_name), regions.get_value(1, -1, contig_name))
+
+
+class VCFGenomeFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.genome = VCFGenome()
+
+    def test_unset_filters(self):
+        self.assertEqual('N', self.genome.get_was_called(5, "foo"))
+        self.assertEqual('?', self.genome.get_coverage_pass(5, "foo"))
+        self.assertEqual('?', self.genome.get_proportion_pass(5, "foo"))
+
+    def test_filters_are_independent(self):
+        self.genome.set_was_called('Y', 2, "foo")
+        self.genome.set_coverage_pass('N', 2, "foo")
+        self.genome.set_proportion_pass('-', 3, "foo")
+        self.genome.set_coverage_pass('Y', 2, "foo")
+        self.assertEqual(('Y', 'Y', '?'), (self.genome.get_was_called(2, "foo"), self.genome.get_coverage_pass(2, "foo"),
+                                           self.genome.get_proportion_pass(2, "foo")))
+        self.assertEqual(('N', '?', '-'), (self.genome.get_was_called(3), self.genome.get_coverage_pass(3),
+                                           self.genome.get_proportion_pass(3)))
+
+    def test_contig_getters(self):
+        self.genome.set_was_called('Y', 2, "foo")
+        self.genome.set_coverage_pass('N', 3, "foo")
+        self.genome.set_proportion_pass('Y', 1, "foo")
+        self.assertEqual(b'NYN', self.genome.get_was_called_contig("foo"))
+        self.assertEqual(b'??N??', self.genome.get_coverage_pass_contig("foo", 5))
+        self.assertEqual(b'Y?', self.genome.get_proportion_pass_contig("foo", 2))
+        self.assertEqual(b'', self.genome.get_was_called_contig("bar"))
+
+    def test_filter_runs(self):
+        self.genome.set_coverage_pass('N', 2, "foo")
+        self.genome.set_was_called('YYNY', 2, "foo")
+        self.genome.set_proportion_pass('-Y', 5, "foo")
+        self.assertEqual(b'NYYNYN', self.genome.get_was_called_contig("foo"))
+        self.assertEqual(b'?N????', self.genome.get_coverage_pass_contig("foo"))
+        self.assertEqual(b'????-Y', self.genome.get_proportion_pass_contig("foo"))
+        self.assertRaises(ValueError, self.genome.set_was_called, 'Y?', 1, "foo")
+
+    def test_fasta_genome_contig_getters(self):
+        genome = FastaGenome()
+        genome.append_contig("ACNX", "foo")
+        self.assertEqual(b'YYNNN', genome.get_was_called_contig("foo", 5))
+        self.assertEqual(b'----', genome.get_coverage_pass_contig("foo"))
+
+
+class GenomeStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.scratch_dir, "sample.naspgenome")
+        self.genome = VCFGenome(packed=True, raw_values=True)
+        self.genome.set_file_path("sample.vcf")
+        self.genome.set_nickname("sample")
+        self.genome.add_generators(["bwa", "gatk"])
+        self.genome.set_call("ACGTN" * 3 + "a", 1, "X", "foo")
+        self.genome.set_call(["C", "GTT", "T"], 4, "X", "foo")
+        self.genome.set_call("A", 3, "X", "bar")
+        for raw_index, values in ( ( VCFGenome.RAW_DEPTHS, [12, 4, VCFGenome.RAW_PASS] ),
+                                   ( VCFGenome.RAW_PROPORTIONS, [0.95, 0.5, VCFGenome.RAW_NOT_APPLICABLE] ) ):
+            self.genome.set_raw_values(raw_index, values, 2, "foo")
+        self.genome.set_was_called("YYY", 2, "foo")
+        self.genome.set_was_called("Y", 1, "baz")
+        self.genome.apply_filter_thresholds(10, 0.9)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def assertSameGenome(self, expected, genome):
+        self.assertEqual(( expected.nickname(), expected.file_path(), expected.file_type(), expected._generators ),
+                         ( genome.nickname(), genome.file_path(), genome.file_type(), genome._generators ))
+        self.assertEqual(expected.get_contigs(), genome.get_contigs())
+        for contig_name in ( "foo", "bar", "baz" ):
+            if contig_name in expected.get_contigs():
+                self.assertEqual(expected.get_call(1, -1, contig_name), genome.get_call(1, -1, contig_name))
+            self.assertEqual(expected.get_filter_status(contig_name), genome.get_filter_status(contig_name))
+
+    def test_round_trip(self):
+        GenomeStore.write(self.genome, self.store_path, {'input_file': "sample.vcf"})
+        self.assertEqual({'input_file': "sample.vcf"}, GenomeStore.read_header(self.store_path)[0]['source'])
+        genome = GenomeStore.read(self.store_path)
+        self.assertSameGenome(self.genome, genome)
+        self.assertEqual("GTT", genome.get_call(5, None, "foo"))
+        # Unset raw values are NaN, which is not equal to itself.
+        self.assertEqual(self.genome.get_raw_values(VCFGenome.RAW_DEPTHS, "foo").tobytes(),
+                         genome.get_raw_values(VCFGenome.RAW_DEPTHS, "foo").tobytes())
+        fasta_genome = FastaGenome(packed=True)
+        fasta_genome.set_file_path("sample.fasta")
+        fasta_genome.append_contig("ACGTRyN", "foo")
+        GenomeStore.write(fasta_genome, self.store_path)
+        self.assertEqual(list("ACGTRyN"), GenomeStore.read(self.store_path).get_call(1, -1, "foo"))
+
+    def test_new_thresholds(self):
+        GenomeStore.write(self.genome, self.store_path)
+        self.assertEqual(b'?YN-', GenomeStore.read(self.store_path, 10, 0.9).get_proportion_pass_contig("foo"))
+        genome = GenomeStore.read(self.store_path, 3, 0.4)
+        self.assertEqual(b'?YYY', genome.get_coverage_pass_contig("foo"))
+        self.assertEqual(b'?YY-', genome.get_proportion_pass_contig("foo"))
+        self.assertEqual(b'NYYY', genome.get_was_called_contig("foo"))
+        self.assertFalse(genome.has_raw_values())
+
+    def test_same_thresholds(self):
+        GenomeStore.write(self.genome, self.store_path, filter_thresholds=( 10, 0.9 ))
+        genome = GenomeStore.read(self.store_path, 10.0, 0.9)
+        self.assertFalse(genome.has_raw_values())
+        self.assertSameGenome(self.genome, genome)
+        self.assertEqual(b'?YYY', GenomeStore.read(self.store_path, 3, 0.4).get_coverage_pass_contig("foo"))
+
+    def test_not_a_store(self):
+        self.assertRaises(ValueError, GenomeStore.write, VCFGenome(), self.store_path)
+        with open(self.store_path, 'wb') as store_handle:
+            store_handle.write(b"##fileformat=VCFv4.1\n")
+        self.assertRaises(MalformedInputFile, GenomeStore.read, self.store_path)
+
+
+class OpenInputFileTestCase(unittest.TestCase):
+    """ Compressed input files must read the same as plain ones. """
+
+    TEXT = "".join("{0}\t{1}\n".format(( "foo" if index < 300 else "bar" ), index) for index in range(500))
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.plain_path = os.path.join(self.scratch_dir, "input.txt")
+        with open(self.plain_path, 'w') as plain_handle:
+            plain_handle.write(self.TEXT)
+        self.gzip_path = os.path.join(self.scratch_dir, "input.gz")
+        with gzip.open(self.gzip_path, 'wt') as gzip_handle:
+            gzip_handle.write(self.TEXT)
+        self.bgzf_path = os.path.join(self.scratch_dir, "input.bgz")
+        text_data = self.TEXT.encode()
+        self.write_bgzf(self.bgzf_path, [text_data[block_start:block_start + 100] for block_start in
+                                         range(0, len(text_data), 100)])
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    @staticmethod
+    def write_bgzf(file_path, blocks):
+        """
+        Writes the data of each block as a BGZF block, as bgzip would, and
+        an empty block at the end.  Returns the file offset of each block.
+        """
+        block_offsets = []
+        with open(file_path, 'wb') as bgzf_handle:
+            for block_data in blocks + [b'']:
+                block_offsets.append(bgzf_handle.tell())
+                deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+                compressed_data = deflater.compress(block_data) + deflater.flush()
+                bgzf_handle.write(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                                              len(compressed_data) + 25))
+                bgzf_handle.write(compressed_data)
+                bgzf_handle.write(struct.pack('<II', zlib.crc32(block_data) & 0xffffffff, len(block_data)))
+        return block_offsets[:-1]
+
+    def test_same_as_plain(self):
+        for file_path in ( self.plain_path, self.gzip_path, self.bgzf_path ):
+            for num_threads in ( 1, 3 ):
+                with open_input_file(file_path, 'r', num_threads) as input_handle:
+                    self.assertEqual(self.TEXT.splitlines(True), list(input_handle))
+                with open_input_file(file_path, 'rb', num_threads) as input_handle:
+                    self.assertEqual(self.TEXT.encode(), input_handle.read())
+
+    def test_bgzf_check_fails(self):
+        # Flip the CRC of the last block before the empty one.
+        with open(self.bgzf_path, 'r+b') as bgzf_handle:
+            bgzf_handle.seek(-36, 2)
+            crc_byte = bgzf_handle.read(1)
+            bgzf_handle.seek(-36, 2)
+            bgzf_handle.write(bytes(( crc_byte[0] ^ 255, )))
+        with open_input_file(self.bgzf_path, 'rb', 2) as input_handle:
+            self.assertRaises(MalformedInputFile, input_handle.read)
+
+    def test_compressed_nickname(self):
+        for file_path in ( "/a/s1.frankenfasta", "/a/s1.frankenfasta.gz", "/a/s1.fasta.bgz", "s1.vcf.gz", "s1.vcf.bgzf" ):
+            self.assertEqual("s1", GenomeMeta.generate_nickname_from_filename(file_path))
+
+    def test_compressed_vcf_seek(self):
+        vcf_text = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" + "".join(
+            "{0}\t{1}\t.\tA\t.\t.\tPASS\tDP=9\n".format(contig_name, current_pos) for contig_name in ( "foo", "bar" )
+            for current_pos in range(1, 60))
+        with gzip.open(self.gzip_path, 'wt') as gzip_handle:
+            gzip_handle.write(vcf_text)
+        vcf_record = VCFRecord(self.gzip_path)
+        contig_offsets = vcf_record.index_contigs()
+        self.assertEqual(vcf_text.index("bar"), contig_offsets["bar"])
+        for contig_name in ( "bar", "foo" ):
+            vcf_record.seek(contig_offsets[contig_name])
+            self.assertTrue(vcf_record.fetch_next_record())
+            self.assertEqual(( contig_name, 1 ), ( vcf_record.get_contig(), vcf_record.get_position() ))
+        vcf_record.close()
+
+
+class FetchRegionTestCase(unittest.TestCase):
+    """ fetch_region must find the same records through a tabix index as through the index it builds. """
+
+    CONTIGS = ( ( "foo", list(range(1, 40000, 7)) ), ( "bar", [3, 5, 16385] ) )
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        blocks = [b"##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+        for contig_name, positions in self.CONTIGS:
+            blocks.append("".join("{0}\t{1}\t.\tA\t.\t.\tPASS\tDP=9\n".format(contig_name, current_pos) for
+                                  current_pos in positions).encode())
+        self.vcf_path = os.path.join(self.scratch_dir, "sample.vcf")
+        with open(self.vcf_path, 'wb') as vcf_handle:
+            vcf_handle.writelines(blocks)
+        self.bgzf_path = os.path.join(self.scratch_dir, "sample.vcf.gz")
+        block_offsets = OpenInputFileTestCase.write_bgzf(self.bgzf_path, blocks)
+        # A tabix index with each contig in the level 0 bin, as one chunk of one block.
+        contig_names = b"foo\x00bar\x00"
+        index_data = b"TBI\x01" + struct.pack('<8i', 2, 2, 1, 2, 0, ord('#'), 0, len(contig_names)) + contig_names
+        for block_offset, next_offset in zip(block_offsets[1:], block_offsets[2:] + [os.path.getsize(self.bgzf_path)]):
+            index_data += struct.pack('<iIiQQiQ', 1, 0, 1, block_offset << 16, next_offset << 16, 1, block_offset << 16)
+        with gzip.open(self.bgzf_path + ".tbi", 'wb') as index_handle:
+            index_handle.write(index_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_same_as_scan(self):
+        for file_path in ( self.vcf_path, self.bgzf_path ):
+            vcf_record = VCFRecord(file_path)
+            for contig_name, first_position, last_position in (( "foo", 1, None ), ( "foo", 16380, 20000 ),
+                                                               ( "bar", 4, None ), ( "bar", 20000, None ),
+                                                               ( "baz", 1, 10 )):
+                expected = [current_pos for current_contig, positions in self.CONTIGS if current_contig == contig_name
+                            for current_pos in positions if first_position <= current_pos and (
+                                last_position is None or current_pos <= last_position )]
+                self.assertEqual(expected, list(vcf_record.fetch_region(contig_name, first_position, last_position)))
+            self.assertTrue(vcf_record.fetch_next_record())
+            self.assertEqual(( "foo", 1 ), ( vcf_record.get_contig(), vcf_record.get_position() ))
+            vcf_record.close()
+
+    def test_unsorted_not_indexed(self):
+        with open(self.vcf_path, 'a') as vcf_handle:
+            vcf_handle.write("bar\t4\t.\tA\t.\t.\tPASS\tDP=9\n")
+        vcf_record = VCFRecord(self.vcf_path)
+        self.assertRaises(MalformedInputFile, list, vcf_record.fetch_region("foo"))
+        vcf_record.close()
+
+
+class FastaIndexTestCase(unittest.TestCase):
+    """ Reading a fasta through its index must give the same genome as reading it a line at a time. """
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def _write_fasta(self, fasta_text):
+        fasta_filename = os.path.join(self.scratch_dir, "genome{0}.fasta".format(len(os.listdir(self.scratch_dir))))
+        with open(fasta_filename, 'w', newline='') as fasta_handle:
+            fasta_handle.write(fasta_text)
+        return fasta_filename
+
+    def _import_lines(self, fasta_filename, contig_prefix=""):
+        genome = Genome()
+        with open(fasta_filename) as fasta_handle:
+            for line_from_fasta in fasta_handle:
+                genome._import_fasta_line(line_from_fasta, contig_prefix)
+        return dict(( contig_name, genome.get_call(1, -1, contig_name) ) for contig_name in genome.get_contigs())
+
+    def test_same_as_lines(self):
+        fasta_filename = self._write_fasta(">franken::x desc\nACGT\nAC\n\n>franken::y\n>franken::z\r\nAAA\r\nN\r\n")
+        for use_mmap in ( False, True ):
+            genome = Genome(packed=True)
+            genome.import_fasta_file(fasta_filename, "franken::", use_mmap=use_mmap)
+            self.assertEqual(self._import_lines(fasta_filename, "franken::"), dict(
+                ( contig_name, genome.get_call(1, -1, contig_name) ) for contig_name in genome.get_contigs()))
+        with open(fasta_filename + ".fai") as index_handle:
+            self.assertEqual("franken::x\t6\t17\t4\t5\n", index_handle.readline())
+        fasta_index = FastaIndex.load(fasta_filename, "franken::")
+        self.assertEqual(["x", "y", "z"], fasta_index.get_contigs())
+        self.assertEqual(["GTA", "C", "", "AN"], [fasta_index.get_calls("x", 3, 5), fasta_index.get_calls("x", 6, 9),
+                                                  fasta_index.get_calls("y"), fasta_index.get_calls("z", 3)])
+
+    def test_not_indexable(self):
+        fasta_filename = self._write_fasta(">x\nACGT\nACGTAC\nAC*T\n>y\nGG\n")
+        self.assertIsNone(FastaIndex.load(fasta_filename))
+        self.assertFalse(os.path.exists(fasta_filename + ".fai"))
+        genome = Genome()
+        genome.import_fasta_file(fasta_filename, contig_names=["x"])
+        self.assertEqual(["x"], genome.get_contigs())
+        self.assertEqual(list("ACGTACGTAC"), genome.get_call(1, -1, "x"))
+
+    def test_contig_names(self):
+        fasta_filename = self._write_fasta(">x\nACGT\n>y\nGG\n")
+        genome = Genome(compact=True)
+        genome.import_fasta_file(fasta_filename, contig_names=["y"])
+        self.assertEqual(["y"], genome.get_contigs())
+        self.assertEqual(['G', 'G'], genome.get_call(1, -1, "y"))
+
+
+class PatternRegistryTestCase(unittest.TestCase):
+
+    def test_numbers_in_first_seen_order(self):
+        registry = PatternRegistry()
+        self.assertEqual([1, 2, 1, 3], [registry.get_number(pattern) for pattern in ("11", "12", "11", "21")])
+        self.assertEqual(["11", "12", "21"], registry.get_patterns())
+        self.assertEqual(3, len(PatternRegistry(registry.get_patterns())))
+
+    def test_merge_shards(self):
+        shard_patterns = [["11", "12"], ["12", "22", "11"], ["22", "33"]]
+        registry = PatternRegistry()
+        remaps = [registry.merge(PatternRegistry(patterns)) for patterns in shard_patterns]
+        self.assertEqual([{}, {1: 2, 2: 3, 3: 1}, {1: 3, 2: 4}], remaps)
+        self.assertEqual(["11", "12", "22", "33"], registry.get_patterns())
+
+    def test_remap_matrix_lines(self):
+        matrix_lines = ["LocusID\tPattern\tPattern#\n", "foo::1\t'11'\t1\n", "foo::2\t'22'\t2\n"]
+        self.assertEqual(["LocusID\tPattern\tPattern#\n", "foo::1\t'11'\t3\n", "foo::2\t'22'\t2\n"],
+                         list(PatternRegistry.remap_matrix_lines(matrix_lines, {1: 3})))
+        self.assertEqual(matrix_lines, list(PatternRegistry.remap_matrix_lines(matrix_lines, {})))
+
+
+class CollectionStatisticsTestCase(unittest.TestCase):
+    """ Recording stats with lanes must tally the same as recording them one position at a time. """
+
+    def test_lanes_same_as_per_position(self):
+        random_source = random.Random(7)
+        analyses = [( "sample{0}".format(index // 2), "analysis{0}".format(index), "sample{0}.vcf".format(index) ) for
+                    index in range(5)]
+        passed = [[random_source.random() < 0.7 for _ in range(40)] for _ in analyses]
+        recorded = [[random_source.random() < 0.9 for _ in range(40)] for _ in analyses]
+        expected = CollectionStatistics()
+        for current_pos in range(40):
+            for analysis_index, ( sample_nickname, sample_identifier, sample_path ) in enumerate(analyses):
+                if recorded[analysis_index][current_pos]:
+                    expected.record_sample_stat('was_called', sample_nickname, sample_identifier, sample_path,
+                                                passed[analysis_index][current_pos])
+            if passed[0][current_pos]:
+                expected.increment_contig_stat('all_called', "foo")
+            expected.flush_cumulative_stat_cache()
+        stats = CollectionStatistics()
+        for analysis_index, ( sample_nickname, sample_identifier, sample_path ) in enumerate(analyses):
+            analysis_recorded = CollectionStatistics.to_lanes(recorded[analysis_index])
+            stats.record_sample_stat_lanes('was_called', sample_nickname, sample_identifier, sample_path,
+                                           CollectionStatistics.to_lanes(passed[analysis_index]) & analysis_recorded,
+                                           analysis_recorded)
+        stats.increment_contig_stat_lanes('all_called', "foo", passed[0])
+        stats.flush_cumulative_stat_cache()
+        self.assertEqual(( expected._contig_stats, expected._sample_stats ), ( stats._contig_stats, stats._sample_stats ))
+        self.assertEqual(sum(passed[0]), stats.get_contig_stat('all_called'))
+
+
+class MatrixEngineTestCase(unittest.TestCase):
+    """ _format_matrix_contig must write the same matrices and stats as _format_matrix_line does per position. """
+
+    MATRIX_FORMATS = [('matrix', 'allcallable'), ('matrix', 'bestsnp'), ('matrix', 'missingdata'),
+                      ('matrix', 'includeref'), ('vcf', 'bestsnp'), ('vcf', 'missingdata'), ('fasta', 'bestsnp'),
+                      ('fasta', 'missingdata'), ('fasta', 'includeref')]
+
+    @staticmethod
+    def _build_collection(packed):
+        random_source = random.Random(4)
+        reference = ReferenceGenome(packed=packed)
+        reference.set_call([random_source.choice("AAAACCGGTTN") for _ in range(300)], 1, "X", "foo")
+        reference.set_call(list("ACGTACGTAC"), 1, "X", "bar")
+        reference._dups.append_contig(''.join(random_source.choice("0000001") for _ in range(300)), "foo")
+        collection = GenomeCollection()
+        collection.set_reference(reference)
+        for sample_index in range(6):
+            genome = FastaGenome(packed=packed) if sample_index == 5 else VCFGenome(packed=packed)
+            genome.set_file_path("sample{0}.vcf".format(sample_index))
+            genome.set_nickname("sample{0}".format(max(0, sample_index - 1)))
+            genome.add_generators(["gatk"])
+            for current_pos in range(1, 290):
+                # Mostly the same as the reference, so that there are shared columns and SNP lines.
+                call = random_source.choice(["A", "C", "G", "T", "N", "a", "CTT", "", "R"])
+                if random_source.random() < 0.9:
+                    call = reference.get_call(current_pos, None, "foo")
+                genome.set_call(call, current_pos, "X", "foo")
+                if sample_index != 5:
+                    if random_source.random() < 0.98:
+                        genome.set_was_called("Y", current_pos, "foo")
+                    genome.set_coverage_pass(random_source.choice("YYYYYYYYYYYYYYYYYYYYYYYYN?"), current_pos, "foo")
+                    genome.set_proportion_pass(random_source.choice("YYYYYYYYYYYYYYYYYYYYYYYYN-"), current_pos, "foo")
+            collection.add_genome(genome)
+        collection.add_failed_genome("failed.vcf")
+        return collection
+
+    def _send_to_matrix_handles(self, collection, line_by_line, num_threads=1):
+        matrix_formats = [{'dataformat': dataformat, 'filter': matrix_filter, 'handle': StringIO()} for
+                          dataformat, matrix_filter in self.MATRIX_FORMATS]
+        if line_by_line:
+            collection._format_matrix_contig = lambda current_contig, matrix_formats, pattern_registry: [
+                self._format_matrix_lines(collection, current_contig, current_pos, matrix_formats, pattern_registry) for
+                current_pos in range(1, collection.reference().get_contig_length(current_contig) + 1)]
+        collection.send_to_matrix_handles(matrix_formats, num_threads)
+        return [matrix_format['handle'].getvalue() for matrix_format in matrix_formats], \
+            collection._contig_stats, collection._sample_stats
+
+    @staticmethod
+    def _format_matrix_lines(collection, current_contig, current_pos, matrix_formats, pattern_registry):
+        collection._format_matrix_line(current_contig, current_pos, matrix_formats, pattern_registry)
+        for matrix_format in matrix_formats:
+            if matrix_format['dataformat'] in ( 'matrix', 'vcf' ) and matrix_format['linetowrite'] is not None:
+                matrix_format['handle'].write(matrix_format['linetowrite'])
+
+    def test_same_as_line_by_line(self):
+        for packed in (False, True):
+            expected = self._send_to_matrix_handles(self._build_collection(packed), True)
+            self.assertEqual(expected, self._send_to_matrix_handles(self._build_collection(packed), False))
+
+    def test_windows(self):
+        expected = self._send_to_matrix_handles(self._build_collection(True), False)
+        collection = self._build_collection(True)
+        collection.MATRIX_WINDOW_SIZE = 7
+        self.assertEqual(expected, self._send_to_matrix_handles(collection, False))
+
+    def test_shards(self):
+        expected = self._send_to_matrix_handles(self._build_collection(True), False)
+        collection = self._build_collection(True)
+        collection.MATRIX_SHARD_SIZE = 50
+        self.assertEqual(expected, self._send_to_matrix_handles(collection, False, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
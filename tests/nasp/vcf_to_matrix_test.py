@@ -0,0 +1,209 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nasp import vcf_to_matrix
+from nasp.nasp_objects import VCFGenome, ReferenceGenome, GenomeCollection
+
+
+class GenomeTransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.genome = VCFGenome(packed=True)
+        self.genome.set_file_path("sample.vcf")
+        self.genome.set_nickname("sample")
+        self.genome.set_call("ACGTN" * 2000, 1, "X", "foo")
+        self.genome.set_call("CTT", 7, "X", "foo")
+        self.genome.set_call("A", 3, "X", "bar")
+        self.genome.set_was_called("Y", 9999, "foo")
+        self.genome.set_coverage_pass("N", 2, "foo")
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_pack_to_scratch_file(self):
+        packed_genome = vcf_to_matrix.pack_genome(self.genome, self.scratch_dir)
+        # Only the small contig and the metadata are sent back.
+        self.assertLess(len(packed_genome[1]), vcf_to_matrix.SCRATCH_BUFFER_SIZE)
+        genome = vcf_to_matrix.unpack_genome(packed_genome)
+        self.assertEqual([], os.listdir(self.scratch_dir))
+        self.assertEqual("sample", genome.nickname())
+        self.assertEqual(self.genome.get_call(1, -1, "foo"), genome.get_call(1, -1, "foo"))
+        self.assertEqual(['X', 'X', 'A'], genome.get_call(1, -1, "bar"))
+        self.assertEqual(self.genome.get_filter_status("foo"), genome.get_filter_status("foo"))
+
+    def test_pack_without_scratch_dir(self):
+        self.assertIs(self.genome, vcf_to_matrix.unpack_genome(vcf_to_matrix.pack_genome(self.genome)))
+
+    def test_parse_input_files(self):
+        input_files = []
+        for sample_index, calls in enumerate(( "ACGT", "ACGTACGT" * 1000 )):
+            fasta_path = os.path.join(self.scratch_dir, "sample{0}.fasta".format(sample_index))
+            with open(fasta_path, 'w') as fasta_handle:
+                fasta_handle.write(">franken::foo\n{0}\n".format(calls))
+            input_files.append("frankenfasta,::" + fasta_path)
+        input_files.insert(1, "vcf,gatk,::" + os.path.join(self.scratch_dir, "missing.vcf"))
+        collection = GenomeCollection()
+        collection.set_reference(ReferenceGenome())
+        input_results = vcf_to_matrix.parse_input_files(input_files, 2, collection, 10, 0.9)
+        self.assertEqual(sorted(input_files), sorted(input_result['input_file'] for input_result in input_results))
+        self.assertEqual([os.path.join(self.scratch_dir, "missing.vcf")], collection._failed_genomes)
+        self.assertEqual(2, len(collection._genomes))
+        self.assertEqual(list("ACGT"), collection._genomes[0].get_call(1, -1, "foo"))
+        self.assertEqual(8000, collection._genomes[1].get_contig_length("foo"))
+        errors = dict(( input_result['input_file'], input_result['error'] ) for input_result in input_results)
+        self.assertTrue(errors[input_files[1]].startswith("FileNotFoundError"))
+        self.assertEqual([None, None], [errors[input_files[0]], errors[input_files[2]]])
+
+
+class ReadVCFBatchTestCase(unittest.TestCase):
+    """ Reading a VCF in batches must give the same genomes as reading it a record at a time. """
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.vcf_path = os.path.join(self.scratch_dir, "sample.vcf")
+        with open(self.vcf_path, 'w') as vcf_handle:
+            vcf_handle.writelines([
+                "##fileformat=VCFv4.1\n", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n",
+                "foo\t2\t.\tC\tT\t.\tPASS\tDP=30\tGT:AD\t1:1,14\t0:9,6\n",
+                "foo\t3\t.\tG\t.\t.\tPASS\tDP=4\tGT\t0\t0\n",
+                "foo\t3\t.\tG\tA\t.\tPASS\t.\tGT:DP:AD\t1:20:2,18\t./.:20\n",
+                "foo\t6\t.\tC\tG,T\t.\tPASS\t.\tAD:DP:GT\t0,1,9:10:2/2\t5,5,0:10:0/1\n",
+                "foo\t40\t.\tA\tC\t.\tPASS\t.\tGT:DP:AD\t1:20:2,18\t0:5:5,0\n",
+                "bar\t1\t.\tN\t.\t.\tPASS\tDP=8;DP4=1,2,3,4\tGT\t0\t0\n"])
+        self.reference = ReferenceGenome()
+        self.reference.set_call("ACGTACGT", 1, "X", "foo")
+        self.reference.set_call("NNN", 1, "X", "bar")
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_same_as_record_at_a_time(self):
+        from nasp.nasp_objects import VCFRecord
+
+        vcf_record = VCFRecord(self.vcf_path)
+        genomes = dict(( vcf_sample, VCFGenome(packed=True) ) for vcf_sample in vcf_record.get_samples())
+        while vcf_record.fetch_next_record():
+            vcf_to_matrix.read_vcf_record(self.reference, 10, 0.9, self.vcf_path, vcf_record, genomes)
+        vcf_record.close()
+        default_batch_size = VCFRecord.RECORD_BATCH_SIZE
+        for batch_size in ( 2, default_batch_size ):
+            VCFRecord.RECORD_BATCH_SIZE = batch_size
+            try:
+                batch_genomes = vcf_to_matrix.read_vcf_file(self.reference, 10, 0.9, "vcf,::" + self.vcf_path)
+            finally:
+                VCFRecord.RECORD_BATCH_SIZE = default_batch_size
+            for batch_genome in batch_genomes:
+                genome = genomes[batch_genome.nickname()]
+                for contig_name in ( "foo", "bar" ):
+                    self.assertEqual(genome.get_call(1, -1, contig_name), batch_genome.get_call(1, -1, contig_name))
+                    self.assertEqual(genome.get_filter_status(contig_name), batch_genome.get_filter_status(contig_name))
+        self.assertEqual(list("XTAXXT"), genomes["s1"].get_call(1, -1, "foo"))
+        self.assertEqual(b'NYYNNY', genomes["s1"].get_was_called_contig("foo"))
+
+    def _parse_input_files(self, min_coverage, min_proportion, genome_store=None):
+        collection = GenomeCollection()
+        collection.set_reference(self.reference)
+        vcf_to_matrix.parse_input_files(["vcf,::" + self.vcf_path], 1, collection, min_coverage, min_proportion,
+                                        genome_store)
+        return dict(( genome.nickname(), genome ) for genome in collection._genomes)
+
+    def test_genome_store(self):
+        genome_store = os.path.join(self.scratch_dir, "genomes")
+        for min_coverage, min_proportion in ( ( 10, 0.9 ), ( 3, 0.5 ) ):
+            genomes = self._parse_input_files(min_coverage, min_proportion)
+            stored_genomes = self._parse_input_files(min_coverage, min_proportion, genome_store)
+            self.assertEqual(sorted(genomes), sorted(stored_genomes))
+            for nickname, genome in genomes.items():
+                for contig_name in ( "foo", "bar" ):
+                    self.assertEqual(genome.get_call(1, -1, contig_name),
+                                     stored_genomes[nickname].get_call(1, -1, contig_name))
+                    self.assertEqual(genome.get_filter_status(contig_name),
+                                     stored_genomes[nickname].get_filter_status(contig_name))
+        store_paths = sorted(os.listdir(genome_store))
+        self.assertEqual(2, len(store_paths))
+        store_mtimes = [os.stat(os.path.join(genome_store, store_path)).st_mtime for store_path in store_paths]
+        # A changed input file is read in again.
+        with open(self.vcf_path, 'a') as vcf_handle:
+            vcf_handle.write("bar\t2\t.\tN\tA\t.\tPASS\t.\tGT:DP:AD\t1:20:2,18\t0:5:5,0\n")
+        self.assertEqual(['N', 'A'], self._parse_input_files(10, 0.9, genome_store)["s1"].get_call(1, -1, "bar"))
+        self.assertEqual(store_paths, sorted(os.listdir(genome_store)))
+        self.assertNotEqual(store_mtimes, [os.stat(os.path.join(genome_store, store_path)).st_mtime
+                                           for store_path in store_paths])
+
+    def test_run_state(self):
+        run_state = os.path.join(self.scratch_dir, "run_state")
+        fasta_path = os.path.join(self.scratch_dir, "external.fasta")
+        with open(fasta_path, 'w') as fasta_handle:
+            fasta_handle.write(">franken::foo\nACGAACGT\n")
+        input_files = ["vcf,::" + self.vcf_path]
+        self.assertEqual(input_files, vcf_to_matrix.get_run_input_files(run_state, input_files))
+        vcf_to_matrix.save_run_input_files(run_state, input_files)
+        # A later run is only given the new input files, and reading in old ones again does not add them twice.
+        input_files = vcf_to_matrix.get_run_input_files(run_state, ["frankenfasta,::" + fasta_path, input_files[0]])
+        self.assertEqual(["vcf,::" + self.vcf_path, "frankenfasta,::" + fasta_path], input_files)
+        vcf_to_matrix.save_run_input_files(run_state, input_files)
+        self.assertEqual(input_files, vcf_to_matrix.get_run_input_files(run_state, None))
+
+
+class StreamOutputMatricesTestCase(unittest.TestCase):
+    """ Streaming must write the same matrices and stats as reading everything in first. """
+
+    REFERENCE = {"zeta": "ACGTACGTACGTAC", "alpha": "GGCCAATT"}
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        vcf_lines = ["##fileformat=VCFv4.1\n", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"]
+        # Contigs are not in matrix order, and positions past the reference are skipped.
+        for contig_name, current_pos, alt_call in (( "zeta", 2, "T" ), ( "zeta", 3, "." ), ( "zeta", 9, "G" ),
+                                                   ( "zeta", 20, "A" ), ( "alpha", 1, "A" ), ( "alpha", 8, "." )):
+            reference_call = ( self.REFERENCE[contig_name] + "A" * 20 )[current_pos - 1]
+            vcf_lines.append("{0}\t{1}\t.\t{2}\t{3}\t.\tPASS\t.\tGT:DP:AD\t1:20:2,18\t0:5:5,0\n".format(
+                contig_name, current_pos, reference_call, alt_call))
+        self.input_files = ["vcf,bwa,gatk,::" + self._write_file("sample.vcf", vcf_lines),
+                            "frankenfasta,nucmer,::" + self._write_file("external.frankenfasta", [
+                                ">franken::zeta\n", "ACGA\n", "CGTN\n", ">franken::alpha\n", "GGCCA\n"]),
+                            "vcf,bwa,gatk,::" + os.path.join(self.scratch_dir, "missing.vcf")]
+        self.reference_path = self._write_file("reference.fasta", [
+            ">{0}\n{1}\n".format(contig_name, calls) for contig_name, calls in self.REFERENCE.items()])
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def _write_file(self, file_name, lines):
+        file_path = os.path.join(self.scratch_dir, file_name)
+        with open(file_path, 'w') as file_handle:
+            file_handle.writelines(lines)
+        return file_path
+
+    def _write_matrices(self, stream, window_size):
+        matrix_folder = tempfile.mkdtemp(dir=self.scratch_dir)
+        reference = ReferenceGenome()
+        vcf_to_matrix.import_reference(reference, self.reference_path, None)
+        collection = GenomeCollection()
+        collection.set_reference(reference)
+        collection.MATRIX_WINDOW_SIZE = window_size
+        if stream:
+            vcf_to_matrix.stream_output_matrices(collection, self.input_files, matrix_folder, "include_allref_pos",
+                                                 10, 0.9, 2)
+        else:
+            vcf_to_matrix.parse_input_files(self.input_files, 2, collection, 10, 0.9)
+            vcf_to_matrix.write_output_matrices(collection, matrix_folder, "include_allref_pos")
+        vcf_to_matrix.write_stats_data(collection, matrix_folder)
+        matrices = {}
+        for file_name in sorted(os.listdir(matrix_folder)):
+            with open(os.path.join(matrix_folder, file_name)) as matrix_handle:
+                matrices[file_name] = matrix_handle.read()
+        return matrices
+
+    def test_same_as_read_in(self):
+        expected = self._write_matrices(False, 65536)
+        self.assertIn("missing.vcf", expected['master_matrix.tsv'].split("\n", 1)[0])
+        for window_size in ( 65536, 3 ):
+            self.assertEqual(expected, self._write_matrices(True, window_size))
+
+
+if __name__ == '__main__':
+    unittest.main()